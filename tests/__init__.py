@@ -0,0 +1,33 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    unit tests, run from the repo root by `python -m unittest discover -s tests -t .`
+"""
+
+
+class patch:
+    """
+    set @obj.@name to @value inside a with block, the old value is restored on exit
+    """
+    def __init__(self, obj, name, value):
+        self.obj = obj
+        self.name = name
+        self.value = value
+        self._old = None
+
+    def __enter__(self):
+        self._old = getattr(self.obj, self.name)
+        setattr(self.obj, self.name, self.value)
+        return self.value
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        setattr(self.obj, self.name, self._old)
+
+    def start(self, test):
+        """
+        patch for the rest of @test <unittest.TestCase>
+        """
+        self.__enter__()
+        test.addCleanup(self.__exit__, None, None, None)
+        return self.value
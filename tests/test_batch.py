@@ -0,0 +1,169 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of topt.batch
+"""
+
+import os
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import unittest
+from video import trans
+from topt import batch
+from tests import patch
+
+
+def _dead_pid():
+    child = subprocess.Popen(["true"])
+    child.wait()
+    return child.pid
+
+
+class JobDbTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.db = batch.JobDb(os.path.join(self.dir, "jobs.db"))
+
+    def test_add_claim_finish(self):
+        self.assertTrue(self.db.add("/a.mp4", {"anchor_crf": 26}))
+        self.assertTrue(self.db.add("/b.mp4", {}))
+        self.assertFalse(self.db.add("/a.mp4", {"anchor_crf": 30}))
+        self.assertEqual(self.db.claim("w:1:0"), ("/a.mp4", {"anchor_crf": 26}))
+        self.assertEqual(self.db.claim("w:1:1"), ("/b.mp4", {}))
+        self.assertIsNone(self.db.claim("w:1:2"))
+        self.db.finish("/a.mp4", {"better": None})
+        self.db.fail("/b.mp4", "traceback")
+        self.assertEqual(self.db.status(), {batch.DONE: 1, batch.FAILED: 1})
+        job = self.db.query("/a.mp4")
+        self.assertEqual((job["state"], job["worker"], job["attempts"], job["result"], job["points"]),
+                         (batch.DONE, "w:1:0", 1, {"better": None}, 0))
+        self.assertIsNone(self.db.query("/c.mp4"))
+
+    def test_requeue(self):
+        self.db.add("/a.mp4", {})
+        self.db.add("/b.mp4", {})
+        self.db.claim("w:1:0")
+        self.db.fail("/a.mp4", "error")
+        self.assertEqual(self.db.requeue((batch.FAILED,)), 1)
+        self.assertEqual(self.db.claim("w:1:0"), ("/a.mp4", {}))
+        self.assertEqual(self.db.query("/a.mp4")["attempts"], 2)
+
+    def test_requeue_stale(self):
+        for path in ("/dead.mp4", "/alive.mp4", "/other.mp4"):
+            self.db.add(path, {})
+        host = socket.gethostname()
+        self.db.claim("{:s}:{:d}:0".format(host, _dead_pid()))
+        self.db.claim("{:s}:{:d}:0".format(host, os.getpid()))
+        self.db.claim("{:s}-other:{:d}:0".format(host, _dead_pid()))
+        self.assertEqual(self.db.requeue_stale(), 1)
+        self.assertEqual(self.db.query("/dead.mp4")["state"], batch.QUEUED)
+        self.assertEqual(self.db.query("/alive.mp4")["state"], batch.RUNNING)
+        self.assertEqual(self.db.query("/other.mp4")["state"], batch.RUNNING)
+
+    def test_claim_concurrent(self):
+        for i in range(20):
+            self.db.add("/{:d}.mp4".format(i), {})
+        claimed = []
+
+        def _work(index):
+            while True:
+                job = self.db.claim("w:1:{:d}".format(index))
+                if job is None:
+                    return
+                claimed.append(job[0])
+                self.db.finish(job[0], {})
+
+        threads = [threading.Thread(target=_work, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(claimed), sorted("/{:d}.mp4".format(i) for i in range(20)))
+
+    def test_points(self):
+        self.db.add("/a.mp4", {})
+        fmt = trans.Format(size=trans.TSize(1280, 720), crf=26.004, br=1500000.7, psnr=40.0, ssim=0.98, vmaf=93.5)
+        self.db.save_point("/a.mp4", fmt, "veryslow")
+        self.db.save_point("/a.mp4", fmt, "veryslow")
+        self.db.save_point("/a.mp4", fmt, "veryfast")
+        points = self.db.points("/a.mp4")
+        self.assertEqual(len(points), 2)
+        fmt, preset = sorted(points, key=lambda p: p[1])[1]
+        self.assertEqual((fmt.size.wxh(), fmt.crf, fmt.br, fmt.vmaf, preset),
+                         ("1280x720", 26.0, 1500000, 93.5, "veryslow"))
+        self.assertEqual(self.db.query("/a.mp4")["points"], 2)
+        self.assertEqual(self.db.points("/b.mp4"), [])
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.db = batch.JobDb(os.path.join(self.dir, "jobs.db"))
+        self.batch = batch.Batch(self.db, workers=2, cores=4)
+
+    def test_add_manifest(self):
+        manifest = os.path.join(self.dir, "titles.txt")
+        with open(manifest, "w") as f:
+            f.write("# titles\n/a.mp4\n\n" + json.dumps({"path": "/b.mp4", "anchor_crf": 30}) + "\n/a.mp4\n")
+        self.assertEqual(self.batch.add_manifest(manifest, {"anchor_crf": 26, "search_size": "720"}), 2)
+        self.assertEqual(self.db.query("/a.mp4")["params"], {"anchor_crf": 26, "search_size": "720"})
+        self.assertEqual(self.db.query("/b.mp4")["params"], {"anchor_crf": 30, "search_size": "720"})
+
+    def test_scan_spool(self):
+        spool = os.path.join(self.dir, "spool")
+        os.mkdir(spool)
+        path = os.path.join(spool, "a.mp4")
+        with open(path, "w") as f:
+            f.write("a")
+        open(os.path.join(spool, ".partial"), "w").close()
+        self.assertEqual(self.batch.scan_spool(spool, {}), 0)     # not known to be complete yet
+        with open(path, "a") as f:
+            f.write("b")
+        self.assertEqual(self.batch.scan_spool(spool, {}), 0)     # still growing
+        self.assertEqual(self.batch.scan_spool(spool, {}), 1)
+        self.assertEqual(self.batch.scan_spool(spool, {}), 0)     # queued already
+        self.assertEqual(self.db.status(), {batch.QUEUED: 1})
+
+    def test_run(self):
+        def _run_title(db, path, params, budget=None):
+            self.assertIs(budget, self.batch.budget)
+            if path == "/bad.mp4":
+                raise IOError("no such file")
+            return {"path": path}
+
+        patch(batch, "run_title", _run_title).start(self)
+        for path in ("/a.mp4", "/bad.mp4", "/b.mp4"):
+            self.db.add(path, {})
+        self.assertEqual(self.batch.run(), 2)
+        self.assertEqual(self.db.status(), {batch.DONE: 2, batch.FAILED: 1})
+        self.assertEqual(self.db.query("/b.mp4")["result"], {"path": "/b.mp4"})
+        self.assertIn("no such file", self.db.query("/bad.mp4")["error"])
+
+    def test_run_spool(self):
+        spool = os.path.join(self.dir, "spool")
+        os.mkdir(spool)
+        open(os.path.join(spool, "a.mp4"), "w").close()
+        done = []
+
+        def _run_title(db, path, params, budget=None):
+            done.append((path, params))
+            self.batch.stop()
+            return {}
+
+        patch(batch, "run_title", _run_title).start(self)
+        start = time.time()
+        self.assertEqual(self.batch.run(spool, {"anchor_crf": 26}, interval=0.05), 1)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(done, [(os.path.join(spool, "a.mp4"), {"anchor_crf": 26})])
+
+
+if __name__ == "__main__":
+    unittest.main()
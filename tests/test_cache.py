@@ -0,0 +1,203 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.cache
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from video import cache,trans,utils
+from tests import patch
+
+
+def _writer(data):
+    def _create(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        return True
+    return _create
+
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+
+    def _age(self, path, seconds):
+        t = time.time() - seconds
+        os.utime(path, (t, t))
+
+    def test_miss_then_hit(self):
+        c = cache.FileCache(self.cache_dir)
+        calls = []
+
+        def _create(tmp_path):
+            calls.append(tmp_path)
+            return _writer("abc")(tmp_path)
+
+        path = c.get("k", _create)
+        c.release(path)
+        self.assertEqual(c.get("k", _create), path)
+        c.release(path)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(open(path).read(), "abc")
+
+    def test_create_failed(self):
+        c = cache.FileCache(self.cache_dir)
+        self.assertIsNone(c.get("k", lambda tmp_path: False))
+        self.assertIsNone(c.lookup("k"))
+        # no partial entry is left
+        self.assertEqual(c._entries(), [])
+
+    def test_lookup(self):
+        c = cache.FileCache(self.cache_dir)
+        self.assertIsNone(c.lookup("k"))
+        c.release(c.get("k", _writer("abc")))
+        path = c.lookup("k")
+        self.assertEqual(path, c.path_of("k"))
+        c.release(path)
+
+    def test_evict_least_recently_used(self):
+        c = cache.FileCache(self.cache_dir, max_bytes=25)
+        for i, key in enumerate(("a", "b")):
+            path = c.get(key, _writer("x" * 10))
+            c.release(path)
+            self._age(path, 100 - i)
+        # "a" is used again, so "b" is the least recently used
+        c.release(c.get("a", _writer("x" * 10)))
+        c.release(c.get("c", _writer("x" * 10)))
+        self.assertTrue(os.path.isfile(c.path_of("a")))
+        self.assertFalse(os.path.isfile(c.path_of("b")))
+        self.assertTrue(os.path.isfile(c.path_of("c")))
+
+    def test_pinned_not_evicted(self):
+        c = cache.FileCache(self.cache_dir, max_bytes=15)
+        pinned = c.get("a", _writer("x" * 10))
+        self._age(pinned, 100)
+        c.release(c.get("b", _writer("x" * 10)))
+        # "a" is the least recently used, but in use
+        self.assertEqual(c.evict(), 10)
+        self.assertTrue(os.path.isfile(pinned))
+        self.assertFalse(os.path.isfile(c.path_of("b")))
+        c.release(pinned)
+        self.assertEqual(c.evict(), 0)      # within budget once "b" is gone
+
+    def test_unlimited(self):
+        c = cache.FileCache(self.cache_dir)
+        for key in "abc":
+            c.release(c.get(key, _writer("x" * 10)))
+        self.assertEqual(c.evict(), 0)
+        self.assertEqual(len(c._entries()), 3)
+
+
+class RefYuvCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+        self.decodes = []
+
+    def _to_yuv_by_size(self, original, tsize, save_name=None, _iparam=[], _oparam=[], save_dir=None):
+        self.decodes.append((tsize.wxh(), _iparam, _oparam))
+        path = os.path.join(save_dir, save_name)
+        open(path, "w").close()
+        return path
+
+    def test_decoded_once_per_key(self):
+        c = cache.RefYuvCache(self.cache_dir)
+        fd, source = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+        self.addCleanup(os.remove, source)
+        ref = trans.Format(path=source, size=trans.TSize(64, 32))
+        with patch(trans, "to_yuv_by_size", self._to_yuv_by_size):
+            paths = [c.get_ref_yuv(ref, trans.TSize(32, 16), cmp_frames=10) for _ in range(2)]
+            paths.append(c.get_ref_yuv(ref, trans.TSize(32, 16), cmp_frames=10, start_time=5))
+        for path in paths:
+            c.release(path)
+        self.assertEqual(paths[0], paths[1])
+        self.assertNotEqual(paths[0], paths[2])
+        self.assertEqual(self.decodes, [("32x16", [], ["-vframes", "10", "-pix_fmt", "yuv420p"]),
+                                        ("32x16", ["-ss", "5"], ["-vframes", "10", "-pix_fmt", "yuv420p"])])
+
+
+class TransCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.input = os.path.join(self.dir, "in.mp4")
+        open(self.input, "w").close()
+        self.cache = cache.TransCache(os.path.join(self.dir, "cache"), tool="ffmpeg")
+        self.calls = []
+        patch(cache, "tool_version", lambda tool: "ffmpeg version 4.4").start(self)
+
+    def _trans(self, returncode=0):
+        def _trans_func(input, iparam, oparam, output):
+            self.calls.append(oparam)
+            if returncode == 0:
+                with open(output, "w") as f:
+                    f.write(" ".join(oparam))
+            return returncode
+        return _trans_func
+
+    def test_hit(self):
+        output = os.path.join(self.dir, "a.mp4")
+        self.assertEqual(self.cache.trans(self.input, [], ["-crf", "23"], output, self._trans()), 0)
+        os.remove(output)
+        self.assertEqual(self.cache.trans(self.input, [], ["-crf", "23"], output, self._trans()), 0)
+        self.assertEqual(open(output).read(), "-crf 23")
+        self.assertEqual(self.cache.trans(self.input, [], ["-crf", "30"], output, self._trans()), 0)
+        self.assertEqual(self.calls, [["-crf", "23"], ["-crf", "30"]])
+
+    def test_key(self):
+        key = self.cache.key_of(self.input, [], ["-crf", "23"], "a.mp4")
+        self.assertEqual(key, self.cache.key_of(self.input, [], ["-crf", "23"], "b/c.mp4"))
+        self.assertNotEqual(key, self.cache.key_of(self.input, [], ["-crf", "23"], "a.mkv"))
+        with open(self.input, "w") as f:
+            f.write("changed")
+        self.assertNotEqual(key, self.cache.key_of(self.input, [], ["-crf", "23"], "a.mp4"))
+
+    def test_failure_not_cached(self):
+        output = os.path.join(self.dir, "a.mp4")
+        self.assertEqual(self.cache.trans(self.input, [], [], output, self._trans(returncode=2)), 2)
+        self.assertEqual(self.cache.trans(self.input, [], [], output, self._trans()), 0)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_output_rewritten_not_entry(self):
+        output = os.path.join(self.dir, "a.mp4")
+        self.cache.trans(self.input, [], ["-crf", "23"], output, self._trans())
+        entry = self.cache.lookup(self.cache.key_of(self.input, [], ["-crf", "23"], output))
+        self.cache.release(entry)
+        trans.unlink_shared(output)
+        with open(output, "w") as f:
+            f.write("other")
+        self.assertEqual(open(entry).read(), "-crf 23")
+
+    def test_multi_misses_only(self):
+        outputs = [(None, ["-crf", str(crf)], os.path.join(self.dir, "{:d}.mp4".format(crf))) for crf in (23, 30)]
+        self.cache.trans(self.input, [], ["", "-crf", "23"], outputs[0][2], self._trans())
+        self.calls = []
+
+        def _trans_multi(input, iparam, outputs):
+            return [self._trans()(input, iparam, oparam, output) for _, oparam, output in outputs]
+
+        self.assertEqual(self.cache.trans_multi(self.input, [], outputs, _trans_multi), [0, 0])
+        self.assertEqual(self.calls, [["-crf", "30"]])
+        self.calls = []
+        self.assertEqual(self.cache.trans_multi(self.input, [], outputs, _trans_multi), [0, 0])
+        self.assertEqual(self.calls, [])
+
+
+class ParseBytesTest(unittest.TestCase):
+    def test_parse_bytes(self):
+        self.assertEqual(utils.parse_bytes(None), 0)
+        self.assertEqual(utils.parse_bytes(123), 123)
+        self.assertEqual(utils.parse_bytes("20G"), 20 << 30)
+        self.assertEqual(utils.parse_bytes("1.5mb"), 3 << 19)
+        self.assertEqual(utils.parse_bytes("4096"), 4096)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.chunk
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from video import chunk,trans,cache
+from tests import patch
+
+
+class PlanTest(unittest.TestCase):
+    def test_plan_chunks(self):
+        keyframes = [0.0, 9.0, 19.5, 31.0, 42.0, 50.0, 61.0]
+        self.assertEqual(chunk.plan_chunks(keyframes, 60.0, 3), [(0.0, 19.5), (19.5, 42.0), (42.0, None)])
+        # at least min_chunk_time long
+        self.assertEqual(len(chunk.plan_chunks(keyframes, 60.0, 16)), 6)
+        self.assertEqual(chunk.plan_chunks(keyframes, 15.0, 4), [(0.0, None)])
+        self.assertEqual(chunk.plan_chunks([0.0], 60.0, 3), [(0.0, None)])
+
+    def test_share_cores(self):
+        self.assertEqual(chunk.share_cores("auto", 8), (8, 1))
+        self.assertEqual(chunk.share_cores(16, 8), (8, 1))
+        self.assertEqual(chunk.share_cores(3, 8), (3, 2))
+        self.assertEqual(chunk.share_cores(1, "8"), (1, 8))
+
+    def test_length_limited(self):
+        self.assertTrue(chunk.is_length_limited([], ["-t", "10"]))
+        self.assertTrue(chunk.is_length_limited(["-ss", "5"], []))
+        self.assertTrue(chunk.is_length_limited(["-to", "5"], []))
+        self.assertFalse(chunk.is_length_limited(["-y", "-threads", "0"], ["-crf", "23"]))
+
+    def test_split_audio_params(self):
+        oparam = ["-crf", "23", "-b:a", "48k", "-an", "-movflags", "faststart", "-acodec"]
+        self.assertEqual(chunk.split_audio_params(oparam),
+                         (["-crf", "23", "-an", "-acodec"], ["-b:a", "48k", "-an", "-movflags", "faststart"]))
+
+
+class TransChunkedTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.encodes = []
+        self.commands = []
+        for name, value in (("get_duration", lambda path: 60.0),
+                            ("get_keyframes", lambda path: [0.0, 20.0, 40.0])):
+            patch(chunk, name, value).start(self)
+
+    def _trans(self, input, iparam, oparam, output, trans_cache=None, on_progress=None):
+        self.encodes.append((iparam, oparam))
+        open(output, "w").close()
+        return 0
+
+    def _run_command(self, cmdargs, on_progress=None):
+        self.commands.append(cmdargs)
+        with open(cmdargs[-1], "w") as f:
+            f.write(str(len(self.commands)))
+        return 0
+
+    def test_chunks(self):
+        output = os.path.join(self.dir, "out.mp4")
+        with patch(trans, "trans_by_ioparam", self._trans), patch(trans, "run_command", self._run_command):
+            report = chunk.trans_chunked("in.mp4", ["-y"], ["-crf", "23", "-b:a", "48k"], output, chunks=3,
+                                         cores=3)
+        self.assertEqual(report["returncode"], 0)
+        self.assertEqual([(c["start"], c["end"]) for c in report["chunks"]], [(0.0, 20.0), (20.0, 40.0), (40.0, None)])
+        self.assertEqual(sorted(self.encodes),
+                         [(["-y"], ["-an", "-crf", "23", "-t", "20.000000"]),
+                          (["-y", "-ss", "20.000000"], ["-an", "-crf", "23", "-t", "20.000000"]),
+                          (["-y", "-ss", "40.000000"], ["-an", "-crf", "23"])])
+        # joined without re-encoding, audio taken from the input
+        command = self.commands[0]
+        self.assertEqual(command[-7:], ["-map", "1:a?", "-c:v", "copy", "-b:a", "48k", output])
+
+    def test_one_chunk(self):
+        for iparam, oparam, chunks, cores in ((["-ss", "5"], [], 3, 3), ([], ["-t", "5"], 3, 3), ([], [], 3, 1)):
+            self.encodes = []
+            with patch(trans, "trans_by_ioparam", self._trans), patch(trans, "run_command", self._run_command):
+                report = chunk.trans_chunked("in.mp4", iparam, oparam, os.path.join(self.dir, "out.mp4"),
+                                             chunks=chunks, cores=cores)
+            self.assertEqual(len(report["chunks"]), 1)
+            self.assertEqual(self.encodes, [(iparam, oparam)])
+        self.assertEqual(self.commands, [])
+
+    def test_to_264_chunked_threads(self):
+        original = trans.Format(path="in.mp4", size=trans.TSize(1280, 720))
+        with patch(trans, "trans_by_ioparam", self._trans), patch(trans, "run_command", self._run_command):
+            path, report = chunk.to_264_chunked(original, trans.TSize(shorter=360), 23, chunks=3,
+                                                save_dir=self.dir, cores=6)
+        self.assertIsNotNone(path)
+        self.assertEqual(len(report["chunks"]), 3)
+        # the cores are shared by the chunks
+        for _, oparam in self.encodes:
+            self.assertIn(":threads=2:", oparam[oparam.index("-x264opts") + 1])
+
+    def test_trans_cache(self):
+        patch(cache, "tool_version", lambda tool: "ffmpeg version 4.4").start(self)
+        trans_cache = cache.TransCache(os.path.join(self.dir, "cache"), tool="ffmpeg")
+        input = os.path.join(self.dir, "in.mp4")
+        output = os.path.join(self.dir, "out.mp4")
+        open(input, "w").close()
+
+        def _encode(chunks):
+            with patch(trans, "trans_by_ioparam", self._trans), patch(trans, "run_command", self._run_command):
+                report = chunk.trans_chunked(input, ["-y"], ["-crf", "23"], output, chunks=chunks, cores=3,
+                                             trans_cache=trans_cache)
+            with open(output) as f:
+                return report["cached"], len(self.encodes), f.read()
+
+        self.assertEqual(_encode(3), (False, 3, "1"))
+        self.assertEqual(_encode(3), (True, 3, "1"))
+        # other splits give another output, the one cached is not overwritten through the link
+        self.assertEqual(_encode(2), (False, 5, "2"))
+        self.assertEqual(_encode(3), (True, 5, "1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.clips
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from video import clips,trans
+from tests import patch
+
+
+def _scene(start, duration, complexity):
+    return {"start": start, "duration": duration, "frames": int(duration * 25), "complexity": complexity}
+
+
+class DetectScenesTest(unittest.TestCase):
+    def _vstats(self, frames):
+        """
+        :return: run_command() replacement writing @frames [(f_size, type), ...] as ffmpeg -vstats_file
+        """
+        def _run_command(cmdargs, on_progress=None):
+            with open(cmdargs[cmdargs.index("-vstats_file") + 1], "w") as f:
+                for i, (size, ftype) in enumerate(frames):
+                    f.write("frame= {:4d} q= 23.0 f_size= {:6d} s_size= 1kB time= {:.3f} br= 1.0kbits/s "
+                            "avg_br= 1.0kbits/s type= {:s}\n".format(i + 1, size, (i + 1) * 0.04, ftype))
+            return 0
+        return _run_command
+
+    def test_scenes(self):
+        frames = [(1000, "I")] + [(100, "P")] * 49 + [(3000, "I")] + [(300, "B")] * 24
+        with patch(trans, "run_command", self._vstats(frames)):
+            scenes = clips.detect_scenes("in.mp4")
+        self.assertEqual([(s["start"], s["frames"]) for s in scenes], [(0.04, 50), (2.04, 25)])
+        self.assertAlmostEqual(scenes[0]["duration"], 2.0)
+        self.assertAlmostEqual(scenes[0]["complexity"], (1000 + 49 * 100) / 50.0)
+
+    def test_long_scene(self):
+        with patch(trans, "run_command", self._vstats([(1000, "I")] + [(100, "P")] * 99)):
+            scenes = clips.detect_scenes("in.mp4", max_scene_time=1.0)
+        self.assertEqual([s["frames"] for s in scenes], [25, 25, 25, 25])
+
+    def test_failed(self):
+        with patch(trans, "run_command", lambda cmdargs, on_progress=None: 1):
+            self.assertEqual(clips.detect_scenes("in.mp4"), [])
+
+
+class SelectClipsTest(unittest.TestCase):
+    def test_groups(self):
+        scenes = [_scene(10.0 * i, 10.0, c) for i, c in enumerate([5, 1, 9, 3, 7, 2])]
+        selected = clips.select_clips(scenes, clips=3, clip_time=4.0)
+        self.assertEqual(len(selected), 3)
+        self.assertAlmostEqual(sum(c["weight"] for c in selected), 1.0)
+        self.assertEqual([c["start"] for c in selected], sorted(c["start"] for c in selected))
+        # one clip per complexity tercile, cut from the middle of the scene
+        self.assertEqual(sorted(c["complexity"] for c in selected), [1, 3, 7])
+        self.assertEqual(selected[0], {"start": 13.0, "duration": 4.0, "weight": 1 / 3.0, "complexity": 1})
+
+    def test_short_scenes(self):
+        scenes = [_scene(0.0, 1.0, 5), _scene(1.0, 6.0, 6), _scene(7.0, 1.0, 5)]
+        selected = clips.select_clips(scenes, clips=1, clip_time=4.0)
+        # a scene long enough for the whole clip wins over closer complexities
+        self.assertEqual(selected, [{"start": 2.0, "duration": 4.0, "weight": 1.0, "complexity": 6}])
+        self.assertEqual(clips.select_clips([], clips=3), [])
+
+
+class ClipCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.source = os.path.join(self.dir, "in.mp4")
+        open(self.source, "w").close()
+        self.detected = []
+        patch(clips, "detect_scenes", self._detect_scenes).start(self)
+        patch(clips, "_extract_clip", self._extract_clip).start(self)
+
+    def _detect_scenes(self, path, max_scene_time=20.0):
+        self.detected.append(path)
+        return [_scene(10.0 * i, 10.0, c) for i, c in enumerate([5, 1, 9])]
+
+    def _extract_clip(self, path, clip, clip_path):
+        open(clip_path, "w").close()
+        return 0
+
+    def test_reused(self):
+        cache = clips.ClipCache(os.path.join(self.dir, "clips"))
+        clip_set = cache.get_clips(self.source, clips=3)
+        self.assertEqual(len(clip_set), 3)
+        self.assertTrue(all(os.path.isfile(c["path"]) for c in clip_set))
+        self.assertEqual(cache.get_clips(self.source, clips=3), clip_set)
+        self.assertEqual(len(self.detected), 1)
+        # selected again once a clip file is gone
+        os.remove(clip_set[0]["path"])
+        self.assertEqual(cache.get_clips(self.source, clips=3), clip_set)
+        self.assertEqual(len(self.detected), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.eval
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from video import eval,trans,score,cache,framestore
+from tests import patch
+
+get_yuv_score = score.get_yuv_score
+
+
+class CollectSeqTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.reference = os.path.join(self.dir, "ref.mp4")
+        open(self.reference, "w").close()
+        self.probes, self.decodes, self.scored, self.saved = [], [], [], []
+        self.ref_caches = set()
+        self._lock = threading.Lock()
+        real_format = trans.Format
+        probes = self.probes
+
+        class _Format(real_format):
+            def __init__(self, path=None, probe=False, **kwargs):
+                real_format.__init__(self, path, **kwargs)
+                if probe is True:
+                    probes.append(path)
+                    self.size, self.br = trans.TSize(64, 32), len(os.path.basename(path)) * 1000
+
+        for obj, name, value in ((trans, "Format", _Format),
+                                 (trans, "to_yuv_by_size", self._to_yuv_by_size),
+                                 (score, "get_yuv_score", self._get_yuv_score),
+                                 (framestore, "save_frame_scores", self._save_frame_scores)):
+            patch(obj, name, value).start(self)
+
+    def _to_yuv_by_size(self, original, tsize, save_name=None, _iparam=[], _oparam=[], save_dir=None):
+        with self._lock:
+            self.decodes.append(tsize.wxh())
+        time.sleep(0.02)
+        path = os.path.join(save_dir, save_name)
+        open(path, "w").close()
+        return path
+
+    def _get_yuv_score(self, ref_fmt, dis_fmt, cmp_res=None, cmp_frames=None, ref_cache=None, frame_scores=None,
+                       **kwargs):
+        cmp_res = ref_fmt.size if cmp_res is None else cmp_res
+        ref_yuv = ref_cache.get_ref_yuv(ref_fmt, cmp_res, cmp_frames)
+        try:
+            time.sleep(0.01)
+            with self._lock:
+                self.scored.append(dis_fmt.path)
+                self.ref_caches.add(ref_cache)
+        finally:
+            ref_cache.release(ref_yuv)
+        if frame_scores is not None:
+            frame_scores["vmaf"] = [90.0]
+        return 40.0, 0.98, float(len(dis_fmt.path))
+
+    def _save_frame_scores(self, frame_scores, save_name, save_dir=None):
+        self.saved.append(save_name)
+        return save_name
+
+    def seq_cfg(self, *paths, **kwargs):
+        cfg = {"reference": {"path": self.reference}, "trans_list": [{"path": path} for path in paths]}
+        cfg.update(kwargs)
+        return cfg
+
+    def test_one_decoding(self):
+        paths = ["a.mp4", "bb.mp4", "ccc.mp4", "dddd.mp4"]
+        seq_cfg = self.seq_cfg(*paths)
+        seq_cfg["trans_list"][3]["cmp_res"] = trans.TSize(32, 16)
+        seq_data = eval.collect_seq_data({"workers": 4}, seq_cfg)
+        # in config order, whatever order they were scored in
+        self.assertEqual([t["path"] for t in seq_data["trans_list"]], paths)
+        self.assertEqual([t["vmaf"] for t in seq_data["trans_list"]], [5.0, 6.0, 7.0, 8.0])
+        self.assertEqual([t["rate"] for t in seq_data["trans_list"]], [5000, 6000, 7000, 8000])
+        self.assertEqual(sorted(self.scored), paths)
+        self.assertEqual(self.probes.count(self.reference), 1)
+        self.assertEqual(sorted(self.decodes), ["32x16", "64x32"])
+        # one temporary cache shared by the entries, removed with the sequence
+        self.assertEqual(len(self.ref_caches), 1)
+        self.assertFalse(os.path.isdir(self.ref_caches.pop().cache_dir))
+
+    def test_task_cache(self):
+        cache_dir = os.path.join(self.dir, "yuv")
+        task_cfg = {"workers": 2, "yuv_cache_dir": cache_dir}
+        eval.collect_seq_data(task_cfg, self.seq_cfg("a.mp4", "b.mp4"))
+        eval.collect_seq_data(task_cfg, self.seq_cfg("c.mp4"))
+        self.assertEqual(self.decodes, ["64x32"])
+        self.assertEqual(self.ref_caches, set([cache.get_ref_yuv_cache(cache_dir)]))
+        self.assertTrue(os.path.isdir(cache_dir))
+
+    def test_frame_scores_names(self):
+        seq_cfg = self.seq_cfg("x/out.mp4", "y/out.mp4", save_frame_scores=True)
+        seq_data = eval.collect_seq_data({"workers": 1}, seq_cfg)
+        self.assertEqual(len(set(self.saved)), 2)
+        for name, path in zip(self.saved, ("x/out.mp4", "y/out.mp4")):
+            self.assertEqual(name, "out.mp4.{:s}.frames.npz".format(cache.make_key(os.path.abspath(path))[:8]))
+        self.assertEqual([t["frame_scores"] for t in seq_data["trans_list"]], self.saved)
+
+    def test_pipe(self):
+        # the real get_yuv_score(), piped entries get no reference from the cache
+        ref_yuvs = {}
+
+        def _pipe_score(ref_fmt, dis_fmt, cmp_res, cmp_frames, has_psnr, has_vmaf, ref_yuv, *args):
+            ref_yuvs[dis_fmt.path] = ref_yuv
+            return 40.0, 0.98, 90.0
+
+        def _file_score(ref_fmt, dis_fmt, cmp_res, cmp_frames, has_psnr, has_vmaf, save_dir, ref_yuv, *args):
+            ref_yuvs[dis_fmt.path] = ref_yuv
+            return 40.0, 0.98, 90.0
+
+        for name, value in (("get_yuv_score", get_yuv_score), ("get_pipe_score", _pipe_score),
+                            ("_get_file_score", _file_score)):
+            patch(score, name, value).start(self)
+        eval.collect_seq_data({"workers": 2}, self.seq_cfg("a.mp4", "b.mp4", yuv_pipe=True))
+        self.assertEqual(ref_yuvs, {"a.mp4": None, "b.mp4": None})
+        self.assertEqual(self.decodes, [])
+        # only the entry scored through files decodes the reference
+        seq_cfg = self.seq_cfg("c.mp4", "d.mp4", yuv_pipe=True)
+        seq_cfg["trans_list"][1]["yuv_pipe"] = False
+        eval.collect_seq_data({"workers": 2}, seq_cfg)
+        self.assertIsNone(ref_yuvs["c.mp4"])
+        self.assertTrue(ref_yuvs["d.mp4"].endswith(".yuv"))
+        self.assertEqual(self.decodes, ["64x32"])
+
+    def test_temp_cache_in_save_dir(self):
+        save_dir = os.path.join(self.dir, "yuv")
+        eval.collect_seq_data({"workers": 1}, self.seq_cfg("a.mp4", yuv_pipe=True, yuv_save_dir=save_dir))
+        cache_dir = self.ref_caches.pop().cache_dir
+        self.assertEqual(os.path.dirname(cache_dir), save_dir)
+        self.assertFalse(os.path.isdir(cache_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.framestore
+"""
+
+import os
+import json
+import math
+import shutil
+import tempfile
+import unittest
+from video import framestore
+
+_SAMPLE = os.path.join(os.path.dirname(__file__), "..", "doc", "data_format", "video.score.vmaf.json")
+
+_LIBVMAF_LOG = """{
+  "version": "2.3.1",
+  "frames": [
+    {"frameNum": 0, "metrics": {"integer_motion2": 0.000000, "vmaf": 90.5}},
+    {"frameNum": 1, "metrics": {"integer_motion2": 1.5, "vmaf": 92.5}},
+    {"frameNum": 2, "metrics": {"vmaf": 94.0}}
+  ],
+  "pooled_metrics": {
+    "vmaf": {"min": 90.5, "max": 94.0, "mean": 92.333333, "harmonic_mean": 92.3}
+  },
+  "aggregate_metrics": {}
+}
+"""
+
+
+class VmafJsonParserTest(unittest.TestCase):
+    def test_run_vmaf_output(self):
+        with open(_SAMPLE) as f:
+            expected = json.load(f)
+        with open(_SAMPLE) as f:
+            parser = framestore.parse_vmaf_json(f)
+        self.assertEqual(parser.frames, len(expected["frames"]))
+        self.assertEqual(list(parser.columns["VMAF_score"]), [frame["VMAF_score"] for frame in expected["frames"]])
+        self.assertEqual(list(parser.columns["frameNum"]), range(len(expected["frames"])))
+        self.assertEqual(parser.vmaf(), expected["aggregate"]["VMAF_score"])
+        scores = parser.frame_scores()
+        self.assertIs(scores["vmaf"], scores["VMAF_score"])
+        self.assertEqual(scores[framestore.AGGREGATE_PREFIX + "VMAF_feature_adm2_score"],
+                         expected["aggregate"]["VMAF_feature_adm2_score"])
+
+    def test_libvmaf_log(self):
+        parser = framestore.parse_vmaf_json(_LIBVMAF_LOG.splitlines(True))
+        self.assertEqual(parser.frames, 3)
+        self.assertEqual(list(parser.columns["vmaf"]), [90.5, 92.5, 94.0])
+        # missing values are nan
+        motion = parser.columns["integer_motion2"]
+        self.assertEqual(list(motion[:2]), [0.0, 1.5])
+        self.assertTrue(math.isnan(motion[2]))
+        self.assertEqual(parser.vmaf(), 92.333333)
+        self.assertEqual(parser.aggregate["vmaf.harmonic_mean"], 92.3)
+        self.assertNotIn("version", parser.aggregate)
+
+    def test_split_lines(self):
+        # tokens split at any point give the same result, as long as a number is not cut
+        one_line = framestore.parse_vmaf_json([_LIBVMAF_LOG.replace("\n", "")])
+        by_token = framestore.parse_vmaf_json(_LIBVMAF_LOG.replace(",", ",\n").replace("{", "{\n").splitlines(True))
+        self.assertEqual(repr(one_line.columns), repr(by_token.columns))     # nan != nan
+        self.assertEqual(one_line.aggregate, by_token.aggregate)
+
+    def test_no_pooled(self):
+        parser = framestore.parse_vmaf_json(['{"frames": [{"vmaf": 80}, {"vmaf": 90}]}'])
+        self.assertEqual(parser.vmaf(), 85.0)
+        self.assertIsNone(framestore.parse_vmaf_json(['{"frames": []}']).vmaf())
+
+
+@unittest.skipIf(framestore.np is None, "numpy is not installed")
+class FrameScoresTest(unittest.TestCase):
+    def test_save_load(self):
+        save_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, save_dir, True)
+        parser = framestore.parse_vmaf_json(_LIBVMAF_LOG.splitlines(True))
+        path = framestore.save_frame_scores(parser.frame_scores(), "a.frames.npz", save_dir)
+        scores = framestore.FrameScores.load(path)
+        self.assertEqual(sorted(scores.keys()), ["frameNum", "integer_motion2", "vmaf"])
+        self.assertAlmostEqual(scores.mean("vmaf"), 92.333333, places=5)
+        self.assertAlmostEqual(scores.mean("integer_motion2"), 0.75)
+        self.assertEqual(scores.percentile("vmaf", 0), 90.5)
+        self.assertIsNone(framestore.save_frame_scores({}, "b.frames.npz", save_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.header on synthetic mp4 and matroska headers
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from video import header,info,proc
+from tests import patch
+
+
+def box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, payload, version=0):
+    return box(box_type, struct.pack(">I", version << 24) + payload)
+
+
+def mp4_trak(handler, entry, timescale, duration, sizes, deltas, extra=b"", edts=b""):
+    mdhd = full_box(b"mdhd", struct.pack(">IIII", 0, 0, timescale, duration) + b"\0" * 4)
+    hdlr = full_box(b"hdlr", struct.pack(">I4s", 0, handler) + b"\0" * 13)
+    stsd = full_box(b"stsd", struct.pack(">I", 1) + box(entry[0], entry[1]))
+    stsz = full_box(b"stsz", struct.pack(">II", 0, len(sizes)) + b"".join(struct.pack(">I", s) for s in sizes))
+    stts = full_box(b"stts", struct.pack(">I", len(deltas)) + b"".join(struct.pack(">II", *d) for d in deltas))
+    stbl = box(b"stbl", stsd + stts + stsz + extra)
+    return box(b"trak", edts + box(b"mdia", mdhd + hdlr + box(b"minf", stbl)))
+
+
+def video_entry(fourcc, w, h):
+    return fourcc, b"\0" * 6 + struct.pack(">H", 1) + b"\0" * 16 + struct.pack(">HH", w, h) + b"\0" * 50
+
+
+def audio_entry(fourcc, channels, sample_rate):
+    return fourcc, b"\0" * 6 + struct.pack(">H", 1) + b"\0" * 8 + struct.pack(">HHHHI", channels, 16, 0, 0,
+                                                                                sample_rate << 16)
+
+
+def ebml_vint(n):
+    return struct.pack(">B", 0x80 | n) if n < 127 else struct.pack(">Q", n | (1 << 56))
+
+
+def ebml(element_id, payload):
+    id_bytes = b""
+    while element_id:
+        id_bytes = struct.pack(">B", element_id & 0xff) + id_bytes
+        element_id >>= 8
+    return id_bytes + ebml_vint(len(payload)) + payload
+
+
+def ebml_uint(element_id, value):
+    return ebml(element_id, struct.pack(">I", value))
+
+
+def mkv(tracks, duration=12345.0):
+    segment_info = ebml(0x1549A966, ebml_uint(0x2AD7B1, 1000000) + ebml(0x4489, struct.pack(">d", duration)))
+    # the segment of a live muxed file has an unknown size
+    return ebml(0x1A45DFA3, ebml_uint(0x4286, 1)) + b"\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff" + \
+        segment_info + ebml(0x1654AE6B, b"".join(tracks)) + ebml(0x1F43B675, b"\0" * 50)
+
+
+MKV_VIDEO = ebml(0xAE, ebml_uint(0x83, 1) + ebml(0x86, b"V_MPEG4/ISO/AVC") + ebml_uint(0x23E383, 40000000) +
+                 ebml(0xE0, ebml_uint(0xB0, 1280) + ebml_uint(0xBA, 720)))
+MKV_AUDIO = ebml(0xAE, ebml_uint(0x83, 2) + ebml(0x86, b"A_OPUS") +
+                 ebml(0xE1, ebml(0xB5, struct.pack(">f", 48000.0)) + ebml_uint(0x9F, 2)))
+
+
+class HeaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def mp4(self, name="a.mp4", moov_extra=b""):
+        moov = box(b"moov", mp4_trak(b"vide", video_entry(b"avc1", 1920, 1080), 30000, 300300, [1000] * 300,
+                                     [(300, 1001)]) +
+                   mp4_trak(b"soun", audio_entry(b"mp4a", 2, 48000), 48000, 480000, [400] * 469, [(469, 1024)]) +
+                   moov_extra)
+        return self.write(name, box(b"ftyp", b"isom\0\0\0\0") + box(b"mdat", b"\0" * 100) + moov)
+
+
+class Mp4Test(HeaderTestCase):
+    def test_streams(self):
+        video, audio = header.probe(self.mp4())["streams"]
+        self.assertEqual((video["codec_type"], video["codec_name"], video["width"], video["height"]),
+                         ("video", "h264", 1920, 1080))
+        self.assertEqual(video["r_frame_rate"], "30000/1001")
+        self.assertEqual(video["nb_frames"], "300")
+        self.assertEqual(video["duration"], "10.010000")
+        self.assertEqual(video["bit_rate"], str(int(300 * 1000 * 8 / 10.01)))
+        self.assertEqual((audio["codec_type"], audio["codec_name"], audio["channels"], audio["sample_rate"]),
+                         ("audio", "aac", 2, "48000"))
+        self.assertEqual(audio["index"], 1)
+
+    def test_fragmented(self):
+        self.assertIsNone(header.probe(self.mp4(moov_extra=box(b"mvex", b""))))
+
+    def test_not_media(self):
+        self.assertIsNone(header.probe(self.write("a.txt", b"just some text, not a video")))
+        data = open(self.mp4(), "rb").read()
+        self.assertIsNone(header.probe(self.write("cut.mp4", data[:-40])))
+
+    def test_sample_tables(self):
+        n = 10
+        ctts = full_box(b"ctts", struct.pack(">I", n) + struct.pack(">II", 1, 1024) * n)
+        stss = full_box(b"stss", struct.pack(">III", 2, 1, 6))
+        elst = full_box(b"elst", struct.pack(">IIiI", 1, n * 512, 1024, 1 << 16))
+        trak = mp4_trak(b"vide", video_entry(b"avc1", 64, 48), 12800, n * 512, [1000 + i for i in range(n)],
+                        [(n, 512)], ctts + stss, box(b"edts", elst))
+        tables = header.sample_tables(self.write("b.mp4", box(b"ftyp", b"isom\0\0\0\0") + box(b"moov", trak)))
+        self.assertEqual((tables["timescale"], tables["count"], tables["sample_size"], tables["media_time"]),
+                         (12800, n, 0, 1024))
+        self.assertEqual(struct.unpack(">II", tables["stss"]), (1, 6))
+        self.assertEqual(struct.unpack(">II", tables["stts"]), (n, 512))
+        self.assertEqual(len(tables["ctts"]), 8 * n)
+        self.assertIsNone(header.sample_tables(self.mp4(), "audio")["stss"])
+        self.assertIsNone(header.sample_tables(self.write("c.mkv", mkv([MKV_VIDEO]))))
+
+
+class MkvTest(HeaderTestCase):
+    def test_streams(self):
+        video, audio = header.probe(self.write("a.mkv", mkv([MKV_VIDEO, MKV_AUDIO])))["streams"]
+        self.assertEqual((video["codec_type"], video["codec_name"], video["width"], video["height"]),
+                         ("video", "h264", 1280, 720))
+        self.assertEqual(video["r_frame_rate"], "25/1")
+        self.assertEqual(video["duration"], "12.345000")
+        # the bit-rate of the file is not the one of the video with audio in it
+        self.assertNotIn("bit_rate", video)
+        self.assertEqual((audio["codec_name"], audio["channels"], audio["sample_rate"]), ("opus", 2, "48000"))
+
+    def test_video_only(self):
+        path = self.write("v.mkv", mkv([MKV_VIDEO]))
+        video, = header.probe(path)["streams"]
+        self.assertEqual(video["bit_rate"], str(int(os.path.getsize(path) * 8 / 12.345)))
+
+
+class ProbeInfoTest(HeaderTestCase):
+    def test_no_ffprobe(self):
+        path = self.mp4()
+
+        def _run(cmdargs, on_stdout=None, on_stderr=None):
+            raise AssertionError("ffprobe ran")
+
+        with patch(proc, "run", _run):
+            mi = info.Media(path, probe=True, entries=info.STREAM_ENTRIES)
+        self.assertEqual((mi.video.w, mi.video.h, mi.audio.ch), (1920, 1080, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.info
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import threading
+from video import info,proc,trans
+from tests import patch
+
+_PROBE = {"streams": [{"codec_type": "video", "codec_name": "h264", "coded_width": 1920, "coded_height": 1080,
+                       "bit_rate": "4000000", "r_frame_rate": "25/1", "duration": "10.0"}]}
+
+
+class ProbeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.video = os.path.join(self.dir, "a.mp4")
+        with open(self.video, "w") as f:
+            f.write("a")
+        self.cache = info.ProbeCache(os.path.join(self.dir, "probe.db"))
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.get(self.video, "-show_streams"))
+        self.cache.put(self.video, "-show_streams", _PROBE)
+        self.assertEqual(self.cache.get(self.video, "-show_streams"), _PROBE)
+        self.assertIsNone(self.cache.get(self.video, "-show_format"))
+        # same file by another path
+        self.assertEqual(self.cache.get(os.path.join(self.dir, ".", "a.mp4"), "-show_streams"), _PROBE)
+
+    def test_changed_file(self):
+        self.cache.put(self.video, "-show_streams", _PROBE)
+        with open(self.video, "w") as f:
+            f.write("ab")
+        self.assertIsNone(self.cache.get(self.video, "-show_streams"))
+
+    def test_blob(self):
+        self.cache.put_blob(self.video, "packets", b"\0\1\2")
+        self.assertEqual(self.cache.get_blob(self.video, "packets"), b"\0\1\2")
+        self.cache.invalidate(self.video)
+        self.assertIsNone(self.cache.get_blob(self.video, "packets"))
+
+    def test_net_stream(self):
+        self.cache.put("rtmp://host/live", "-show_streams", _PROBE)
+        self.assertIsNone(self.cache.get("rtmp://host/live", "-show_streams"))
+
+    def test_ffprobe_once(self):
+        commands = []
+
+        def _run(cmdargs, on_stdout=None, on_stderr=None):
+            commands.append(cmdargs)
+            return 0, json.dumps(_PROBE), ""
+
+        info.set_probe_cache(self.cache.db_path)
+        self.addCleanup(info.set_probe_cache, None)
+        with patch(proc, "run", _run):
+            first = info.probe_info(self.video)
+            self.assertEqual(info.probe_info(self.video), first)
+            self.assertEqual(len(commands), 1)
+            info.invalidate_probe_cache(self.video)
+            info.probe_info(self.video)
+        self.assertEqual(len(commands), 2)
+
+
+class BatchProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.probed = []
+        self._lock = threading.Lock()
+        patch(info, "probe_info", self._probe_info).start(self)
+
+    def _probe_info(self, video, entries=None):
+        with self._lock:
+            self.probed.append((video, entries))
+        if video == "bad.mp4":
+            raise IOError(video)
+        return None if video == "missing.mp4" else _PROBE
+
+    def test_batch(self):
+        paths = ["{:d}.mp4".format(i) for i in range(8)] + ["bad.mp4", "missing.mp4"]
+        results = dict(info.probe_batch(paths, jobs=3))
+        self.assertEqual(sorted(results), sorted(paths))
+        self.assertEqual(results["3.mp4"].video.w, 1920)
+        self.assertEqual(results["3.mp4"].video.br, "4000000")
+        self.assertIsNone(results["bad.mp4"].probe_obj)
+        self.assertIsNone(results["missing.mp4"].probe_obj)
+        self.assertEqual(set(entries for _, entries in self.probed), set([info.STREAM_ENTRIES]))
+
+    def test_lazy_media(self):
+        mi = info.Media("a.mp4", probe="lazy", entries=info.STREAM_ENTRIES)
+        self.assertEqual(self.probed, [])
+        self.assertEqual(mi.video.h, 1080)
+        self.assertEqual(mi.audio.codec, "")
+        self.assertEqual(self.probed, [("a.mp4", info.STREAM_ENTRIES)])
+
+    def test_lazy_format(self):
+        fmt = trans.Format("a.mp4", probe="lazy")
+        fmt.crf = 23
+        self.assertEqual(self.probed, [])
+        self.assertEqual(fmt.size.wxh(), "1920x1080")
+        self.assertEqual(fmt.br, "4000000")
+        self.assertEqual(len(self.probed), 1)
+        self.assertRaises(AttributeError, getattr, fmt, "fps")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of topt.ladder
+"""
+
+import unittest
+from video import trans
+from topt import ladder
+from tests.test_sizeopt import SearchTestCase
+
+
+def _point(br, vmaf, h=720, crf=26):
+    return trans.Format(size=trans.TSize(h * 16 // 9, h), crf=crf, br=br, vmaf=vmaf)
+
+
+class HullTest(unittest.TestCase):
+    def test_upper_hull(self):
+        points = [_point(1000000, 80), _point(2000000, 90), _point(4000000, 94), _point(8000000, 96),
+                  _point(2000000, 85), _point(3000000, 88), _point(4000000, 97)]
+        hull = ladder.upper_hull(points)
+        self.assertEqual([(p.br, p.vmaf) for p in hull], [(1000000, 80), (2000000, 90), (4000000, 97)])
+        self.assertEqual(ladder.upper_hull([]), [])
+
+    def test_parse_bit_rate(self):
+        self.assertEqual(ladder.parse_bit_rate("1500k"), 1500000)
+        self.assertEqual(ladder.parse_bit_rate(" 2.5M"), 2500000)
+        self.assertEqual(ladder.parse_bit_rate("800000"), 800000)
+
+    def test_rungs(self):
+        builder = ladder.Ladder(None, [])
+        builder.hull = [_point(1000000, 80, 540), _point(2000000, 90, 720), _point(4000000, 95, 1080)]
+        rungs = builder.rungs(bit_rates=[500000, 2500000], vmafs=[85, 99])
+        self.assertEqual(rungs, [
+            {"size": "1280x720", "crf": 26.0, "br": 2000000, "vmaf": 90.0, "target": "br<=2500000"},
+            {"size": "1280x720", "crf": 26.0, "br": 2000000, "vmaf": 90.0, "target": "vmaf>=85"}])
+
+
+class BuildTest(SearchTestCase):
+    def test_build(self):
+        sizes = [trans.TSize(shorter=h) for h in (1080, 720, 540)]
+        builder = ladder.Ladder(self.ctx, sizes, max_encodes=30)
+        hull = builder.build()
+        self.assertLessEqual(len(self.encoder.calls), 30)
+        self.assertGreaterEqual(len(hull), 3)
+        brs = [int(p.br) for p in hull]
+        self.assertEqual(brs, sorted(brs))
+        self.assertEqual(hull, ladder.upper_hull(hull))
+        # every scored point is on or under the hull
+        scored = [p for size in sizes for p in self.ctx.points(size)]
+        self.assertEqual(ladder.upper_hull(scored), hull)
+        # the small sizes take the low bit-rates
+        self.assertEqual(hull[0].size.h, 540)
+        self.assertEqual(hull[-1].size.h, 1080)
+
+
+if __name__ == "__main__":
+    unittest.main()
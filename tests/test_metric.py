@@ -0,0 +1,81 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.metric, skipped without numpy
+"""
+
+import os
+import math
+import shutil
+import tempfile
+import unittest
+from video import trans
+try:
+    import numpy as np
+    from video import metric
+except ImportError:
+    np = None
+
+W, H = 32, 16
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class YuvScoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        rng = np.random.RandomState(0)
+        self.frames = rng.randint(16, 236, size=(5, trans.yuv420p_frame_bytes(W, H))).astype(np.uint8)
+
+    def _yuv(self, name, frames):
+        path = os.path.join(self.dir, name)
+        frames.tofile(path)
+        return path
+
+    def test_identical(self):
+        ref = self._yuv("ref.yuv", self.frames)
+        result = metric.yuv_score(ref, ref, W, H)
+        self.assertEqual(result["frames"], 5)
+        self.assertTrue(np.all(np.isinf(result["psnr"])))
+        self.assertTrue(np.allclose(result["ssim"], 1.0))
+
+    def test_constant_error(self):
+        ref = self._yuv("ref.yuv", self.frames)
+        dis = self._yuv("dis.yuv", self.frames + 1)
+        result = metric.yuv_score(ref, dis, W, H)
+        # mse 1 on every plane
+        self.assertAlmostEqual(result["psnr_avg"], 10 * math.log10(255 * 255), places=6)
+        for plane in metric.PLANES:
+            self.assertTrue(np.allclose(result["psnr_" + plane], result["psnr_avg"]))
+        self.assertTrue(np.all(result["ssim"] < 1.0))
+
+    def test_odd_size(self):
+        w, h = 33, 17
+        frames = np.random.RandomState(2).randint(16, 236, size=(3, trans.yuv420p_frame_bytes(w, h))).astype(np.uint8)
+        ref = self._yuv("ref.yuv", frames)
+        dis = self._yuv("dis.yuv", frames + 1)
+        result = metric.yuv_score(ref, dis, w, h)
+        self.assertEqual(result["frames"], 3)
+        self.assertTrue(np.allclose(result["psnr_u"], 10 * math.log10(255 * 255)))
+
+    def test_batches(self):
+        ref = self._yuv("ref.yuv", self.frames)
+        noisy = self.frames.astype(np.int32) + np.random.RandomState(1).randint(-8, 9, self.frames.shape)
+        dis = self._yuv("dis.yuv", np.clip(noisy, 0, 255).astype(np.uint8))
+        one = metric.yuv_score(ref, dis, W, H, batch=1, jobs=1)
+        many = metric.yuv_score(ref, dis, W, H, batch=2, jobs=3)
+        for key in ("psnr", "ssim", "psnr_y", "ssim_v"):
+            self.assertTrue(np.allclose(one[key], many[key]))
+        self.assertEqual(one["psnr_avg"], many["psnr_avg"])
+
+    def test_frames(self):
+        ref = self._yuv("ref.yuv", self.frames)
+        dis = self._yuv("dis.yuv", self.frames[:3])
+        self.assertEqual(metric.yuv_score(ref, dis, W, H)["frames"], 3)
+        self.assertEqual(metric.yuv_score(ref, ref, W, H, max_frames=2)["frames"], 2)
+        self.assertIsNone(metric.yuv_score(ref, self._yuv("empty.yuv", self.frames[:0]), W, H))
+
+
+if __name__ == "__main__":
+    unittest.main()
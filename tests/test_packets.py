@@ -0,0 +1,99 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.packets, the index needs numpy
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from video import packets,info,proc
+from tests import patch
+from tests.test_header import box,full_box,mp4_trak,video_entry
+
+N = 10      # frames of the synthetic mp4, 25 fps
+
+
+def _ffprobe(lines):
+    """
+    :return: proc.run() replacement printing @lines as `ffprobe -show_entries packet=... -of csv=p=0`
+    """
+    commands = []
+
+    def _run(cmdargs, on_stdout=None, on_stderr=None):
+        commands.append(cmdargs)
+        for line in lines:
+            on_stdout(line + "\n")
+        return 0, "", ""
+    return _run, commands
+
+
+class PacketsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        # b frames: pts = dts + 2 frames, with an edit list shifting them back by 2 frames
+        ctts = full_box(b"ctts", struct.pack(">I", N) + struct.pack(">II", 1, 1024) * N)
+        stss = full_box(b"stss", struct.pack(">III", 2, 1, 6))
+        elst = full_box(b"elst", struct.pack(">IIiI", 1, N * 512, 1024, 1 << 16))
+        trak = mp4_trak(b"vide", video_entry(b"avc1", 64, 48), 12800, N * 512, [1000 + i for i in range(N)],
+                        [(N, 512)], ctts + stss, box(b"edts", elst))
+        self.mp4 = os.path.join(self.dir, "b.mp4")
+        with open(self.mp4, "wb") as f:
+            f.write(box(b"ftyp", b"isom\0\0\0\0") + box(b"moov", trak))
+        self.mkv = os.path.join(self.dir, "a.mkv")
+        with open(self.mkv, "wb") as f:
+            f.write(b"\x1a\x45\xdf\xa3")
+
+
+@unittest.skipIf(packets.np is None, "numpy is not installed")
+class IndexTest(PacketsTestCase):
+    def test_sample_tables(self):
+        run, commands = _ffprobe([])
+        with patch(proc, "run", run):
+            index = packets.get_index(self.mp4)
+        self.assertEqual(commands, [])
+        self.assertEqual(len(index), N)
+        self.assertEqual(list(index.keyframes()), [0.0, 0.2])
+        self.assertEqual(list(index.pts[:2]), [0.0, 0.04])
+        self.assertEqual(list(index.dts[:2]), [-0.08, -0.04])
+        self.assertAlmostEqual(index.duration(), 0.4)
+        self.assertEqual(index.bit_rate(), int(sum(1000 + i for i in range(N)) * 8 / 0.4))
+
+    def test_ffprobe_scan(self):
+        lines = ["0.000000,0.000000,100,K_", "0.080000,0.040000,50,__", "0.040000,0.080000,60,__",
+                 "N/A,0.120000,70,K_", "", "garbage"]
+        run, commands = _ffprobe(lines)
+        with patch(proc, "run", run):
+            self.assertIsNone(packets.get_index(self.mkv, scan=False))
+            index = packets.get_index(self.mkv)
+        self.assertEqual(len(commands), 1)
+        self.assertEqual(len(index), 4)
+        # a packet without pts is placed by its dts
+        self.assertEqual(list(index.keyframes()), [0.0, 0.12])
+        times, bit_rates = index.bitrate_windows(0.1)
+        self.assertEqual(list(bit_rates), [(100 + 50 + 60) * 8 / 0.1, 70 * 8 / 0.1])
+
+    def test_probe_cache(self):
+        info.set_probe_cache(os.path.join(self.dir, "probe.db"))
+        self.addCleanup(info.set_probe_cache, None)
+        run, commands = _ffprobe(["0.000000,0.000000,100,K_", "0.040000,0.040000,50,__"])
+        with patch(proc, "run", run):
+            first = packets.get_index(self.mkv)
+            again = packets.get_index(self.mkv)
+        self.assertEqual(len(commands), 1)
+        self.assertEqual(again.to_bytes(), first.to_bytes())
+
+
+@unittest.skipIf(packets.np is not None, "numpy is installed")
+class NoNumpyTest(PacketsTestCase):
+    def test_no_index(self):
+        self.assertIsNone(packets.get_index(self.mp4))
+        self.assertIsNone(packets.get_bit_rate(self.mp4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.proc
+"""
+
+import time
+import unittest
+from video import proc
+
+
+class RunTest(unittest.TestCase):
+    def test_output(self):
+        returncode, out, err = proc.run(["sh", "-c", "echo a; echo b >&2; exit 3"])
+        self.assertEqual((returncode, out, err), (3, "a\n", "b\n"))
+
+    def test_callbacks(self):
+        lines = []
+        returncode, out, err = proc.run(["sh", "-c", "echo a; echo b; echo c >&2"], on_stdout=lines.append)
+        self.assertEqual((returncode, out, err), (0, "", "c\n"))
+        self.assertEqual(lines, ["a\n", "b\n"])
+
+    def test_full_pipes(self):
+        # both streams are drained at the same time
+        script = "head -c 1000000 /dev/zero | tr '\\\\0' e >&2; head -c 1000000 /dev/zero | tr '\\\\0' o"
+        returncode, out, err = proc.run(["sh", "-c", script])
+        self.assertEqual((returncode, len(out), len(err)), (0, 1000000, 1000000))
+
+    def test_kill_by_callback(self):
+        lines = []
+
+        def _on_line(line):
+            lines.append(line)
+            return True
+
+        returncode, _, _ = proc.run(["sh", "-c", "echo first; exec sleep 30"], on_stdout=_on_line)
+        self.assertNotEqual(returncode, 0)
+        self.assertEqual(lines, ["first\n"])
+
+    def test_callback_error(self):
+        def _on_line(line):
+            raise ValueError(line)
+
+        start = time.time()
+        self.assertRaises(ValueError, proc.run, ["sh", "-c", "echo first; exec sleep 30"], on_stdout=_on_line)
+        self.assertLess(time.time() - start, 10)
+
+    def test_stderr_callback_error(self):
+        # the rest of stderr is still drained, else the process would block on the full pipe
+        script = "echo first >&2; head -c 1000000 /dev/zero | tr '\\\\0' e >&2; exec sleep 30"
+        start = time.time()
+        self.assertRaises(ValueError, proc.run, ["sh", "-c", script], on_stderr=lambda line: int(line))
+        self.assertLess(time.time() - start, 10)
+
+
+class JobTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(proc.set_max_procs, proc.get_max_procs())
+
+    def test_gather_order(self):
+        def _delayed(value, delay):
+            time.sleep(delay)
+            return value
+        jobs = [proc.submit(_delayed, i, 0.05 * (3 - i)) for i in range(3)]
+        self.assertEqual(proc.gather(jobs), [0, 1, 2])
+
+    def test_error(self):
+        job = proc.submit(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, job.result)
+        self.assertTrue(job.done())
+
+    def test_timeout(self):
+        job = proc.submit(time.sleep, 0.5)
+        self.assertRaises(RuntimeError, job.result, 0.01)
+        self.assertIsNone(job.result())
+
+    def test_max_procs(self):
+        proc.set_max_procs(2)
+        start = time.time()
+        proc.gather([proc.run_async(["sleep", "0.2"]) for _ in range(4)])
+        self.assertGreaterEqual(time.time() - start, 0.4)
+        proc.set_max_procs(4)
+        start = time.time()
+        proc.gather([proc.run_async(["sleep", "0.2"]) for _ in range(4)])
+        self.assertLess(time.time() - start, 0.4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.rd
+"""
+
+import os
+import time
+import threading
+import unittest
+import video.trans as trans
+import video.rd.sched as sched
+import video.rd.collect as collect
+from tests import patch
+
+
+class ThreadsTest(unittest.TestCase):
+    def test_useful_threads(self):
+        self.assertEqual(sched.useful_threads(240), 2)
+        self.assertEqual(sched.useful_threads(720), 8)
+        self.assertEqual(sched.useful_threads(1080, cores=4), 4)
+        self.assertEqual(sched.useful_threads(4320), 32)
+        self.assertEqual(sched.get_cores("3"), 3)
+
+    def test_output_height(self):
+        self.assertEqual(sched.output_height("-s 1280x720 -c:v libx264", 1080), 720)
+        self.assertEqual(sched.output_height("-c:v libx264", 1080), 1080)
+
+    def test_set_threads(self):
+        oparam = "-c:v libx264 -x264opts crf=23:threads=36:lookahead-threads=4 -f mp4"
+        self.assertEqual(sched.set_threads(oparam, 18),
+                         "-c:v libx264 -x264opts crf=23:threads=18:lookahead-threads=2 -f mp4")
+        self.assertEqual(sched.set_threads("-c:v libx265 -x265-params crf=28:pools=8", 4),
+                         "-c:v libx265 -x265-params crf=28:pools=4")
+        self.assertEqual(sched.set_threads("-c:v libx265 -x265-params crf=28", 4),
+                         "-c:v libx265 -x265-params crf=28:pools=4")
+        self.assertEqual(sched.set_threads("-threads %THREADS% -c:v libx264", 6), "-threads 6 -c:v libx264")
+        self.assertEqual(sched.set_threads("-c:v libx264 -crf 23", 6), "-c:v libx264 -crf 23 -threads 6")
+
+
+class RunJobsTest(unittest.TestCase):
+    def test_budget(self):
+        running = [0, 0]    # cores in use, most cores in use at once
+        lock = threading.Lock()
+
+        def _job(i, threads):
+            with lock:
+                running[0] += threads
+                running[1] = max(running[1], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= threads
+            return i, threads
+
+        results = sched.run_jobs([(3, _job, (0,)), (3, _job, (1,)), (8, _job, (2,)), (1, _job, (3,))], 6)
+        self.assertEqual(results, [(0, 3), (1, 3), (2, 8), (3, 1)])
+        # a job asking for more than the budget takes all of it, and runs alone
+        self.assertEqual(running[1], 8)
+
+    def test_core_budget(self):
+        budget = sched.CoreBudget(4)
+        self.assertEqual(budget.acquire(8), 4)
+        self.assertEqual(budget.free, 0)
+        budget.release(4)
+        self.assertEqual(budget.acquire(1), 1)
+
+
+class _Fmt:
+    def __init__(self, path, probe=False):
+        self.size = trans.TSize(1280, 720)
+
+
+class TaskPointsTest(unittest.TestCase):
+    def test_shared_ref_cache(self):
+        calls = []
+
+        def _point(task_cfg, graph_cfg, line_cfg, point_cfg, threads=None, ref_cache=None):
+            calls.append(ref_cache)
+            return point_cfg["label"], threads
+
+        def _batch(task_cfg, graph_cfg, line_cfg, point_cfgs, threads=None, ref_cache=None):
+            calls.append(ref_cache)
+            return [(point_cfg["label"], threads) for point_cfg in point_cfgs]
+
+        line_cfgs = [{"output_param": "-s 640x360"}, {"output_param": "", "batch_points": True}]
+        point_cfgs = [{"label": "a"}, {"label": "b"}]
+        with patch(trans, "Format", _Fmt), patch(collect, "collect_point_data", _point), \
+                patch(collect, "collect_batch_data", _batch):
+            raw_points = collect.collect_task_points({}, [{"input": "x.mp4"}], line_cfgs, point_cfgs, 8)
+        self.assertEqual(raw_points, [[[("a", 4), ("b", 4)], [("a", 8), ("b", 8)]]])
+        # one temporary cache for all points, removed when done
+        self.assertEqual(len(set(calls)), 1)
+        self.assertIsNotNone(calls[0])
+        self.assertFalse(os.path.exists(calls[0].cache_dir))
+
+    def test_pipe_lines(self):
+        calls = {}
+
+        def _point(task_cfg, graph_cfg, line_cfg, point_cfg, threads=None, ref_cache=None):
+            calls[line_cfg["label"]] = ref_cache
+
+        line_cfgs = [{"label": "pipe", "output_param": ""}, {"label": "file", "output_param": "", "yuv_pipe": False}]
+        with patch(trans, "Format", _Fmt), patch(collect, "collect_point_data", _point):
+            collect.collect_task_points({"yuv_pipe": True}, [{"input": "x.mp4"}], line_cfgs[:1], [{}], 8)
+            # no reference yuv written for piped lines
+            self.assertEqual(calls, {"pipe": None})
+            collect.collect_task_points({"yuv_pipe": True}, [{"input": "x.mp4"}], line_cfgs, [{}], 8)
+        self.assertIsNone(calls["pipe"])
+        self.assertIsNotNone(calls["file"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.sample
+"""
+
+import unittest
+from video import sample,score
+from tests import patch
+
+
+class _Fmt:
+    class info:
+        class video:
+            ts = "100.0"
+            fps = "25/1"
+            frames = 2500
+
+
+class StatsTest(unittest.TestCase):
+    def test_t_quantile(self):
+        self.assertAlmostEqual(sample.t_quantile(0.95, 10 ** 6), 1.96, places=4)
+        # 2.571 for 5 degrees of freedom
+        self.assertAlmostEqual(sample.t_quantile(0.95, 5), 2.571, delta=0.01)
+        self.assertGreater(sample.t_quantile(0.95, 2), sample.t_quantile(0.95, 5))
+        self.assertEqual(sample.t_quantile(0.95, 0), float("inf"))
+        self.assertRaises(ValueError, sample.t_quantile, 0.97, 5)
+
+    def test_stratum_order(self):
+        self.assertEqual(sample.stratum_order(8), [0, 4, 2, 6, 1, 5, 3, 7])
+        self.assertEqual(sorted(sample.stratum_order(5)), range(5))
+        self.assertEqual(sample.stratum_order(5)[:2], [0, 4])
+        self.assertEqual(sample.stratum_order(1), [0])
+
+    def test_estimate(self):
+        estimate = sample.Estimate(0.95)
+        estimate.add(40, 0.98, 90)
+        self.assertEqual(estimate.half_width("vmaf"), float("inf"))
+        self.assertIsNone(estimate.bounds()["vmaf_ci"])
+        estimate.add(42, 0.98, 92)
+        self.assertEqual(estimate.mean("vmaf"), 91.0)
+        self.assertEqual(estimate.half_width("ssim"), 0.0)
+        self.assertTrue(estimate.reached({"ssim": 0.001}))
+        self.assertFalse(estimate.reached({"ssim": 0.001, "vmaf": 1.0}))
+
+    def test_finite_population(self):
+        estimate = sample.Estimate(0.95, population=2)
+        estimate.add(40, 0.98, 90)
+        estimate.add(42, 0.97, 92)
+        # every stratum is scored, the mean is exact
+        self.assertEqual(estimate.half_width("vmaf"), 0.0)
+
+
+class SampledScoreTest(unittest.TestCase):
+    def setUp(self):
+        self.starts = []
+
+    def _score(self, scores):
+        def _get_yuv_score(ref_fmt, dis_fmt, cmp_res=None, cmp_frames=None, start_time=None, **kw):
+            self.starts.append(start_time)
+            return scores(len(self.starts))
+        return patch(score, "get_yuv_score", _get_yuv_score)
+
+    def test_all_windows_without_ci(self):
+        with self._score(lambda i: (40, 0.98, 90)):
+            psnr, ssim, vmaf, bounds = sample.get_sampled_score(_Fmt, None, window=25, max_windows=8)
+        self.assertEqual(bounds["windows"], 8)
+        self.assertEqual((psnr, vmaf), (40, 90))
+        self.assertAlmostEqual(ssim, 0.98)
+        # 1s windows centred in 12.5s strata
+        self.assertEqual(self.starts[:3], [5.75, 55.75, 30.75])
+
+    def test_stop_at_ci(self):
+        with self._score(lambda i: (40, 0.98, 90)):
+            _, _, _, bounds = sample.get_sampled_score(_Fmt, None, ci={"vmaf": 0.5}, min_windows=3, max_windows=8)
+        self.assertEqual(bounds["windows"], 3)
+        with self._score(lambda i: (40, 0.98, 80 + 20 * (i % 2))):
+            _, _, _, bounds = sample.get_sampled_score(_Fmt, None, ci={"vmaf": 0.5}, min_windows=3, max_windows=8)
+        self.assertEqual(bounds["windows"], 8)
+        self.assertRaises(ValueError, sample.get_sampled_score, _Fmt, None, ci={"psnr_y": 0.5})
+
+    def test_failed_window(self):
+        with self._score(lambda i: (0, 0, 0) if i == 2 else (40, 0.98, 90)):
+            _, _, vmaf, bounds = sample.get_sampled_score(_Fmt, None, max_windows=4)
+        self.assertEqual(len(self.starts), 4)
+        self.assertEqual(bounds["windows"], 3)
+        self.assertEqual(vmaf, 90)
+
+
+if __name__ == "__main__":
+    unittest.main()
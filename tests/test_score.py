@@ -0,0 +1,190 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.score
+"""
+
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import unittest
+from video import score,trans
+from tests import patch
+
+
+def _fake_decoder(data, exit_code=0):
+    """
+    :return: open_yuv_pipe() replacement writing @data into the pipe
+    """
+    def _open_yuv_pipe(original, tsize, pipe_path, _iparam=[], _oparam=[]):
+        script = "printf '{:s}' > \"$0\"; exit {:d}".format(data[original], exit_code)
+        return subprocess.Popen(["sh", "-c", script, pipe_path])
+    return _open_yuv_pipe
+
+
+class WaitDecodersTest(unittest.TestCase):
+    def test_all_succeeded(self):
+        self.assertTrue(score._wait_decoders([subprocess.Popen(["true"]), subprocess.Popen(["true"])]))
+
+    def test_failed(self):
+        self.assertFalse(score._wait_decoders([subprocess.Popen(["true"]), subprocess.Popen(["false"])]))
+
+    def test_blocked_is_killed(self):
+        blocked = subprocess.Popen(["sleep", "30"])
+        self.assertFalse(score._wait_decoders([blocked], timeout=0.1))
+        self.assertIsNotNone(blocked.poll())
+
+
+class ScoreByPipeTest(unittest.TestCase):
+    def setUp(self):
+        self.pipes = []
+
+    def _read_both(self, ref_yuv, dis_yuv, cmp_res):
+        self.pipes += [ref_yuv, dis_yuv]
+        with open(ref_yuv) as ref, open(dis_yuv) as dis:
+            return ref.read(), dis.read()
+
+    def test_pipes(self):
+        with patch(trans, "open_yuv_pipe", _fake_decoder({"ref": "R", "dis": "D"})):
+            ret = score._get_score_by_pipe(self._read_both, "ref", "dis", trans.TSize(2, 2), [], [])
+        self.assertEqual(ret, ("R", "D"))
+        # the pipes and their dir are gone
+        self.assertFalse(os.path.exists(os.path.dirname(self.pipes[0])))
+
+    def test_ref_yuv_file(self):
+        fd, ref_yuv = tempfile.mkstemp(suffix=".yuv")
+        os.close(fd)
+        self.addCleanup(os.remove, ref_yuv)
+        with patch(trans, "open_yuv_pipe", _fake_decoder({"dis": "D"})):
+            ret = score._get_score_by_pipe(lambda r, d, c: (r, open(d).read()), "ref", "dis",
+                                           trans.TSize(2, 2), [], [], ref_yuv=ref_yuv)
+        self.assertEqual(ret, (ref_yuv, "D"))
+
+    def test_decoder_failed(self):
+        with patch(trans, "open_yuv_pipe", _fake_decoder({"ref": "R", "dis": "D"}, exit_code=1)):
+            ret = score._get_score_by_pipe(self._read_both, "ref", "dis", trans.TSize(2, 2), [], [])
+        self.assertIsNone(ret)
+
+    def test_scorer_exits_early(self):
+        # decoders blocked on a pipe nobody opens are killed
+        with patch(trans, "open_yuv_pipe", _fake_decoder({"ref": "R", "dis": "D"})):
+            ret = score._get_score_by_pipe(lambda r, d, c: 1, "ref", "dis", trans.TSize(2, 2), [], [])
+        self.assertIsNone(ret)
+
+
+_PSNR_LINE = "[Parsed_psnr_0 @ 0x55d1c7a3c2c0] PSNR y:41.21 u:45.02 v:45.67 average:42.305123 min:39.1 max:46.2"
+_SSIM_LINE = "[Parsed_ssim_1 @ 0x55d1c7a3d0c0] SSIM Y:0.981 (17.2) U:0.990 (20.1) V:0.991 (20.4) All:0.984512 (18.08)"
+_VMAF_LINE = "[Parsed_libvmaf_2 @ 0x55d1c7a3e0c0] VMAF score: 93.417021"
+
+
+class LavfiScoreTest(unittest.TestCase):
+    def test_regex(self):
+        self.assertEqual(score._psnr_regex.search(_PSNR_LINE).group("psnr"), "42.305123")
+        self.assertEqual(score._ssim_regex.search(_SSIM_LINE).group("ssim"), "0.984512")
+        self.assertEqual(score._vmaf_regex.search(_VMAF_LINE).group("vmaf"), "93.417021")
+        self.assertEqual(score._vmaf_regex.search(_VMAF_LINE.replace(": ", "=")).group("vmaf"), "93.417021")
+
+    def test_args(self):
+        cmd_args = score._lavfi_score_args("ref.yuv", "dis.yuv", trans.TSize(64, 32))
+        graph = cmd_args[cmd_args.index("-lavfi") + 1]
+        self.assertEqual(graph, "[0:v]split=3[r0][r1][r2];[1:v]split=3[d0][d1][d2];"
+                                "[r0][d0]psnr;[r1][d1]ssim;[d2][r2]libvmaf")
+        self.assertEqual([cmd_args[i + 1] for i, a in enumerate(cmd_args) if a == "-i"], ["ref.yuv", "dis.yuv"])
+        cmd_args = score._lavfi_score_args("ref.yuv", "dis.yuv", trans.TSize(64, 32), False, "v.json")
+        self.assertEqual(cmd_args[cmd_args.index("-lavfi") + 1], "[1:v][0:v]libvmaf=log_fmt=json:log_path=v.json")
+
+    def test_one_command(self):
+        script = "printf '%s\\n%s\\n%s\\n' \"$0\" \"$1\" \"$2\" >&2"
+        cmd_args = ["sh", "-c", script, _PSNR_LINE, _SSIM_LINE, _VMAF_LINE]
+        self.assertEqual(score._get_lavfi_score_from_command(cmd_args), (42.305123, 0.984512, 93.417021))
+
+    def _passes(self, has_libvmaf, has_psnr=True, has_vmaf=True, backend="auto"):
+        passes = []
+
+        def _run_pass(score_func):
+            passes.append(score_func)
+            return {"lavfi": (1, 2, 3), "_psnr_ssim_args": (1, 2), "_vmaf_args": 3}[score_func]
+
+        with patch(score, "has_libvmaf", lambda: has_libvmaf):
+            with patch(score, "_lavfi_pass", lambda *args: "lavfi"):
+                with patch(score, "_command_pass", lambda cmd_args_func, get_score_func: cmd_args_func.__name__):
+                    ret = score._run_score_passes(_run_pass, has_psnr, has_vmaf, backend)
+        return passes, ret
+
+    def test_single_pass(self):
+        self.assertEqual(self._passes(True), (["lavfi"], (1, 2, 3)))
+        self.assertEqual(self._passes(False), (["_psnr_ssim_args", "_vmaf_args"], (1, 2, 3)))
+        self.assertEqual(self._passes(True, backend="run_vmaf")[0], ["_psnr_ssim_args", "_vmaf_args"])
+        self.assertEqual(self._passes(True, has_vmaf=False)[0], ["_psnr_ssim_args"])
+        self.assertRaises(ValueError, self._passes, True, backend="vmafossexec")
+
+
+class ChunkedVmafTest(unittest.TestCase):
+    FRAMES = 100
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.yuv = os.path.join(self.dir, "a.yuv")
+        with open(self.yuv, "wb") as f:
+            f.write("\0" * 6 * self.FRAMES)    # 2x2 yuv420p frames
+        self.commands = []
+
+    def _vmaf_command(self, drop=0):
+        """
+        :return: _get_vmaf_from_lavfi_command() replacement logging vmaf = frame number of the whole file
+        """
+        def _get_vmaf(cmd_args):
+            self.commands.append(cmd_args)
+            start = int(round(float(cmd_args[cmd_args.index("-ss") + 1]) * score._RAW_FPS))
+            frames = int(cmd_args[cmd_args.index("-frames:v") + 1]) - drop
+            vmaf_log = cmd_args[cmd_args.index("-lavfi") + 1].split("log_path=")[1]
+            with open(vmaf_log, "w") as f:
+                json.dump({"frames": [{"frameNum": i, "metrics": {"vmaf": start + i}} for i in range(frames)],
+                           "pooled_metrics": {"vmaf": {"mean": 0}}}, f)
+            return 0
+        return _get_vmaf
+
+    def test_chunks_equal_single_pass(self):
+        frame_scores = {}
+        with patch(score, "_get_vmaf_from_lavfi_command", self._vmaf_command()):
+            vmaf = score._chunked_vmaf_pass(3, frame_scores)(self.yuv, self.yuv, trans.TSize(2, 2))
+        self.assertEqual(len(self.commands), 3)
+        # neighbour frames are decoded but dropped
+        self.assertEqual([c[c.index("-frames:v") + 1] for c in self.commands], ["34", "35", "35"])
+        self.assertEqual(frame_scores["vmaf"], range(self.FRAMES))
+        self.assertEqual(vmaf, 49.5)
+        self.assertEqual(frame_scores["aggregate.vmaf.mean"], 49.5)
+
+    def test_odd_size(self):
+        with open(self.yuv, "wb") as f:
+            f.write("\0" * 17 * self.FRAMES)   # 3x3 yuv420p frames, 2x2 chroma
+        frame_scores = {}
+        with patch(score, "_get_vmaf_from_lavfi_command", self._vmaf_command()):
+            score._chunked_vmaf_pass(3, frame_scores)(self.yuv, self.yuv, trans.TSize(3, 3))
+        self.assertEqual(frame_scores["vmaf"], range(self.FRAMES))
+
+    def test_chunks_limited_by_length(self):
+        with patch(score, "_get_vmaf_from_lavfi_command", self._vmaf_command()):
+            score._chunked_vmaf_pass(16)(self.yuv, self.yuv, trans.TSize(2, 2))
+        self.assertEqual(len(self.commands), self.FRAMES // score._MIN_CHUNK_FRAMES)
+
+    def test_missing_frames(self):
+        with patch(score, "_get_vmaf_from_lavfi_command", self._vmaf_command(drop=1)):
+            self.assertIsNone(score._chunked_vmaf_pass(2)(self.yuv, self.yuv, trans.TSize(2, 2)))
+
+    def test_needs_libvmaf(self):
+        for has_libvmaf, expected in ((True, "chunked"), (False, "_vmaf_args")):
+            passes = []
+            with patch(score, "has_libvmaf", lambda: has_libvmaf):
+                with patch(score, "_chunked_vmaf_pass", lambda chunks, frame_scores: "chunked"):
+                    with patch(score, "_command_pass", lambda cmd_args_func, get_score_func: cmd_args_func.__name__):
+                        score._run_score_passes(lambda f: passes.append(f) or 1, False, True, "auto", vmaf_chunks=4)
+            self.assertEqual(passes, [expected])
+
+
+if __name__ == "__main__":
+    unittest.main()
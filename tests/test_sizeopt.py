@@ -0,0 +1,405 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of topt.sizeopt, encodes are simulated by a smooth rd model
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from video import trans,score,packets,cache,clips
+from topt import sizeopt
+from tests import patch
+
+SOURCE = trans.Format(path="source.mp4", size=trans.TSize(1920, 1080))
+
+
+class _Encoder:
+    """
+    stands in for score.trans_and_get_score() and score.trans_multi_and_get_score():
+    vmaf falls linearly with crf and with the size, bit-rate halves every 6 crf
+    """
+    def __init__(self, proxy_preset=sizeopt.PROXY_PRESET, fail=None, duration=10):
+        """
+        :param fail: fail(h, crf, preset) -> True for the encodes to fail
+        :param duration: seconds of the originals, an encode reports its progress every second of it
+        """
+        self.proxy_preset = proxy_preset
+        self.fail = fail
+        self.duration = duration
+        self.vmaf_offsets = {}  # path of an original, or (path, height) -> vmaf added to its encodes
+        self.frame_vmafs = {}   # path of an original -> per-frame vmaf around the mean of its encodes
+        self.calls = []         # (h, crf, preset) of each encode
+        self._lock = threading.Lock()
+
+    def model(self, h, crf, preset):
+        vmaf = 100 - 1.5 * (crf - 20) - 20 * (1 - h / 1080.0)
+        br = 5e6 * (h / 1080.0) ** 1.5 * 2 ** (-(crf - 20) / 6.0)
+        if preset == self.proxy_preset:
+            vmaf, br = vmaf - 1.0, br * 1.3
+        return vmaf, int(br)
+
+    def trans_and_get_score(self, ori_fmt, dis_fmt, ref_cache=None, trans_cache=None, chunks=None,
+                            preset="veryslow", threads=36, frame_scores=None, on_progress=None):
+        h = dis_fmt.size.shorter2wxh(ori_fmt.size).h
+        with self._lock:
+            self.calls.append((h, dis_fmt.crf, preset))
+        if self.fail is not None and self.fail(h, dis_fmt.crf, preset):
+            return dis_fmt
+        vmaf, br = self.model(h, dis_fmt.crf, preset)
+        for t in range(1, self.duration + 1) if on_progress is not None else []:
+            if on_progress({"out_time_us": str(t * 1000000), "total_size": str(br * t // 8)}) is True:
+                return dis_fmt      # aborted, not scored
+        dis_fmt.vmaf, dis_fmt.br = vmaf, br
+        dis_fmt.vmaf += self.vmaf_offsets.get(ori_fmt.path, 0.0) + self.vmaf_offsets.get((ori_fmt.path, h), 0.0)
+        if frame_scores is not None and ori_fmt.path in self.frame_vmafs:
+            frame_scores["vmaf"] = [dis_fmt.vmaf + d for d in self.frame_vmafs[ori_fmt.path]]
+        dis_fmt.path = "{:d}.{:.2f}.{:s}.mp4".format(h, dis_fmt.crf, preset)
+        return dis_fmt
+
+    def trans_multi_and_get_score(self, ori_fmt, dis_fmts, ref_cache=None, trans_cache=None, preset="veryslow",
+                                  threads=36):
+        return [self.trans_and_get_score(ori_fmt, dis_fmt, preset=preset) for dis_fmt in dis_fmts]
+
+    def encodes(self, preset=sizeopt.FINAL_PRESET):
+        return len([c for c in self.calls if c[2] == preset])
+
+
+class SearchTestCase(unittest.TestCase):
+    """
+    a SearchContext on SOURCE encoding by self.encoder
+    """
+    def setUp(self):
+        self.encoder = _Encoder()
+        for obj, name, value in ((score, "trans_and_get_score", self._trans_and_get_score),
+                                 (score, "trans_multi_and_get_score", self._trans_multi_and_get_score),
+                                 (packets, "get_index", lambda path, stream="v", scan=True: None)):
+            patch(obj, name, value).start(self)
+        self.ctx = sizeopt.SearchContext(SOURCE, cores=4)
+        self.addCleanup(self.ctx.close)
+
+    def _trans_and_get_score(self, *args, **kwargs):
+        return self.encoder.trans_and_get_score(*args, **kwargs)
+
+    def _trans_multi_and_get_score(self, *args, **kwargs):
+        return self.encoder.trans_multi_and_get_score(*args, **kwargs)
+
+    def anchor(self, crf=26):
+        return self.ctx.encode([trans.Format(size=trans.TSize(shorter=1080), crf=crf)])[0]
+
+
+class ProxyTest(SearchTestCase):
+    def test_calibrate(self):
+        proxy = sizeopt.Proxy()
+        self.assertTrue(proxy.calibrate(self.ctx, self.anchor()))
+        self.assertAlmostEqual(proxy.vmaf_offset, 1.0)
+        self.assertAlmostEqual(proxy.br_ratio, 1 / 1.3, places=5)
+
+    def test_calibrate_failed(self):
+        self.encoder.fail = lambda h, crf, preset: preset == sizeopt.PROXY_PRESET
+        proxy = sizeopt.Proxy()
+        self.assertFalse(proxy.calibrate(self.ctx, self.anchor()))
+        self.assertEqual((proxy.vmaf_offset, proxy.br_ratio), (0.0, 1.0))
+
+    def test_search_on_proxy(self):
+        anchor = self.anchor()
+        better = sizeopt.search_better_size(self.ctx, anchor, [trans.TSize(shorter=720)], sizeopt.PROXY_PRESET)
+        self.assertEqual(better.size.h, 720)
+        self.assertLessEqual(abs(better.vmaf - anchor.vmaf), sizeopt.VMAF_TOLERANCE)
+        self.assertLess(better.br, anchor.br)
+        # the probes run on the proxy, the final preset only confirms
+        self.assertEqual(self.encoder.encodes(), 2)
+        self.assertGreaterEqual(self.encoder.encodes(sizeopt.PROXY_PRESET), 3)
+
+
+class ClipSetTest(SearchTestCase):
+    def test_weighted(self):
+        clip_set = [(trans.Format(path="clip0.mkv", size=trans.TSize(1920, 1080)), 0.25),
+                    (trans.Format(path="clip1.mkv", size=trans.TSize(1920, 1080)), 0.75)]
+        self.encoder.vmaf_offsets["clip1.mkv"] = -4.0     # the harder one
+        ctx = sizeopt.SearchContext(SOURCE, clip_set=clip_set)
+        self.addCleanup(ctx.close)
+        point = ctx.encode([trans.Format(size=trans.TSize(shorter=720), crf=26)])[0]
+        vmaf, br = self.encoder.model(720, 26, sizeopt.FINAL_PRESET)
+        self.assertAlmostEqual(point.vmaf, vmaf - 3)
+        self.assertAlmostEqual(point.br, br, delta=1)
+        self.assertEqual(len(self.encoder.calls), 2)
+
+
+    def test_verify(self):
+        ctx = sizeopt.SearchContext(SOURCE, clip_set=[(trans.Format(path="clip.mkv", size=SOURCE.size), 1.0)])
+        self.addCleanup(ctx.close)
+        sizes = [trans.TSize(shorter=h) for h in (900, 720)]
+        # the clip favours 720, which falls short on the whole title
+        self.encoder.vmaf_offsets[(SOURCE.path, 720)] = -3.0
+        anchor = trans.Format(size=trans.TSize(shorter=1080), crf=26)
+        better = sizeopt.search_better_size(ctx, anchor, sizes)
+        self.assertEqual(better.size.wxh(), "1600x900")
+        self.assertEqual(ctx.encodes["verify"], 3)
+
+    def test_verify_failed(self):
+        ctx = sizeopt.SearchContext(SOURCE, clip_set=[(trans.Format(path="clip.mkv", size=SOURCE.size), 1.0)])
+        self.addCleanup(ctx.close)
+        self.encoder.vmaf_offsets[(SOURCE.path, 720)] = -3.0
+        anchor = trans.Format(size=trans.TSize(shorter=1080), crf=26)
+        self.assertIsNone(sizeopt.search_better_size(ctx, anchor, [trans.TSize(shorter=720)]))
+        self.assertEqual(ctx.encodes["verify"], 2)
+
+class _Index:
+    """
+    stands in for packets.PacketIndex with the bit-rate of each second
+    """
+    def __init__(self, bit_rates):
+        self.bit_rates = bit_rates
+
+    def __len__(self):
+        return len(self.bit_rates)
+
+    def bitrate_windows(self, window):
+        return [i * window for i in range(len(self.bit_rates))], self.bit_rates
+
+    def duration(self):
+        return float(len(self.bit_rates))
+
+
+class CutoffTest(SearchTestCase):
+    @staticmethod
+    def report(t, br):
+        return {"out_time_us": str(int(t * 1000000)), "total_size": str(int(br * t / 8)), "progress": "continue"}
+
+    def test_profile(self):
+        profile = sizeopt.Profile(_Index([1e6, 1e6, 3e6, 3e6]))
+        self.assertEqual(profile.duration, 4.0)
+        self.assertAlmostEqual(profile.share(0.5), 0.0625)
+        self.assertAlmostEqual(profile.share(1.0), 0.125)
+        self.assertAlmostEqual(profile.share(2.5), 0.4375)
+        self.assertEqual(profile.share(10), 1.0)
+        self.assertEqual(sizeopt.Profile(_Index([])).share(1.0), 1.0)
+
+    def test_cutoff(self):
+        race = sizeopt.Race(2000000, sizeopt.Profile(_Index([2e6] * 10)))
+        cutoff = race.cutoff()
+        self.assertFalse(cutoff({"out_time_us": "N/A", "total_size": "N/A"}))
+        self.assertFalse(cutoff(self.report(0.5, 10e6)))      # too few of the bits yet
+        self.assertFalse(cutoff(self.report(2, 2.1e6)))       # within the margin
+        self.assertFalse(cutoff.aborted)
+        self.assertTrue(cutoff({"out_time_ms": "2000000", "total_size": str(int(3e6 * 2 / 8))}))
+        self.assertTrue(cutoff.aborted)
+        # the proxy preset spends more bits than the final one
+        self.assertFalse(race.cutoff(br_ratio=0.7)(self.report(2, 3e6)))
+        race.finish(trans.Format(br=1000000))
+        self.assertTrue(race.cutoff()(self.report(2, 2e6)))
+
+    def test_encode(self):
+        anchor = self.anchor()
+        race = sizeopt.Race(anchor.br, sizeopt.Profile(_Index([2e6] * 10)))
+        size = trans.TSize(shorter=1080)
+        point = self.ctx.encode([trans.Format(size=size, crf=22)], cutoff=race.cutoff())[0]
+        self.assertFalse(point.vmaf)
+        self.assertEqual(self.ctx.encodes["aborted"], 1)
+        self.assertEqual([p.crf for p in self.ctx.points(size)], [26])
+        point = self.ctx.encode([trans.Format(size=size, crf=30)], cutoff=race.cutoff())[0]
+        self.assertTrue(point.vmaf)
+        self.assertEqual(sorted(p.crf for p in self.ctx.points(size)), [26, 30])
+
+    def test_search(self):
+        anchor = self.anchor()
+        race = sizeopt.Race(anchor.br, sizeopt.Profile(_Index([2e6] * 10)))
+        race.finish(trans.Format(br=2200000))     # matched by another size
+        size = trans.TSize(shorter=900)
+        self.assertIsNone(sizeopt.search_crf_in_other_size(self.ctx, anchor, size, race=race))
+        self.assertGreater(self.ctx.encodes["aborted"], 0)
+        # the aborted probes are not kept, all the points of the size are below the best bit-rate
+        self.assertTrue(all(p.br < race.br * (1 + sizeopt.BR_MARGIN) for p in self.ctx.points(size)))
+
+
+class PchipTest(unittest.TestCase):
+    def test_through_points(self):
+        xs, ys = [20.0, 22.0, 25.0, 30.0], [98.0, 95.0, 94.5, 80.0]
+        f = sizeopt._pchip(xs, ys)
+        for x, y in zip(xs, ys):
+            self.assertAlmostEqual(f(x), y)
+        self.assertAlmostEqual(sizeopt._pchip([20.0, 30.0], [90.0, 80.0])(24.0), 86.0)
+
+    def test_monotone(self):
+        xs, ys = [20.0, 21.0, 26.0, 27.0, 36.0], [99.0, 98.9, 90.0, 89.9, 60.0]
+        f = sizeopt._pchip(xs, ys)
+        values = [f(20.0 + i * 0.01) for i in range(1601)]
+        self.assertTrue(all(a >= b - 1e-9 for a, b in zip(values, values[1:])))
+        # no overshoot between the points
+        for i in range(len(xs) - 1):
+            inner = [f(xs[i] + (xs[i + 1] - xs[i]) * k / 10.0) for k in range(11)]
+            self.assertTrue(all(ys[i + 1] - 1e-9 <= v <= ys[i] + 1e-9 for v in inner))
+
+
+class SearchCrfTest(SearchTestCase):
+    SIZE = trans.TSize(shorter=720)
+
+    def search(self, target_vmaf, tolerance=sizeopt.VMAF_TOLERANCE):
+        return sizeopt._search_crf(self.ctx, self.SIZE, 26, target_vmaf, -1, sizeopt.FINAL_PRESET, tolerance)
+
+    def test_converge(self):
+        point, slope = self.search(90.0)
+        self.assertLessEqual(abs(point.vmaf - 90.0), sizeopt.VMAF_TOLERANCE)
+        self.assertAlmostEqual(slope, -1 / 1.5)
+        self.assertLessEqual(len(self.encoder.calls), 3)
+        # points of the first search are used by the next one
+        calls = len(self.encoder.calls)
+        point, _ = self.search(87.0)
+        self.assertLessEqual(abs(point.vmaf - 87.0), sizeopt.VMAF_TOLERANCE)
+        self.assertLessEqual(len(self.encoder.calls) - calls, 1)
+
+    def test_out_of_range(self):
+        self.assertEqual(self.search(99.0), (None, None))
+        self.assertEqual(self.encoder.calls[-1][1], sizeopt.CRF_MIN)
+
+    def test_failed_encode(self):
+        self.encoder.fail = lambda h, crf, preset: crf > 28
+        self.assertEqual(self.search(70.0), (None, None))
+        self.assertLessEqual(len(self.encoder.calls), 4)
+        self.assertEqual(self.ctx.encodes["failed"], 1)
+
+    def test_steps(self):
+        # a coarse model never gets within a tiny tolerance
+        model = self.encoder.model
+        self.encoder.model = lambda h, crf, preset: (round(model(h, crf, preset)[0]), model(h, crf, preset)[1])
+        with patch(sizeopt, "MAX_SEARCH_STEPS", 3):
+            self.assertEqual(self.search(90.4, tolerance=0.01), (None, None))
+        self.assertEqual(len(self.encoder.calls), 2 + 3)
+
+
+class RaceTest(unittest.TestCase):
+    def test_lost(self):
+        race = sizeopt.Race(2000000)
+        points = [trans.Format(crf=30, vmaf=80, br=2100000), trans.Format(crf=24, vmaf=90, br=3000000)]
+        self.assertTrue(race.lost(points, 85, 0.5))
+        self.assertFalse(race.lost(points, 75, 0.5))          # above the target, a higher crf may win
+        self.assertFalse(race.lost(points, 85, 0.5, br_ratio=0.9))
+        race.finish(trans.Format(br=2500000))
+        self.assertEqual(race.br, 2000000)
+        race.finish(trans.Format(br=1500000))
+        self.assertEqual(race.br, 1500000)
+        self.assertIsNone(race.cutoff())
+
+
+class BetterSizeTest(SearchTestCase):
+    def test_sizes(self):
+        anchor = trans.Format(size=trans.TSize(shorter=1080), crf=26)
+        sizes = [trans.TSize(shorter=h) for h in (900, 720, 540)]
+        better = sizeopt.search_better_size(self.ctx, anchor, sizes)
+        self.assertEqual(better.size.wxh(), "1280x720")
+        self.assertLessEqual(abs(better.vmaf - anchor.vmaf), sizeopt.VMAF_TOLERANCE)
+        self.assertLess(better.br, anchor.br)
+        self.assertEqual(set(c[0] for c in self.encoder.calls), set([1080, 900, 720, 540]))
+
+    def test_none_better(self):
+        anchor = trans.Format(size=trans.TSize(shorter=1080), crf=26)
+        self.assertIsNone(sizeopt.search_better_size(self.ctx, anchor, [trans.TSize(shorter=540)]))
+
+    def test_concurrent(self):
+        running, most = [0], [0]
+        lock = threading.Lock()
+        trans_and_get_score = self.encoder.trans_and_get_score
+
+        def _slow(*args, **kwargs):
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return trans_and_get_score(*args, **kwargs)
+
+        self.encoder.trans_and_get_score = _slow
+        # room for the encodes of several sizes in the core budget
+        ctx = sizeopt.SearchContext(SOURCE, cores=32)
+        self.addCleanup(ctx.close)
+        anchor = trans.Format(size=trans.TSize(shorter=1080), crf=26)
+        sizeopt.search_better_size(ctx, anchor, [trans.TSize(shorter=h) for h in (900, 720, 540)])
+        self.assertGreater(most[0], 1)
+
+    def test_ref_cache(self):
+        tmp_dir = self.ctx.ref_cache.cache_dir
+        self.assertTrue(os.path.isdir(tmp_dir))
+        self.ctx.close()
+        self.assertFalse(os.path.isdir(tmp_dir))
+        shared = cache.RefYuvCache(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, shared.cache_dir, True)
+        ctx = sizeopt.SearchContext(SOURCE, ref_cache=shared)
+        ctx.close()
+        self.assertTrue(os.path.isdir(shared.cache_dir))
+        # the temporary one keeps to its budget
+        ctx = sizeopt.SearchContext(SOURCE, ref_cache_size="2G")
+        self.addCleanup(ctx.close)
+        self.assertEqual(ctx.ref_cache.max_bytes, 2 << 30)
+
+
+class PrefixTest(SearchTestCase):
+    CLIP = trans.Format(path="prefix.mkv", size=trans.TSize(1920, 1080))
+    SIZE = trans.TSize(shorter=720)
+
+    def setUp(self):
+        SearchTestCase.setUp(self)
+        self.encoder.vmaf_offsets[self.CLIP.path] = -2.0     # the prefix is harder than the whole
+        self.prefix = sizeopt.Prefix(self.CLIP, block_frames=2)
+
+    def test_score(self):
+        vmaf, se = self.prefix._score(self.ctx, self.SIZE, 26, sizeopt.FINAL_PRESET)
+        self.assertAlmostEqual(vmaf, self.encoder.model(720, 26, sizeopt.FINAL_PRESET)[0] - 2)
+        self.assertEqual(se, self.prefix.offset_sd)     # no per-frame scores
+        self.encoder.frame_vmafs[self.CLIP.path] = [1, 1, -1, -1, 1, float("nan"), 1, -1, -1]
+        _, se = self.prefix._score(self.ctx, self.SIZE, 27, sizeopt.FINAL_PRESET)
+        self.assertAlmostEqual(se, (4 / 3.0) ** 0.5 / 2)
+        self.assertEqual(self.ctx.encodes["prefix"], 2)
+        self.assertEqual(self.ctx.points(self.SIZE, sizeopt.FINAL_PRESET), [])
+
+    def test_offset(self):
+        self.assertEqual(self.prefix._offset(), (0.0, 1.0))
+        self.prefix.learn(trans.Format(vmaf=90.0), 88.0)
+        self.prefix.learn(trans.Format(vmaf=0), 88.0)       # failed
+        self.prefix.learn(trans.Format(vmaf=80.0), 77.0)
+        self.assertEqual(self.prefix._offset(), (2.5, 1.0))
+        self.prefix.learn(trans.Format(vmaf=70.0), 68.0)
+        mean, sd = self.prefix._offset()
+        self.assertAlmostEqual(mean, 7 / 3.0)
+        self.assertAlmostEqual(sd, (1 / 3.0) ** 0.5)
+
+    def test_check(self):
+        self.prefix.calibrate(self.ctx, self.anchor())
+        self.assertEqual(self.prefix.offsets, [2.0])
+        vmaf = self.encoder.model(720, 26, sizeopt.FINAL_PRESET)[0]
+        self.assertEqual(self.prefix.check(self.ctx, self.SIZE, 26, vmaf + 1, 0.5, sizeopt.FINAL_PRESET),
+                         (None, vmaf - 2))
+        for target in (vmaf + 5, vmaf - 5):
+            predicted, prefix_vmaf = self.prefix.check(self.ctx, self.SIZE, 26, target, 0.5, sizeopt.FINAL_PRESET)
+            self.assertAlmostEqual(predicted.vmaf, vmaf)
+            self.assertEqual((predicted.size, predicted.crf, prefix_vmaf), (self.SIZE, 26, vmaf - 2))
+
+    def test_prune(self):
+        self.prefix.calibrate(self.ctx, self.anchor())
+        point, _ = sizeopt._search_crf(self.ctx, self.SIZE, 36, 90.0, -1, sizeopt.FINAL_PRESET, 0.5,
+                                       prefix=self.prefix)
+        self.assertLessEqual(abs(point.vmaf - 90.0), 0.5)
+        # the steps far from the target are only scored on the prefix
+        full = sorted(p.crf for p in self.ctx.points(self.SIZE, sizeopt.FINAL_PRESET))
+        self.assertEqual(full, [22.0, 23.0, 35.0, 36.0])
+        self.assertEqual(self.ctx.encodes["prefix"], 1 + 4)
+        self.assertEqual(self.prefix.offsets, [2.0] * 3)    # learned from the points encoded both ways
+
+    def test_search(self):
+        patch(clips, "get_prefix", lambda path, duration, cache_dir=None: self.CLIP).start(self)
+        anchor = trans.Format(size=trans.TSize(shorter=1080), crf=26)
+        better = sizeopt.search_better_size(self.ctx, anchor, [self.SIZE], prefix_time=10)
+        self.assertEqual(better.size.wxh(), "1280x720")
+        self.assertLessEqual(abs(better.vmaf - anchor.vmaf), sizeopt.VMAF_TOLERANCE)
+        # the pruned points are never returned, the best is a point encoded in full
+        self.assertIn(better.crf, [p.crf for p in self.ctx.points(self.SIZE, sizeopt.FINAL_PRESET)])
+        self.assertGreater(self.ctx.encodes["prefix"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
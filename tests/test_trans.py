@@ -0,0 +1,127 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Brief
+    tests of video.trans
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from video import trans
+from tests import patch
+
+
+class YuvSizeTest(unittest.TestCase):
+    def test_frame_bytes(self):
+        self.assertEqual(trans.yuv420p_frame_bytes(1920, 1080), 1920 * 1080 * 3 // 2)
+        self.assertEqual(trans.yuv420p_chroma_size(33, 17), (17, 9))
+        self.assertEqual(trans.yuv420p_frame_bytes(33, 17), 33 * 17 + 2 * 17 * 9)
+
+
+class MultiOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.commands = []
+
+    def _run_command(self, returncode=0, skip=()):
+        """
+        :return: run_command() replacement writing every output not in @skip
+        """
+        def _run(cmdargs, on_progress=None):
+            self.commands.append(cmdargs)
+            for arg in cmdargs:
+                if arg.startswith(self.dir) and os.path.basename(arg) not in skip:
+                    with open(arg, "w") as f:
+                        f.write("x")
+            return returncode
+        return _run
+
+    def _outputs(self, *names):
+        return [("scale=64:36", ["-crf", "23"], os.path.join(self.dir, names[0])),
+                (None, ["-crf", "30"], os.path.join(self.dir, names[1]))]
+
+    def test_one_decoding(self):
+        outputs = self._outputs("a.mp4", "b.mp4")
+        with patch(trans, "run_command", self._run_command()):
+            rets = trans.trans_multi_by_ioparam("in.mp4", ["-y"], outputs)
+        self.assertEqual(rets, [0, 0])
+        self.assertEqual(len(self.commands), 1)
+        command = self.commands[0]
+        self.assertEqual(command.count("-i"), 1)
+        self.assertEqual(command[command.index("-filter_complex") + 1],
+                         "[0:v]split=2[s0][s1];[s0]scale=64:36[o0];[s1]null[o1]")
+        self.assertEqual(command[command.index("[o0]") - 1:command.index("[o1]") - 1],
+                         ["-map", "[o0]", "-map", "0:a?", "-crf", "23", outputs[0][2]])
+        self.assertEqual(command[command.index("[o1]") - 1:], ["-map", "[o1]", "-map", "0:a?", "-crf", "30",
+                                                              outputs[1][2]])
+
+    def test_missing_output(self):
+        outputs = self._outputs("a.mp4", "b.mp4")
+        with patch(trans, "run_command", self._run_command(skip=("b.mp4",))):
+            self.assertEqual(trans.trans_multi_by_ioparam("in.mp4", [], outputs), [0, 1])
+        with patch(trans, "run_command", self._run_command(returncode=2)):
+            self.assertEqual(trans.trans_multi_by_ioparam("in.mp4", [], outputs), [2, 2])
+
+    def test_to_264_multi(self):
+        original = trans.Format(path="in.mp4", size=trans.TSize(1280, 720))
+        with patch(trans, "run_command", self._run_command(skip=("in.mp4.[640x360].[30].mp4",))):
+            paths = trans.to_264_multi(original, [(trans.TSize(854, 480), 23), (trans.TSize(shorter=360), 30)],
+                                       save_dir=self.dir)
+        self.assertEqual(paths, [os.path.join(self.dir, "in.mp4.[854x480].[23].mp4"), None])
+        command = self.commands[0]
+        self.assertIn("[s1]scale=640:360[o1]", command[command.index("-filter_complex") + 1])
+
+
+class ProgressTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        # an ffmpeg writing a progress report every second of a 5s output, then hanging for $HANG seconds
+        self.ffmpeg = os.path.join(self.dir, "ffmpeg")
+        with open(self.ffmpeg, "w") as f:
+            f.write('#!/bin/sh\necho "$@" > "$0.args"\n'
+                    'printf "out_time_us=N/A\\ntotal_size=N/A\\nprogress=continue\\n"\n'
+                    'for t in 1 2 3 4 5; do\n'
+                    '    printf "frame=%d\\nout_time_us=%d000000\\ntotal_size=%d000\\nprogress=continue\\n" '
+                    '$t $t $t\n'
+                    'done\n'
+                    'exec sleep ${HANG:-0}\n')
+        os.chmod(self.ffmpeg, 0o755)
+
+    def test_reports(self):
+        reports = []
+        self.assertEqual(trans.run_command([self.ffmpeg, "-i", "in.mp4", "out.mp4"], reports.append), 0)
+        with open(self.ffmpeg + ".args") as f:
+            self.assertEqual(f.read().split(), ["-progress", "pipe:1", "-i", "in.mp4", "out.mp4"])
+        self.assertEqual(len(reports), 6)
+        self.assertEqual(reports[0]["total_size"], "N/A")
+        self.assertEqual((reports[-1]["frame"], reports[-1]["out_time_us"], reports[-1]["total_size"]),
+                         ("5", "5000000", "5000"))
+
+    def test_abort(self):
+        os.environ["HANG"] = "30"
+        self.addCleanup(os.environ.pop, "HANG")
+        reports = []
+
+        def _on_progress(report):
+            reports.append(report)
+            return report.get("frame") == "2"
+
+        start = time.time()
+        self.assertEqual(trans.run_command([self.ffmpeg, "out.mp4"], _on_progress), trans.ABORTED)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(reports[-1]["frame"], "2")
+
+    def test_to_264_aborted(self):
+        with patch(trans, "run_command", lambda cmdargs, on_progress=None: trans.ABORTED):
+            original = trans.Format(path="in.mp4", size=trans.TSize(1920, 1080))
+            self.assertIsNone(trans.to_264_by_size_crf(original, trans.TSize(shorter=720), 26, save_dir=self.dir,
+                                                       on_progress=lambda report: True))
+
+
+if __name__ == "__main__":
+    unittest.main()
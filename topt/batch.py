@@ -0,0 +1,380 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    sizeopt over a catalog: titles from a manifest or a spool dir are queued in
+    a sqlite job table and run by a pool of workers. every scored point is
+    checkpointed, so a restarted batch goes on where it stopped
+"""
+
+import os
+import sys
+import errno
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+import traceback
+from video import info,trans,cache,clips,proc
+from video.rd import sched
+from topt import sizeopt
+
+module_name = "toptimize.batch"
+log = logging.getLogger(module_name)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def _pid_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM     # alive, owned by another user
+    return True
+
+
+class JobDb:
+    """
+    job table and point checkpoints in a sqlite db, one row per title.
+    every thread of every process opens its own connection, the db is in wal mode
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def __str__(self):
+        return str({"db_path": self.db_path})
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS job (path TEXT PRIMARY KEY, state TEXT, params TEXT, "
+                         "worker TEXT, attempts INTEGER DEFAULT 0, started REAL, finished REAL, "
+                         "result TEXT, error TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS point (path TEXT, w INTEGER, h INTEGER, crf REAL, preset TEXT, "
+                         "br INTEGER, psnr REAL, ssim REAL, vmaf REAL, PRIMARY KEY (path, w, h, crf, preset))")
+            conn.commit()
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def add(self, path, params):
+        """
+        queue @path, titles already in the table are left as they are
+        :return: True if queued
+        """
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute("INSERT OR IGNORE INTO job (path, state, params) VALUES (?, ?, ?)",
+                                  (path, QUEUED, json.dumps(params)))
+        return cursor.rowcount == 1
+
+    def claim(self, worker):
+        """
+        take the oldest queued title for @worker, a unique id of the calling thread
+        :return: (path, params), None if nothing is queued
+        """
+        conn = self._conn()
+        with conn:
+            # one statement, so two workers never take the same row
+            conn.execute("UPDATE job SET state=?, worker=?, attempts=attempts+1, started=? WHERE path="
+                         "(SELECT path FROM job WHERE state=? ORDER BY rowid LIMIT 1)",
+                         (RUNNING, worker, time.time(), QUEUED))
+            row = conn.execute("SELECT path, params FROM job WHERE state=? AND worker=?", (RUNNING, worker)).fetchone()
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def finish(self, path, result):
+        conn = self._conn()
+        with conn:
+            conn.execute("UPDATE job SET state=?, finished=?, result=?, error=NULL WHERE path=?",
+                         (DONE, time.time(), json.dumps(result), path))
+
+    def fail(self, path, error):
+        conn = self._conn()
+        with conn:
+            conn.execute("UPDATE job SET state=?, finished=?, error=? WHERE path=?", (FAILED, time.time(), error, path))
+
+    def requeue_stale(self):
+        """
+        queue again the titles left running by dead workers of this host,
+        workers of other hosts are not known to be dead and keep theirs
+        :return: number of titles queued again
+        """
+        conn = self._conn()
+        stale = []
+        for path, worker in conn.execute("SELECT path, worker FROM job WHERE state=?", (RUNNING,)).fetchall():
+            host, pid, _ = (worker or "::").rsplit(":", 2)
+            if host == socket.gethostname() and not _pid_alive(int(pid or 0)):
+                stale.append(path)
+        with conn:
+            for path in stale:
+                conn.execute("UPDATE job SET state=?, worker=NULL WHERE path=? AND state=?", (QUEUED, path, RUNNING))
+        return len(stale)
+
+    def requeue(self, states):
+        """
+        queue again all the titles in @states, ie. (FAILED,)
+        :return: number of titles queued again
+        """
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute("UPDATE job SET state=?, worker=NULL WHERE state IN ({:s})".format(
+                ",".join("?" * len(states))), (QUEUED,) + tuple(states))
+        return cursor.rowcount
+
+    def save_point(self, path, fmt, preset):
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO point VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (path, fmt.size.w, fmt.size.h, round(float(fmt.crf), 2), preset, int(fmt.br),
+                          float(fmt.psnr), float(fmt.ssim), float(fmt.vmaf)))
+
+    def points(self, path):
+        """
+        :return: [(<trans.Format>, preset), ...] checkpointed for @path
+        """
+        rows = self._conn().execute("SELECT w, h, crf, preset, br, psnr, ssim, vmaf FROM point WHERE path=?",
+                                    (path,)).fetchall()
+        return [(trans.Format(size=trans.TSize(w, h), crf=crf, br=br, psnr=psnr, ssim=ssim, vmaf=vmaf), preset)
+                for w, h, crf, preset, br, psnr, ssim, vmaf in rows]
+
+    def status(self):
+        """
+        :return: {state: number of titles}
+        """
+        return dict(self._conn().execute("SELECT state, COUNT(*) FROM job GROUP BY state").fetchall())
+
+    def query(self, path):
+        """
+        :return: job of @path as a dict with its result and checkpointed point count, None if unknown
+        """
+        conn = self._conn()
+        row = conn.execute("SELECT path, state, params, worker, attempts, started, finished, result, error "
+                           "FROM job WHERE path=?", (path,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(("path", "state", "params", "worker", "attempts", "started", "finished", "result", "error"),
+                       row))
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["points"] = conn.execute("SELECT COUNT(*) FROM point WHERE path=?", (path,)).fetchone()[0]
+        return job
+
+
+def run_title(db, path, params, budget=None):
+    """
+    sizeopt of one title, points checkpointed in @db are not encoded again
+    :param params: {"anchor_size", "anchor_crf", "search_size", and the optional "proxy_preset",
+                    "vmaf_tolerance", "clip_count", "clip_cache_dir", "yuv_cache_dir", "yuv_cache_size",
+                    "trans_cache_dir", "trans_cache_size"}
+    :param budget: <rd.sched.CoreBudget> shared by the workers
+    :return: result <dict>
+    """
+    source_fmt = trans.Format().from_mediainfo(info.Media(path, probe=True, entries=info.STREAM_ENTRIES))
+    clip_count = params.get("clip_count")
+    ctx = sizeopt.SearchContext(source_fmt,
+                                ref_cache=cache.get_ref_yuv_cache(params.get("yuv_cache_dir"),
+                                                                  params.get("yuv_cache_size")),
+                                trans_cache=cache.get_trans_cache(params.get("trans_cache_dir"),
+                                                                  params.get("trans_cache_size")),
+                                clip_set=clips.get_clip_set(path, params.get("clip_cache_dir"), int(clip_count))
+                                if clip_count else None,
+                                budget=budget,
+                                on_point=lambda fmt, preset: db.save_point(path, fmt, preset),
+                                ref_cache_size=params.get("yuv_cache_size") or 0)
+    restored = db.points(path)
+    for fmt, preset in restored:
+        ctx.add_point(fmt, preset)
+    if restored:
+        log.info("{:d} points of {:s} restored".format(len(restored), path))
+
+    anchor = trans.Format(size=trans.TSize().from_string(params["anchor_size"]), crf=params["anchor_crf"])
+    search_size = [trans.TSize().from_string(size) for size in params["search_size"].split(",")]
+    tolerance = float(params.get("vmaf_tolerance") or sizeopt.VMAF_TOLERANCE)
+    try:
+        better = sizeopt.search_better_size(ctx, anchor, search_size, params.get("proxy_preset"), tolerance)
+    finally:
+        ctx.close()
+
+    def _point(fmt):
+        return {"size": fmt.size.wxh(), "crf": fmt.crf, "br": int(fmt.br), "vmaf": fmt.vmaf}
+    return {"anchor": _point(anchor), "better": _point(better) if better is not None else None,
+            "encodes": ctx.encodes, "restored": len(restored)}
+
+
+class Batch:
+    """
+    workers taking titles from a JobDb until it is empty, or until stop() when watching a spool dir
+    """
+    def __init__(self, db, workers=1, cores="auto"):
+        self.db = db
+        self.workers = workers
+        self.budget = sched.CoreBudget(sched.get_cores(cores))
+        self._stop = threading.Event()
+        self._seen = {}         # spool file -> (size, mtime) at the last scan
+
+    def stop(self):
+        self._stop.set()
+
+    def add_manifest(self, manifest, params):
+        """
+        :param manifest: text file, one title per line: a path, or a json object with "path"
+                         and params overriding @params
+        :return: number of titles queued
+        """
+        added = 0
+        with open(manifest, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                job = json.loads(line) if line.startswith("{") else {"path": line}
+                title_params = dict(params)
+                title_params.update({k: v for k, v in job.items() if k != "path"})
+                added += self.db.add(os.path.abspath(job["path"]), title_params)
+        log.info("{:d} titles queued from {:s}".format(added, manifest))
+        return added
+
+    def scan_spool(self, spool_dir, params):
+        """
+        queue the files of @spool_dir that did not change since the last scan, so files
+        still being copied wait for the next one
+        :return: number of titles queued
+        """
+        added = 0
+        for name in sorted(os.listdir(spool_dir)):
+            path = os.path.abspath(os.path.join(spool_dir, name))
+            if name.startswith(".") or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            stamp = (st.st_size, st.st_mtime)
+            if self._seen.get(path) == stamp:
+                added += self.db.add(path, params)
+            self._seen[path] = stamp
+        if added:
+            log.info("{:d} titles queued from {:s}".format(added, spool_dir))
+        return added
+
+    def _work(self, index, wait):
+        worker = "{:s}:{:d}:{:d}".format(socket.gethostname(), os.getpid(), index)
+        done = 0
+        while not self._stop.is_set():
+            job = self.db.claim(worker)
+            if job is None:
+                if not wait:
+                    break
+                self._stop.wait(wait)
+                continue
+            path, params = job
+            log.info("worker {:s} takes {:s}".format(worker, path))
+            try:
+                self.db.finish(path, run_title(self.db, path, params, self.budget))
+                done += 1
+            except Exception as e:
+                log.error("Exception = `%s`", repr(e))
+                self.db.fail(path, traceback.format_exc())
+        return done
+
+    def run(self, spool_dir=None, params=None, interval=10.0):
+        """
+        requeue what a stopped batch left running and work until the queue is empty.
+        with @spool_dir, the dir is scanned every @interval seconds until stop()
+        :return: number of titles done
+        """
+        requeued = self.db.requeue_stale()
+        if requeued:
+            log.info("{:d} interrupted titles queued again".format(requeued))
+        jobs = [proc.submit(self._work, i, interval if spool_dir else None) for i in range(self.workers)]
+        try:
+            while spool_dir is not None and not self._stop.is_set():
+                self.scan_spool(spool_dir, params or {})
+                self._stop.wait(interval)
+        except KeyboardInterrupt:
+            log.warning("interrupted, waiting for the running titles")
+            self.stop()
+        done = sum(proc.gather(jobs))
+        log.info("{:d} titles done, status = {:s}".format(done, str(self.db.status())))
+        return done
+
+
+def _main_parser():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--db", dest="db", help=r"sqlite job db")
+    parser.add_option("-m", "--manifest", dest="manifest", help=r"titles to queue, a path or json object per line")
+    parser.add_option("--spool", dest="spool", help=r"keep queuing the files that arrive in this dir")
+    parser.add_option("--interval", dest="interval", type="float", default=10.0, help=r"spool scan seconds")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=1, help=r"titles run at the same time")
+    parser.add_option("--cores", dest="cores", default="auto", help=r"cores shared by all workers (default auto)")
+    parser.add_option("--retry-failed", dest="retry_failed", action="store_true", help=r"queue failed titles again")
+    parser.add_option("--status", dest="status", action="store_true", help=r"print title counts per state")
+    parser.add_option("--query", dest="query", help=r"print the job and result of this title")
+    parser.add_option("-s", "--anchor-size", dest="anchor_size", help=r"anchor shorter size")
+    parser.add_option("-q", "--anchor-crf", dest="anchor_crf", help=r"anchor crf")
+    parser.add_option("-d", "--search-size", dest="search_size", help=r"candidate shorter size separated by comma")
+    parser.add_option("--proxy-preset", dest="proxy_preset", help=r"search crf with this fast x264 preset")
+    parser.add_option("--vmaf-tolerance", dest="vmaf_tolerance", help=r"see sizeopt")
+    parser.add_option("--clips", dest="clip_count", help=r"search on this many representative clips")
+    parser.add_option("--clip-cache-dir", dest="clip_cache_dir", help=r"keep clip sets of the sources in this dir")
+    parser.add_option("--yuv-cache-dir", dest="yuv_cache_dir", help=r"keep decoded reference yuv in this dir")
+    parser.add_option("--yuv-cache-size", dest="yuv_cache_size", help=r"disk budget of yuv cache (ie. 20G)")
+    parser.add_option("--trans-cache-dir", dest="trans_cache_dir", help=r"reuse transcoded videos kept in this dir")
+    parser.add_option("--trans-cache-size", dest="trans_cache_size", help=r"disk budget of transcode cache (ie. 50G)")
+    parser.add_option("--probe-cache", dest="probe_cache", help=r"sqlite db keeping ffprobe results")
+    return parser
+
+
+def _create_module_log():
+    import logger
+    logger.log2file(module_name + ".log", logging.INFO)
+    logger.log2stdout()
+
+
+if __name__ == "__main__":
+    reload(sys)
+    sys.setdefaultencoding('utf-8')     # <! 中文设置
+    #
+    _create_module_log()
+    parser = _main_parser()
+    (opt, args) = parser.parse_args()
+    db = JobDb(opt.db)
+    if opt.query is not None:
+        print json.dumps(db.query(os.path.abspath(opt.query)), indent=4)
+        sys.exit(0)
+    if opt.status:
+        print json.dumps(db.status(), indent=4)
+        sys.exit(0)
+    if opt.probe_cache is not None:
+        info.set_probe_cache(opt.probe_cache)
+    params = {k: getattr(opt, k) for k in ("anchor_size", "anchor_crf", "search_size", "proxy_preset",
+                                           "vmaf_tolerance", "clip_count", "clip_cache_dir", "yuv_cache_dir",
+                                           "yuv_cache_size", "trans_cache_dir", "trans_cache_size")
+              if getattr(opt, k) is not None}
+    batch = Batch(db, opt.workers, opt.cores)
+    if opt.retry_failed:
+        db.requeue((FAILED,))
+    if opt.manifest is not None:
+        batch.add_manifest(opt.manifest, params)
+    batch.run(opt.spool, params, opt.interval)
+    log.info("done")
@@ -0,0 +1,286 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    per-title encoding ladder: the upper convex hull of (bit-rate, vmaf) over
+    (size, crf), resolved by encoding only where the hull can still move
+"""
+
+import re
+import sys
+import json
+import math
+import time
+import logging
+import threading
+from video import info,trans,cache,proc
+from topt import sizeopt
+
+module_name = "toptimize.ladder"
+log = logging.getLogger(module_name)
+
+SEED_CRFS = 3           # crfs encoded per size before refining
+MIN_CRF_STEP = 0.5      # crf gaps of a size narrower than this are not split
+_GAIN_SAMPLES = 8       # points per crf gap where the possible hull gain is checked
+
+
+def _xy(fmt):
+    # bit-rates of ladder rungs are spaced geometrically, so the hull is taken over log2(br)
+    return math.log(max(1, int(fmt.br)), 2), fmt.vmaf
+
+
+def _cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def upper_hull(points):
+    """
+    :param points: scored points <[trans.Format,...]>
+    :return: points on the upper convex hull of (log2(br), vmaf), by ascending bit-rate and vmaf
+    """
+    hull = []
+    for p in sorted(points, key=lambda p: (_xy(p)[0], -p.vmaf)):
+        if hull and _xy(hull[-1])[0] == _xy(p)[0]:
+            continue    # same bit-rate, the first one has the higher vmaf
+        while len(hull) >= 2 and _cross(_xy(hull[-2]), _xy(hull[-1]), _xy(p)) >= 0:
+            hull.pop()
+        hull.append(p)
+    # the last points may spend more bits for no more vmaf
+    while len(hull) >= 2 and hull[-1].vmaf <= hull[-2].vmaf:
+        hull.pop()
+    return hull
+
+
+def _hull_at(hull, x):
+    """
+    :return: vmaf of @hull at log2(br) @x, linear between the hull points
+    """
+    xys = [_xy(p) for p in hull]
+    if x <= xys[0][0]:
+        return xys[0][1]
+    for (x1, y1), (x2, y2) in zip(xys, xys[1:]):
+        if x <= x2:
+            return y1 + (y2 - y1) * (x - x1) / (x2 - x1)
+    return xys[-1][1]
+
+
+def _line_at(p1, p2, x):
+    (x1, y1), (x2, y2) = _xy(p1), _xy(p2)
+    return y1 + (y2 - y1) * (x - x1) / (x2 - x1) if x2 != x1 else max(y1, y2)
+
+
+def _gap_gain(hull, points, i):
+    """
+    vmaf a new crf between points[i] and points[i + 1] of one size can add above the hull.
+    the rd curve of a size is concave, so between two points it stays under the
+    lines through their outer neighbours
+    :param points: points of one size by ascending bit-rate
+    """
+    a, b = points[i], points[i + 1]
+    xa, xb = _xy(a)[0], _xy(b)[0]
+    if xb <= xa:
+        return 0.0
+    gain = 0.0
+    for k in range(1, _GAIN_SAMPLES):
+        x = xa + (xb - xa) * k / _GAIN_SAMPLES
+        bounds = []
+        if i > 0:
+            bounds.append(_line_at(points[i - 1], a, x))
+        if i + 2 < len(points):
+            bounds.append(_line_at(b, points[i + 2], x))
+        bound = min(bounds) if bounds else max(a.vmaf, b.vmaf) + abs(b.vmaf - a.vmaf)
+        gain = max(gain, bound - _hull_at(hull, x))
+    return gain
+
+
+class Ladder:
+    """
+    encodes (size, crf) points where the hull can still move by more than the tolerance,
+    the hull is updated as the encodes of each size come back
+    """
+    def __init__(self, ctx, sizes, crf_range=(sizeopt.CRF_MIN, sizeopt.CRF_MAX), tolerance=sizeopt.VMAF_TOLERANCE,
+                 max_encodes=60, preset=sizeopt.FINAL_PRESET):
+        """
+        :param ctx: <sizeopt.SearchContext>, its encodes, caches and core budget are used
+        :param sizes: candidate sizes <[trans.TSize,...]>
+        :param crf_range: (lowest, highest) crf
+        :param tolerance: the hull is resolved when no crf gap can add more vmaf than this
+        :param max_encodes: stop refining after this many encodes
+        """
+        self.ctx = ctx
+        self.sizes = sizes
+        self.crf_range = crf_range
+        self.tolerance = tolerance
+        self.max_encodes = max_encodes
+        self.preset = preset
+        self.hull = []
+        self._lock = threading.Lock()
+
+    def _add(self, fmts):
+        with self._lock:
+            # points under the hull never come back to it, the hull points are all to keep
+            self.hull = upper_hull(self.hull + [fmt for fmt in fmts if fmt.vmaf and fmt.br])
+
+    def _encode(self, batches):
+        """
+        :param batches: {size index: [crf, ...]}, each size is encoded with one decoding
+        """
+        def _run(size, crfs):
+            self._add(self.ctx.encode([trans.Format(size=size, crf=crf) for crf in crfs], self.preset))
+
+        jobs = [proc.submit(_run, self.sizes[i], crfs) for i, crfs in batches.items()]
+        proc.gather(jobs)
+
+    def _candidates(self):
+        """
+        :return: [(gain, size index, crf), ...] with the largest gain first
+        """
+        candidates = []
+        if not self.hull:
+            return candidates   # nothing scored
+        for i, size in enumerate(self.sizes):
+            points = sorted([p for p in self.ctx.points(size, self.preset) if p.vmaf and p.br],
+                            key=lambda p: int(p.br))
+            for k in range(len(points) - 1):
+                if abs(points[k + 1].crf - points[k].crf) < MIN_CRF_STEP:
+                    continue
+                gain = _gap_gain(self.hull, points, k)
+                if gain > self.tolerance:
+                    candidates.append((gain, i, round((points[k].crf + points[k + 1].crf) / 2, 2)))
+        return sorted(candidates, reverse=True)
+
+    def build(self):
+        """
+        :return: hull points <[trans.Format,...]> by ascending bit-rate
+        """
+        lo, hi = self.crf_range
+        seeds = [lo + (hi - lo) * k / float(SEED_CRFS - 1) for k in range(SEED_CRFS)]
+        self._encode({i: seeds for i in range(len(self.sizes))})
+        encodes = len(seeds) * len(self.sizes)
+        rounds = 0
+        while encodes < self.max_encodes:
+            candidates = self._candidates()
+            if not candidates:
+                break
+            # the best gap of every size in a round, so the sizes are encoded at the same time
+            batches = {}
+            for gain, i, crf in candidates[:self.max_encodes - encodes]:
+                if i not in batches:
+                    batches[i] = [crf]
+            self._encode(batches)
+            encodes += len(batches)
+            rounds += 1
+            log.info("round {:d}: {:d} encodes, {:d} hull points, max gain {:.2f}".format(
+                rounds, encodes, len(self.hull), candidates[0][0]))
+        if encodes >= self.max_encodes:
+            log.warning("hull not resolved within {:d} encodes".format(self.max_encodes))
+        log.info("hull of {:d} points in {:d} encodes, grid would be {:d}".format(
+            len(self.hull), encodes, len(self.sizes) * int((hi - lo) / MIN_CRF_STEP + 1)))
+        return self.hull
+
+    def rungs(self, bit_rates=None, vmafs=None):
+        """
+        hull points for the ladder rungs
+        :param bit_rates: for each, the hull point of the highest vmaf not above it
+        :param vmafs: for each, the hull point of the lowest bit-rate reaching it
+        :return: [{"size", "crf", "br", "vmaf", "target"}, ...], rungs with no such point are left out
+        """
+        rungs = []
+        for target in bit_rates or []:
+            fits = [p for p in self.hull if int(p.br) <= target]
+            if fits:
+                rungs.append((fits[-1], "br<={:d}".format(int(target))))
+        for target in vmafs or []:
+            fits = [p for p in self.hull if p.vmaf >= target]
+            if fits:
+                rungs.append((fits[0], "vmaf>={:g}".format(target)))
+        return [{"size": p.size.wxh(), "crf": p.crf, "br": int(p.br), "vmaf": p.vmaf, "target": target}
+                for p, target in rungs]
+
+
+def parse_bit_rate(bit_rate):
+    """
+    :param bit_rate: bits/s, with k/M suffix like "1500k"
+    :return: bits/s <int>
+    """
+    bit_rate = bit_rate.strip().lower()
+    units = {"k": 1000, "m": 1000000}
+    if bit_rate[-1] in units:
+        return int(float(bit_rate[:-1]) * units[bit_rate[-1]])
+    return int(bit_rate)
+
+
+def ladder_test(path, sizes, bit_rates=None, vmafs=None, tolerance=None, max_encodes=None, yuv_cache_dir=None,
+                yuv_cache_size=None, trans_cache_dir=None, trans_cache_size=None, probe_cache=None, cores=None):
+    if probe_cache is not None:
+        info.set_probe_cache(probe_cache)
+    source_fmt = trans.Format().from_mediainfo(info.Media(path, probe=True))
+    ctx = sizeopt.SearchContext(source_fmt,
+                                ref_cache=cache.get_ref_yuv_cache(yuv_cache_dir, yuv_cache_size),
+                                trans_cache=cache.get_trans_cache(trans_cache_dir, trans_cache_size),
+                                cores=cores or "auto",
+                                ref_cache_size=yuv_cache_size or 0)
+    ladder = Ladder(ctx, [trans.TSize(*re.split(r"[x:]", size)) for size in sizes.split(",")],
+                    tolerance=float(tolerance) if tolerance is not None else sizeopt.VMAF_TOLERANCE,
+                    max_encodes=int(max_encodes) if max_encodes is not None else 60)
+    try:
+        ladder.build()
+    finally:
+        ctx.close()
+    return ladder.rungs([parse_bit_rate(br) for br in bit_rates.split(",")] if bit_rates else None,
+                        [float(vmaf) for vmaf in vmafs.split(",")] if vmafs else None)
+
+
+def _main_parser():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("-i", "--input", dest="input", help=r"input video path")
+    parser.add_option("-d", "--sizes", dest="sizes", help=r"candidate sizes wxh separated by comma")
+    parser.add_option("-b", "--bit-rates", dest="bit_rates", help=r"rung bit-rates separated by comma (ie. 800k,2M)")
+    parser.add_option("-m", "--vmafs", dest="vmafs", help=r"rung vmaf levels separated by comma")
+    parser.add_option("--tolerance", dest="tolerance", help=r"vmaf the hull may still move by when done (default 0.5)")
+    parser.add_option("--max-encodes", dest="max_encodes", help=r"encodes allowed for the hull (default 60)")
+    parser.add_option("--yuv-cache-dir", dest="yuv_cache_dir", help=r"keep decoded reference yuv in this dir")
+    parser.add_option("--yuv-cache-size", dest="yuv_cache_size", help=r"disk budget of yuv cache (ie. 20G)")
+    parser.add_option("--trans-cache-dir", dest="trans_cache_dir", help=r"reuse transcoded videos kept in this dir")
+    parser.add_option("--trans-cache-size", dest="trans_cache_size", help=r"disk budget of transcode cache (ie. 50G)")
+    parser.add_option("--probe-cache", dest="probe_cache", help=r"sqlite db keeping ffprobe results")
+    parser.add_option("--cores", dest="cores", help=r"cores shared by the encodes (default auto)")
+    return parser
+
+
+def _create_module_log():
+    import logger
+    logger.log2file(module_name + ".log", logging.DEBUG)
+    logger.log2stdout()
+
+
+if __name__ == "__main__":
+    reload(sys)
+    sys.setdefaultencoding('utf-8')     # <! 中文设置
+    timestr = time.strftime('%y%m%d_%H%M', time.localtime(time.time()))
+    #
+    _create_module_log()
+    parser = _main_parser()
+    (opt, args) = parser.parse_args()
+    rungs = ladder_test(opt.input, opt.sizes, opt.bit_rates, opt.vmafs, opt.tolerance, opt.max_encodes,
+                        opt.yuv_cache_dir, opt.yuv_cache_size, opt.trans_cache_dir, opt.trans_cache_size,
+                        opt.probe_cache, opt.cores)
+    print json.dumps(rungs, indent=4)
+    log.info("done")
@@ -21,34 +21,557 @@ Brief
     choose the best encoding size
 """
 
+import bisect
 import logging
+import shutil
 import sys
+import threading
 import time
-from video import info,trans,score
+from video import info,trans,score,cache,clips,packets,proc
+from video.rd import sched
 
 module_name = "toptimize"
 log = logging.getLogger(module_name)
 
 
-# class CSizeOpt:
-#     def __init__(self):
-#         self.original = trans.Format()
-#         self.anchor = trans.Format()
-#         self.better = trans.Format()
-#         self.b_use_better = False
-#         self.search_size = []
-#
-#     def get_anchor_rd(self):
-#         pass
+FINAL_PRESET = "veryslow"
+PROXY_PRESET = "veryfast"
+VMAF_TOLERANCE = 0.5
+CRF_MIN = 20
+CRF_MAX = 36
+CRF_MAX_STEP = 4.0      # crf step while bracketing
+CRF_RESOLUTION = 0.1    # brackets narrower than this are not split further
+MAX_SEARCH_STEPS = 24   # probes of one crf search before it is given up
+BR_MARGIN = 0.1         # an encode is stopped once projected this much above the best bit-rate
+CUTOFF_SHARE = 0.1      # share of the original's bits encoded before the projection is trusted
 
 
-def search_crf_in_other_size(original, anchor, size):
+class SearchContext:
+    """
+    what the searches on one original video share: caches, encoding mode, encode counts
+    and every point scored so far
+    """
+    def __init__(self, original, ref_cache=None, trans_cache=None, chunks=None, clip_set=None, cores="auto",
+                 budget=None, on_point=None, ref_cache_size=0):
+        """
+        :param original: original video <trans.Format>
+        :param ref_cache: <cache.RefYuvCache> shared by all the encodes of @original, a temporary one
+                          removed by close() if None. concurrent encodes must not decode the
+                          reference each to the same yuv file
+        :param trans_cache: <cache.TransCache> reusing encodes of earlier searches
+        :param chunks: encode long inputs in parallel chunks, see chunk.trans_chunked()
+        :param clip_set: search on these clips instead of @original, see clips.get_clip_set()
+        :param cores: core budget shared by concurrent encodes, see rd.sched.get_cores()
+        :param budget: <rd.sched.CoreBudget> shared with other contexts, a new one of @cores if None
+        :param on_point: on_point(fmt, preset) called for every newly scored point, ie. to checkpoint it
+        :param ref_cache_size: disk budget of the temporary @ref_cache (ie. "20G"), references of the
+                               clips not in use are evicted beyond it. 0 for no limit
+        """
+        self.original = original
+        self._tmp_dir = None
+        if ref_cache is None:
+            ref_cache = cache.make_temp_ref_yuv_cache(max_bytes=ref_cache_size)
+            self._tmp_dir = ref_cache.cache_dir
+        self.ref_cache = ref_cache
+        self.trans_cache = trans_cache
+        self.chunks = chunks
+        self.clip_set = clip_set
+        self.cores = sched.get_cores(cores)
+        self.budget = budget or sched.CoreBudget(self.cores)
+        self.on_point = on_point
+        self.encodes = {}       # preset -> number of encodes
+        self.size_encodes = {}  # wxh -> number of encodes
+        self._points = {}       # (w, h, crf, preset) -> scored <trans.Format>
+        self._profile = False   # <Profile> of the original once read
+        self._lock = threading.Lock()
+
+    def close(self):
+        """
+        remove the temporary reference yuv cache, if any
+        """
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def _key(self, size, crf, preset):
+        size = trans.TSize(size.w, size.h, size.shorter).shorter2wxh(self.original.size)
+        return size.w, size.h, round(float(crf), 2), preset
+
+    def points(self, size, preset=FINAL_PRESET):
+        """
+        :return: points of @size scored with @preset so far, sorted by crf <[trans.Format,...]>
+        """
+        key = self._key(size, 0, preset)
+        with self._lock:
+            points = [p for k, p in self._points.items() if (k[0], k[1], k[3]) == (key[0], key[1], key[3])]
+        return sorted(points, key=lambda p: p.crf)
+
+    def add_point(self, fmt, preset=FINAL_PRESET):
+        """
+        take @fmt as scored with @preset, ie. restored from a checkpoint
+        """
+        with self._lock:
+            self._points[self._key(fmt.size, fmt.crf, preset)] = fmt
+
+    def encodes_of(self, size):
+        key = self._key(size, 0, None)
+        return self.size_encodes.get("{:d}x{:d}".format(key[0], key[1]), 0)
+
+    def profile(self):
+        """
+        :return: <Profile> of the original for projecting encodes, None if the encodes are
+                 not of the whole original in one piece or its packets can't be read
+        """
+        with self._lock:
+            if self._profile is False:
+                index = None
+                if not self.clip_set and self.chunks is None:
+                    index = packets.get_index(self.original.path)
+                self._profile = Profile(index) if index is not None and len(index) else None
+            return self._profile
+
+    def _encode_on(self, original, fmts, preset, frame_scores=None, cutoff=None):
+        # the encode threads that still pay off at this height, taken from the shared budget
+        height = max(self._key(fmt.size, 0, preset)[1] for fmt in fmts)
+        threads = self.budget.acquire(sched.useful_threads(height, self.cores))
+        try:
+            if self.chunks is not None or len(fmts) == 1:
+                for fmt in fmts:
+                    score.trans_and_get_score(original, fmt, self.ref_cache, self.trans_cache, self.chunks, preset,
+                                              threads=threads, frame_scores=frame_scores, on_progress=cutoff)
+            else:
+                score.trans_multi_and_get_score(original, fmts, self.ref_cache, self.trans_cache, preset,
+                                                threads=threads)
+        finally:
+            self.budget.release(threads)
+        return fmts
+
+    def encode(self, fmts, preset=FINAL_PRESET, cutoff=None):
+        """
+        encode and score @fmts <[trans.Format,...]> with their size and crf,
+        several points are encoded with one decoding of the original.
+        points scored before in this context are copied, not encoded again.
+        with a clip set, scores and bit-rate are the weighted means over the clips
+        :param cutoff: <Cutoff> stopping the encode of a single point of the whole original,
+                       an aborted point is left unscored and not kept
+        failed points are not kept either, their vmaf stays 0
+        """
+        todo, keys = [], []
+        with self._lock:
+            for fmt in fmts:
+                key = self._key(fmt.size, fmt.crf, preset)
+                if key not in self._points and key not in keys:
+                    todo.append(fmt)
+                    keys.append(key)
+            self.encodes[preset] = self.encodes.get(preset, 0) + len(todo)
+            for key in keys:
+                wxh = "{:d}x{:d}".format(key[0], key[1])
+                self.size_encodes[wxh] = self.size_encodes.get(wxh, 0) + 1
+        if todo:
+            self._encode(todo, preset, cutoff)
+            if cutoff is not None and cutoff.aborted:
+                with self._lock:
+                    self.encodes["aborted"] = self.encodes.get("aborted", 0) + 1
+                return fmts
+            scored = [(key, fmt) for key, fmt in zip(keys, todo) if fmt.vmaf]
+            with self._lock:
+                self._points.update(scored)
+                if len(scored) < len(todo):
+                    self.encodes["failed"] = self.encodes.get("failed", 0) + len(todo) - len(scored)
+            if self.on_point is not None:
+                for _, fmt in scored:
+                    self.on_point(fmt, preset)
+        for fmt in fmts:
+            with self._lock:
+                known = self._points.get(self._key(fmt.size, fmt.crf, preset))
+            if known is not None and known is not fmt:
+                fmt.path, fmt.psnr, fmt.ssim, fmt.vmaf, fmt.br = known.path, known.psnr, known.ssim, known.vmaf, known.br
+        return fmts
+
+    def _encode(self, fmts, preset, cutoff=None):
+        if not self.clip_set:
+            return self._encode_on(self.original, fmts, preset, cutoff=cutoff if len(fmts) == 1 else None)
+        for fmt in fmts:
+            fmt.psnr, fmt.ssim, fmt.vmaf, fmt.br = 0.0, 0.0, 0.0, 0
+        for clip, weight in self.clip_set:
+            points = self._encode_on(clip, [trans.Format(size=fmt.size, crf=fmt.crf) for fmt in fmts], preset)
+            for fmt, point in zip(fmts, points):
+                fmt.psnr += weight * point.psnr
+                fmt.ssim += weight * point.ssim
+                fmt.vmaf += weight * point.vmaf
+                fmt.br += int(weight * point.br)
+        return fmts
+
+    def encode_other(self, original, fmt, preset, frame_scores=None, counter="prefix"):
+        """
+        encode and score @fmt on another @original, ie. a part of it, not kept as a point
+        :param frame_scores: <dict> filled with per-frame scores
+        :param counter: key of ctx.encodes this encode is counted in
+        """
+        with self._lock:
+            self.encodes[counter] = self.encodes.get(counter, 0) + 1
+        return self._encode_on(original, [fmt], preset, frame_scores)[0]
+
+    def verify(self, fmts):
+        """
+        encode @fmts on the whole original with the final preset
+        :return: new <[trans.Format,...]> of the same size and crf
+        """
+        with self._lock:
+            self.encodes["verify"] = self.encodes.get("verify", 0) + len(fmts)
+        return self._encode_on(self.original, [trans.Format(size=fmt.size, crf=fmt.crf) for fmt in fmts],
+                               FINAL_PRESET)
+
+
+class Proxy:
+    """
+    per-title correction between a fast proxy preset and the final preset,
+    measured on the anchor point
+    """
+    def __init__(self, preset=PROXY_PRESET):
+        self.preset = preset
+        self.vmaf_offset = 0.0      # final vmaf - proxy vmaf at the same crf
+        self.br_ratio = 1.0         # final br / proxy br at the same crf
+
+    def __str__(self):
+        return str(self.__dict__)
+
+    def calibrate(self, ctx, anchor):
+        """
+        :param anchor: anchor already encoded with the final preset <trans.Format>
+        """
+        proxy = ctx.encode([trans.Format(size=anchor.size, crf=anchor.crf)], self.preset)[0]
+        if proxy.vmaf == 0 or proxy.br == 0:
+            log.error("proxy encoding of the anchor failed")
+            return False
+        self.vmaf_offset = anchor.vmaf - proxy.vmaf
+        self.br_ratio = float(anchor.br) / proxy.br
+        log.info("proxy = " + str(self))
+        return True
+
+
+class Prefix:
+    """
+    a probe point is first encoded and scored on the first seconds of the original.
+    full vmaf is predicted as prefix vmaf + offset, the offset learned from points
+    scored both ways (the anchor first). points predicted far enough from the
+    target are not encoded in full, they only bound the crf search.
+    """
+    def __init__(self, clip, z=2.0, block_frames=25, offset_sd=1.0):
+        """
+        :param clip: first seconds of the original <trans.Format>, see clips.get_prefix()
+        :param z: a point is pruned when it is more than @z sigmas + tolerance away from the target
+        :param block_frames: per-frame vmaf is averaged in blocks of this many frames before its
+                             spread is taken, neighbouring frames are far from independent
+        :param offset_sd: sigma of the offset until three points give a measured one
+        """
+        self.clip = clip
+        self.z = z
+        self.block_frames = block_frames
+        self.offset_sd = offset_sd
+        self.offsets = []           # full vmaf - prefix vmaf of points scored both ways
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return str({"clip": self.clip.path, "z": self.z, "offsets": self.offsets})
+
+    def _score(self, ctx, size, crf, preset):
+        """
+        :return: (prefix vmaf, its standard error)
+        """
+        frame_scores = {}
+        fmt = ctx.encode_other(self.clip, trans.Format(size=size, crf=crf), preset, frame_scores)
+        frames = [v for v in frame_scores.get("vmaf", []) if v == v]     # no nan
+        blocks = [frames[i:i + self.block_frames] for i in range(0, len(frames), self.block_frames)]
+        means = [sum(b) / len(b) for b in blocks if len(b) * 2 >= self.block_frames]
+        if len(means) < 2:
+            return fmt.vmaf, self.offset_sd     # no per-frame scores, assume the offset spread
+        mean = sum(means) / len(means)
+        sd = (sum((m - mean) ** 2 for m in means) / (len(means) - 1)) ** 0.5
+        return fmt.vmaf, sd / len(means) ** 0.5
+
+    def _offset(self):
+        with self._lock:
+            offsets = list(self.offsets)
+        if not offsets:
+            return 0.0, self.offset_sd
+        mean = sum(offsets) / len(offsets)
+        if len(offsets) < 3:
+            return mean, self.offset_sd     # too few to trust their spread
+        return mean, (sum((o - mean) ** 2 for o in offsets) / (len(offsets) - 1)) ** 0.5
+
+    def learn(self, full, prefix_vmaf):
+        """
+        :param full: point scored in full <trans.Format>
+        :param prefix_vmaf: its prefix vmaf
+        """
+        if full.vmaf and prefix_vmaf:
+            with self._lock:
+                self.offsets.append(full.vmaf - prefix_vmaf)
+
+    def calibrate(self, ctx, anchor):
+        """
+        :param anchor: anchor already encoded in full with the final preset <trans.Format>
+        """
+        self.learn(anchor, self._score(ctx, anchor.size, anchor.crf, FINAL_PRESET)[0])
+        log.info("prefix = " + str(self))
+
+    def check(self, ctx, size, crf, target_vmaf, tolerance, preset):
+        """
+        :return: (predicted point <trans.Format> if the point is pruned else None, prefix vmaf)
+        """
+        prefix_vmaf, se = self._score(ctx, size, crf, preset)
+        offset, offset_sd = self._offset()
+        predicted = prefix_vmaf + offset
+        sigma = (se ** 2 + offset_sd ** 2) ** 0.5
+        distance = abs(predicted - target_vmaf) - tolerance
+        prune = prefix_vmaf > 0 and distance > self.z * sigma
+        log.info("prefix @{:s} crf={:.2f}: vmaf={:.3f} predicted={:.3f} target={:.3f} sigma={:.3f} "
+                 "(se={:.3f} offset_sd={:.3f}) confidence={:.2f}z -> {:s}".format(
+                     size.wxh(), crf, prefix_vmaf, predicted, target_vmaf, sigma, se, offset_sd,
+                     distance / sigma if sigma > 0 else float("inf"),
+                     ("prune " + ("above" if predicted > target_vmaf else "below")) if prune else "full"))
+        if not prune:
+            return None, prefix_vmaf
+        return trans.Format(size=size, crf=crf, vmaf=predicted), prefix_vmaf
+
+
+class Profile:
+    """
+    how the bits of the original are spread over its time, from its packet index.
+    encodes spend their bits about where the original does, so the share of the
+    original's bits up to a time projects the final size of a running encode
+    """
+    def __init__(self, index, window=1.0):
+        """
+        :param index: <packets.PacketIndex> of the original's video
+        """
+        _, bit_rates = index.bitrate_windows(window)
+        self.window = window
+        self.duration = index.duration()
+        self.bits = []      # bits up to the end of each window
+        total = 0.0
+        for bit_rate in bit_rates:
+            total += bit_rate * window
+            self.bits.append(total)
+
+    def share(self, t):
+        """
+        :return: share of the original's bits before @t seconds
+        """
+        i = int(t / self.window)
+        if not self.bits or self.bits[-1] <= 0 or i >= len(self.bits):
+            return 1.0
+        before = self.bits[i - 1] if i > 0 else 0.0
+        return (before + (self.bits[i] - before) * (t / self.window - i)) / self.bits[-1]
+
+
+class Cutoff:
+    """
+    ffmpeg progress callback of one encode, see trans.run_command(): stops it once its
+    projected bit-rate can't get below the best of the race by BR_MARGIN
+    """
+    def __init__(self, race, profile, br_ratio=1.0):
+        """
+        :param br_ratio: scale of the bit-rate of this encode to the final one, see Proxy
+        """
+        self.race = race
+        self.profile = profile
+        self.br_ratio = br_ratio
+        self.aborted = False
+
+    def __call__(self, report):
+        try:
+            # out_time_ms is in microseconds as well, ffmpeg before 4.1 has only that one
+            t = int(report.get("out_time_us", report.get("out_time_ms"))) / 1e6
+            size = int(report["total_size"])
+        except (TypeError, ValueError, KeyError):
+            return False    # N/A before the first packet
+        share = self.profile.share(t)
+        if share < CUTOFF_SHARE or self.profile.duration <= 0:
+            return False
+        projected = size * 8 / share / self.profile.duration * self.br_ratio
+        limit = self.race.br * (1 + BR_MARGIN)
+        if projected <= limit:
+            return False
+        self.aborted = True
+        log.info("abort encode @{:.1f}s, {:.0%} of the bits: projected br {:.0f} > {:.0f}".format(
+            t, share, projected, limit))
+        return True
+
+
+class Race:
+    """
+    lowest bit-rate matched so far by concurrent size searches, a search
+    that can no longer go below it gives up
+    """
+    def __init__(self, br, profile=None):
+        """
+        :param profile: <Profile> of the original, encodes projected above the best are stopped. None not to
+        """
+        self.br = int(br)
+        self.profile = profile
+        self._lock = threading.Lock()
+
+    def cutoff(self, br_ratio=1.0):
+        """
+        :return: new <Cutoff> for one encode, None without a profile
+        """
+        return Cutoff(self, self.profile, br_ratio) if self.profile is not None else None
+
+    def finish(self, fmt):
+        with self._lock:
+            self.br = min(self.br, int(fmt.br))
+
+    def lost(self, points, target_vmaf, tolerance, br_ratio=1.0):
+        """
+        a point under the target vmaf already has as many bits as the best, so the
+        lower crf matching the target would have more
+        :param br_ratio: scale of the bit-rate of @points to the final one, see Proxy
+        """
+        return any(p.vmaf and p.vmaf <= target_vmaf - tolerance and int(p.br) * br_ratio >= self.br
+                   for p in points)
+
+
+def _pchip(xs, ys):
+    """
+    monotone piecewise cubic hermite interpolation (fritsch-carlson), no overshoot between points
+    :param xs: ascending x values, at least 2
+    :return: f(x) passing through (@xs, @ys)
+    """
+    n = len(xs)
+    h = [float(xs[i + 1] - xs[i]) for i in range(n - 1)]
+    d = [(ys[i + 1] - ys[i]) / h[i] for i in range(n - 1)]
+    m = [d[0]] * n if n == 2 else [0.0] * n
+    if n > 2:
+        for i in range(1, n - 1):
+            if d[i - 1] * d[i] > 0:
+                w1, w2 = 2 * h[i] + h[i - 1], h[i] + 2 * h[i - 1]
+                m[i] = (w1 + w2) / (w1 / d[i - 1] + w2 / d[i])
+
+        def _end(h0, h1, d0, d1):
+            m0 = ((2 * h0 + h1) * d0 - h0 * d1) / (h0 + h1)
+            if m0 * d0 <= 0:
+                return 0.0
+            if d0 * d1 < 0 and abs(m0) > 3 * abs(d0):
+                return 3 * d0
+            return m0
+        m[0] = _end(h[0], h[1], d[0], d[1])
+        m[-1] = _end(h[-1], h[-2], d[-1], d[-2])
+
+    def f(x):
+        i = max(0, min(n - 2, bisect.bisect_right(xs, x) - 1))
+        t = (x - xs[i]) / h[i]
+        return ((2 * t ** 3 - 3 * t ** 2 + 1) * ys[i] + (t ** 3 - 2 * t ** 2 + t) * h[i] * m[i] +
+                (-2 * t ** 3 + 3 * t ** 2) * ys[i + 1] + (t ** 3 - t ** 2) * h[i] * m[i + 1])
+    return f
+
+
+def _slope_at(points, crf):
+    """
+    :return: d(crf)/d(vmaf) between the two points nearest to @crf, None if flat
+    """
+    p1, p2 = sorted(points, key=lambda p: abs(p.crf - crf))[:2]
+    return (p1.crf - p2.crf) / (p1.vmaf - p2.vmaf) if p1.vmaf != p2.vmaf else None
+
+
+def _search_crf(ctx, size, crf, target_vmaf, crf_delta, preset, tolerance, give_up=None, prefix=None,
+                watch=None):
+    """
+    find the crf of @size scoring @target_vmaf, vmaf falling with crf:
+    step out from the points known so far by their secant until the target is bracketed,
+    then take the root of a monotone (pchip) fit of all the points of @size, falling back
+    to bisection whenever that does not halve the bracket. every point of @size scored
+    before in @ctx is used, so later searches of the same size get cheaper
+    :param crf: start crf, with @crf + @crf_delta as the second point
+    :param tolerance: stop once a point is within this vmaf of @target_vmaf
+    :param give_up: give_up(points) is asked before each encode, the search stops if True
+    :param prefix: <Prefix>, probe points are checked on it before they are encoded in full.
+                   pruned ones bound the bracket with their predicted vmaf, they are never returned
+    :param watch: watch() -> <Cutoff> or None, for each probe encode. an aborted probe has more bits than
+                  the best already, so only higher crfs are searched
+    :return: (point closest to @target_vmaf <trans.Format>, d(crf)/d(vmaf) there),
+             (None, None) if the target is out of [CRF_MIN, CRF_MAX], an encode failed
+             or the search gave up
+    """
+    if len(ctx.points(size, preset)) < 2:
+        # the first two points are always needed, encode them with one decoding
+        ctx.encode([trans.Format(size=size, crf=crf), trans.Format(size=size, crf=crf + crf_delta)], preset)
+    width = None
+    pruned = []
+    for _ in range(MAX_SEARCH_STEPS):
+        points = [p for p in ctx.points(size, preset) if p.vmaf]
+        if len(points) < 2:
+            log.error("no scores @" + str(size))
+            return None, None
+        best = min(points, key=lambda p: abs(p.vmaf - target_vmaf))
+        slope = _slope_at(points, best.crf)
+        if abs(best.vmaf - target_vmaf) <= tolerance:
+            return best, slope
+        if give_up is not None and give_up(points):
+            log.info("search @" + size.wxh() + " can't win, give up")
+            return None, None
+        marks = sorted(points + pruned, key=lambda p: p.crf)
+        above = [p for p in marks if p.vmaf >= target_vmaf]
+        below = [p for p in marks if p.vmaf < target_vmaf]
+        lo = max(above, key=lambda p: p.crf) if above else None
+        higher = [p for p in below if lo is None or p.crf > lo.crf]
+        hi = min(higher, key=lambda p: p.crf) if higher else None
+
+        if lo is None or hi is None:
+            # not bracketed, step out from the point on the side of the target
+            edge = marks[-1] if lo is not None else marks[0]
+            step = abs(slope * (target_vmaf - edge.vmaf)) if slope is not None else 1.0
+            step = min(CRF_MAX_STEP, max(1.0, step))
+            next_crf = edge.crf + step if lo is not None else edge.crf - step
+            next_crf = min(CRF_MAX, max(CRF_MIN, round(next_crf, 2)))
+            if next_crf == edge.crf:
+                return None, None
+        else:
+            if hi.crf - lo.crf <= CRF_RESOLUTION:
+                return best, slope
+            f = _pchip([p.crf for p in points], [p.vmaf for p in points])
+            a, b = lo.crf, hi.crf
+            for _ in range(40):
+                mid = (a + b) / 2
+                a, b = (mid, b) if f(mid) >= target_vmaf else (a, mid)
+            next_crf = (a + b) / 2
+            if width is not None and hi.crf - lo.crf > width / 2:
+                next_crf = (lo.crf + hi.crf) / 2     # the fit is not converging, bisect
+            width = hi.crf - lo.crf
+            next_crf = min(hi.crf - CRF_RESOLUTION / 2, max(lo.crf + CRF_RESOLUTION / 2, round(next_crf, 2)))
+        prefix_vmaf = None
+        if prefix is not None and all(p.crf != next_crf for p in marks):
+            predicted, prefix_vmaf = prefix.check(ctx, size, next_crf, target_vmaf, tolerance, preset)
+            if predicted is not None:
+                pruned.append(predicted)
+                continue
+        cutoff = watch() if watch is not None else None
+        point = ctx.encode([trans.Format(size=size, crf=next_crf)], preset, cutoff)[0]
+        if cutoff is not None and cutoff.aborted:
+            pruned.append(trans.Format(size=size, crf=next_crf, vmaf=target_vmaf))
+        elif not point.vmaf:
+            log.error("encode @{:s} crf={:.2f} failed, give up".format(size.wxh(), next_crf))
+            return None, None
+        elif prefix_vmaf is not None:
+            prefix.learn(point, prefix_vmaf)
+    log.warning("search @{:s} not done in {:d} steps".format(size.wxh(), MAX_SEARCH_STEPS))
+    return None, None
+
+
+def search_crf_in_other_size(ctx, anchor, size, proxy=None, tolerance=VMAF_TOLERANCE, race=None, prefix=None):
     """
     search for a encoding crf in other size that has the same video quality
     as the anchor out video.
-    :param original: original video <trans.Format>
+    with @proxy the crf search runs on the proxy preset aiming at the corrected vmaf,
+    then the final preset confirms the point, corrected once more if off by more than the tolerance
+    :param ctx: <SearchContext>
     :param anchor: anchor out video <trans.Format>
     :param size: <trans.CTransSize>
+    :param proxy: calibrated <Proxy>, or None to search with the final preset
+    :param tolerance: vmaf distance to the anchor accepted for the result
+    :param race: <Race> with the searches of other sizes, give up once this one can't win
+    :param prefix: calibrated <Prefix> to prune probe points on, or None
     :return: <trans.Format>
     """
     if anchor.vmaf is None or anchor.vmaf == 0:
@@ -57,68 +580,118 @@ def search_crf_in_other_size(original, anchor, size):
     if size == anchor.size:
         return None
 
-    crf1 = anchor.crf
-    trans1 = trans.Format(size=size, crf=crf1)
-    score.trans_and_get_score(original, trans1)
-
-    target_crf = None
     crf_delta = 1 if size > anchor.size else - 1
-    while trans1.crf in range(20, 37):
-        ''' search in [20, crf1] or [crf1 ,37] 
-        '''
-        crf2 = trans1.crf + crf_delta
-        trans2 = trans.Format(size=size, crf=crf2)
-        score.trans_and_get_score(original, trans2)
-        if (trans1.vmaf - anchor.vmaf) * (trans2.vmaf - anchor.vmaf) <= 0:
-            '''
-            (crf0 - crf1) / (crf1 - crf2) = (vmaf0 - vmaf1) / (vmaf1 - vmaf2)
-            crf0 = crf1 + (crf1 - crf2) * (vmaf0 - vmaf1) / (vmaf1 - vmaf2)
-            '''
-            target_crf = trans1.crf + (trans1.crf - trans2.crf) * (anchor.vmaf - trans1.vmaf) / (trans1.vmaf - trans2.vmaf)
-            break
-        trans1 = trans2
-
-    if target_crf is not None:
-        candi = trans.Format(size=size, crf=target_crf)
-        score.trans_and_get_score(original, candi)
-        log.info("search crf @" + str(size) + " = " + str(candi))
-        return candi
-    return None
-
-
-def search_better_size(original, anchor, search_size=[]):
+    target_vmaf = anchor.vmaf - proxy.vmaf_offset if proxy is not None else anchor.vmaf
+    br_ratio = proxy.br_ratio if proxy is not None else 1.0
+    give_up = (lambda points: race.lost(points, target_vmaf, tolerance, br_ratio)) if race is not None else None
+    watch = (lambda: race.cutoff(br_ratio)) if race is not None else None
+    found, slope = _search_crf(ctx, size, anchor.crf, target_vmaf, crf_delta,
+                               proxy.preset if proxy is not None else FINAL_PRESET, tolerance, give_up, prefix,
+                               watch)
+    if found is None:
+        return None
+
+    cutoff = race.cutoff() if race is not None else None
+    candi = ctx.encode([trans.Format(size=size, crf=found.crf)], FINAL_PRESET, cutoff)[0]
+    if cutoff is not None and cutoff.aborted:
+        log.info("search crf @" + size.wxh() + " can't win, candidate stopped")
+        return None
+    if proxy is not None and abs(candi.vmaf - anchor.vmaf) > tolerance and slope is not None:
+        # the proxy slope is close enough to the final one for one correction step
+        crf = round(candi.crf + slope * (anchor.vmaf - candi.vmaf), 2)
+        candi2 = ctx.encode([trans.Format(size=size, crf=min(CRF_MAX, max(CRF_MIN, crf)))], FINAL_PRESET,
+                            race.cutoff() if race is not None else None)[0]
+        if abs(candi2.vmaf - anchor.vmaf) < abs(candi.vmaf - anchor.vmaf):
+            candi = candi2
+    if race is not None and candi.vmaf >= anchor.vmaf - tolerance:
+        race.finish(candi)
+    log.info("search crf @" + str(size) + " = " + str(candi) + " in {:d} encodes".format(ctx.encodes_of(size)))
+    return candi
+
+
+def search_better_size(ctx, anchor, search_size=[], proxy_preset=None, tolerance=VMAF_TOLERANCE,
+                       prefix_time=None, prefix_z=2.0):
     """
     search for a encoding size that has lower bit-rate but keep the same video quality
     as the anchor out video.
-    :param original: original video <trans.Format>
+    :param ctx: <SearchContext>
     :param anchor: anchor out or target (to be out) video <trans.Format>
     :param search_size: candidated video size to be searched <[trans.CTransSize,...]>
+    :param proxy_preset: search crf with this fast preset and confirm with the final one, None to disable
+    :param tolerance: vmaf distance to the anchor accepted for the candidates
+    :param prefix_time: check probe points on the first seconds of the original first, None to disable
+    :param prefix_z: sigmas a point's predicted vmaf must be out of the bracket to be pruned
     :return: out video that has lower bit-rate but keep the same video quality
     as the anchor out video <trans.CTransSize>
     """
-    score.trans_and_get_score(original, anchor)
-    better1 = anchor
-    b_get_better = False
-
-    for size in search_size:
-        better2 = search_crf_in_other_size(original, anchor, size)
-        if better2 is not None and better1.br < better2.br:
-            better1 = better2
-            b_get_better = True
+    # sizes given by the shorter side get their w and h first, the searches compare them
+    for size in [anchor.size] + list(search_size):
+        size.shorter2wxh(ctx.original.size)
+    ctx.encode([anchor])
+    proxy = None
+    if proxy_preset is not None:
+        proxy = Proxy(proxy_preset)
+        if proxy.calibrate(ctx, anchor) is not True:
+            proxy = None
+    prefix = None
+    if prefix_time is not None and not ctx.clip_set:
+        clip = clips.get_prefix(ctx.original.path, prefix_time)
+        if clip is not None:
+            prefix = Prefix(clip, prefix_z)
+            prefix.calibrate(ctx, anchor)
+    # the sizes are searched at the same time, their encodes share the core budget of @ctx
+    race = Race(anchor.br, ctx.profile())
+    jobs = [proc.submit(search_crf_in_other_size, ctx, anchor, size, proxy, tolerance, race, prefix) for size in search_size]
+    matched = [fmt for fmt in proc.gather(jobs)
+               if fmt is not None and fmt.vmaf >= anchor.vmaf - tolerance and int(fmt.br) < int(anchor.br)]
+    matched.sort(key=lambda fmt: int(fmt.br))
+    better1 = matched[0] if matched else anchor
+    b_get_better = better1 is not anchor
 
+    if b_get_better and ctx.clip_set:
+        # the clips only predict the title, check the choice on all of it, the next
+        # matched size is tried if it fails. the anchor is verified with the first one
+        full_anchor, better1 = ctx.verify([anchor, better1])
+        for i in range(len(matched)):
+            if i > 0:
+                better1 = ctx.verify([matched[i]])[0]
+            if better1.vmaf >= full_anchor.vmaf - tolerance and int(better1.br) < int(full_anchor.br):
+                break
+            log.warning("verified {:s} is not better than the anchor {:s}".format(str(better1), str(full_anchor)))
+        else:
+            b_get_better = False
+    log.info("encodes = " + str(ctx.encodes) + ", per size = " + str(ctx.size_encodes))
     if b_get_better:
         log.info("better = " + str(better1))
 
     return better1 if b_get_better is True else None
 
 
-def sizeopt_test(path, anchor_size, anchor_crf, search_size):
+def sizeopt_test(path, anchor_size, anchor_crf, search_size, yuv_cache_dir=None, yuv_cache_size=None,
+                 trans_cache_dir=None, trans_cache_size=None, chunks=None, proxy_preset=None,
+                 clip_count=None, clip_cache_dir=None, probe_cache=None, vmaf_tolerance=None, cores=None,
+                 prefix_time=None, prefix_z=None):
+    if probe_cache is not None:
+        info.set_probe_cache(probe_cache)
     mi = info.Media(path, probe=True)
     source_fmt = trans.Format().from_mediainfo(mi)
     anchor_res = trans.TSize().from_string(anchor_size)
     anchor_fmt = trans.Format(size=anchor_res, crf=anchor_crf)
     search_res = [trans.TSize().from_string(size) for size in search_size.split(",")]
-    return search_better_size(source_fmt, anchor_fmt, search_res)
+    ctx = SearchContext(source_fmt,
+                        ref_cache=cache.get_ref_yuv_cache(yuv_cache_dir, yuv_cache_size),
+                        trans_cache=cache.get_trans_cache(trans_cache_dir, trans_cache_size),
+                        chunks=chunks,
+                        clip_set=clips.get_clip_set(path, clip_cache_dir, int(clip_count)) if clip_count else None,
+                        cores=cores or "auto",
+                        ref_cache_size=yuv_cache_size or 0)
+    tolerance = float(vmaf_tolerance) if vmaf_tolerance is not None else VMAF_TOLERANCE
+    try:
+        return search_better_size(ctx, anchor_fmt, search_res, proxy_preset, tolerance,
+                                  float(prefix_time) if prefix_time is not None else None,
+                                  float(prefix_z) if prefix_z is not None else 2.0)
+    finally:
+        ctx.close()
 
 
 def _main_parser():
@@ -128,6 +701,23 @@ def _main_parser():
     parser.add_option("-s", "--anchor-size", dest="anchor_size", help=r"anchor shorter size")
     parser.add_option("-q", "--anchor-crf", dest="anchor_crf", help=r"anchor crf")
     parser.add_option("-d", "--search-size", dest="search_size", help=r"candidate shorter size separated by comma")
+    parser.add_option("--yuv-cache-dir", dest="yuv_cache_dir", help=r"keep decoded reference yuv in this dir")
+    parser.add_option("--yuv-cache-size", dest="yuv_cache_size", help=r"disk budget of yuv cache (ie. 20G)")
+    parser.add_option("--trans-cache-dir", dest="trans_cache_dir", help=r"reuse transcoded videos kept in this dir")
+    parser.add_option("--trans-cache-size", dest="trans_cache_size", help=r"disk budget of transcode cache (ie. 50G)")
+    parser.add_option("--chunks", dest="chunks", help=r"encode in parallel chunks, a number or auto")
+    parser.add_option("--proxy-preset", dest="proxy_preset",
+                      help=r"search crf with this fast x264 preset (ie. veryfast), confirm with veryslow")
+    parser.add_option("--clips", dest="clip_count", help=r"search on this many representative clips")
+    parser.add_option("--clip-cache-dir", dest="clip_cache_dir", help=r"keep clip sets of the sources in this dir")
+    parser.add_option("--probe-cache", dest="probe_cache", help=r"sqlite db keeping ffprobe results")
+    parser.add_option("--vmaf-tolerance", dest="vmaf_tolerance",
+                      help=r"vmaf distance to the anchor that ends a crf search (default 0.5)")
+    parser.add_option("--cores", dest="cores", help=r"cores shared by the size searches (default auto)")
+    parser.add_option("--prefix-time", dest="prefix_time",
+                      help=r"check probe points on the first seconds of the input before encoding all of it")
+    parser.add_option("--prefix-z", dest="prefix_z",
+                      help=r"sigmas a prefix prediction must be off the target to skip the point (default 2)")
     return parser
 
 
@@ -145,5 +735,8 @@ if __name__ == "__main__":
     _create_module_log()
     parser = _main_parser()
     (opt, args) = parser.parse_args()
-    sizeopt_test(opt.input, opt.anchor_size, opt.anchor_crf, opt.search_size)
+    sizeopt_test(opt.input, opt.anchor_size, opt.anchor_crf, opt.search_size,
+                 opt.yuv_cache_dir, opt.yuv_cache_size, opt.trans_cache_dir, opt.trans_cache_size,
+                 opt.chunks, opt.proxy_preset, opt.clip_count, opt.clip_cache_dir,
+                 opt.probe_cache, opt.vmaf_tolerance, opt.cores, opt.prefix_time, opt.prefix_z)
     log.info("done")
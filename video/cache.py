@@ -0,0 +1,378 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    content-addressed file cache with lru eviction under a disk budget
+"""
+
+import os
+import json
+import errno
+import fcntl
+import hashlib
+import logging
+import shutil
+import tempfile
+import threading
+import proc
+import trans
+import utils
+import cfg.tools
+
+module_name = "v.cache"
+log = logging.getLogger(module_name)
+
+_LOCK_EXT = ".lock"
+_CREATE_EXT = ".create"
+_TMP_EXT = ".tmp"
+
+
+def file_fingerprint(path):
+    """
+    identity of a local file, changes whenever the file is replaced or rewritten
+    :return: [realpath, size, mtime, inode], or [path] for net streams
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [path]
+    return [os.path.realpath(path), st.st_size, st.st_mtime, st.st_ino]
+
+
+def make_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+
+_tool_versions = {}
+
+
+def tool_version(tool):
+    """
+    :return: first line of `@tool -version`, cached per process
+    """
+    if tool not in _tool_versions:
+        returncode, output, _ = proc.run([tool, "-version"])
+        _tool_versions[tool] = output.split("\n")[0].strip() if returncode == 0 else None
+    return _tool_versions[tool]
+
+
+def link_or_copy(src, dst):
+    """
+    hardlink @src to @dst, copy if they are on different file systems
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class FileCache:
+    """
+    a directory of files named by key.
+    - entries are published by rename, so readers see complete files or nothing
+    - each entry has a lock file held LOCK_SH while in use, and another one held LOCK_EX
+      while creating. flock works across threads and processes, so workers can share a cache
+    - entries are evicted by least recent use (mtime) once the total size exceeds
+      @max_bytes, entries in use are never evicted. max_bytes=0 means unlimited
+    """
+    def __init__(self, cache_dir, max_bytes=0, ext=""):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes or 0)
+        self.ext = ext
+        self._pinned = {}           # path -> [lock file, ...]
+        self._mutex = threading.Lock()
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise e
+
+    def __str__(self):
+        return str({"cache_dir": self.cache_dir, "max_bytes": self.max_bytes})
+
+    def path_of(self, key):
+        return os.path.join(self.cache_dir, key + self.ext)
+
+    def _pin(self, path, lockf):
+        with self._mutex:
+            self._pinned.setdefault(path, []).append(lockf)
+
+    def release(self, path):
+        """
+        mark an entry returned by get() as no longer in use
+        """
+        with self._mutex:
+            lockfs = self._pinned.get(path)
+            if not lockfs:
+                return
+            lockf = lockfs.pop()
+            if not lockfs:
+                del self._pinned[path]
+        fcntl.flock(lockf, fcntl.LOCK_UN)
+        lockf.close()
+
+    def get(self, key, create_func):
+        """
+        get the entry of @key, create it by @create_func if missing.
+        the entry is pinned until release(path)
+        :param create_func: create_func(tmp_path) -> True if the entry is written to tmp_path
+        :return: path of the entry, or None if @create_func failed
+        """
+        path = self.path_of(key)
+        lockf = open(path + _LOCK_EXT, "a")
+        try:
+            # LOCK_SH on the entry keeps it from eviction, creation is serialized by another lock
+            fcntl.flock(lockf, fcntl.LOCK_SH)
+            if os.path.isfile(path):
+                log.info("cache hit " + path)
+            elif self._create(path, create_func) is not True:
+                lockf.close()
+                return None
+            os.utime(path, None)
+        except Exception as e:
+            lockf.close()
+            log.error("Exception = `%s`", repr(e))
+            raise e
+        self._pin(path, lockf)
+        self.evict()
+        return path
+
+    def lookup(self, key):
+        """
+        :return: path of the entry of @key pinned like get(), or None if missing
+        """
+        path = self.path_of(key)
+        lockf = open(path + _LOCK_EXT, "a")
+        fcntl.flock(lockf, fcntl.LOCK_SH)
+        if not os.path.isfile(path):
+            lockf.close()
+            return None
+        log.info("cache hit " + path)
+        os.utime(path, None)
+        self._pin(path, lockf)
+        return path
+
+    def _create(self, path, create_func):
+        with open(path + _CREATE_EXT, "a") as createf:
+            fcntl.flock(createf, fcntl.LOCK_EX)
+            if os.path.isfile(path):
+                return True     # created by someone else while waiting
+            tmp_path = "{:s}{:s}.{:d}.{:d}".format(path, _TMP_EXT, os.getpid(), threading.current_thread().ident)
+            log.info("cache miss " + path)
+            if create_func(tmp_path) is not True or not os.path.isfile(tmp_path):
+                log.error("failed to create cache entry " + path)
+                if os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+                return False
+            os.rename(tmp_path, path)
+        return True
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(_LOCK_EXT) or name.endswith(_CREATE_EXT) or _TMP_EXT in name \
+                    or not name.endswith(self.ext):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        remove least recently used entries until the cache fits in max_bytes
+        :return: bytes removed
+        """
+        if self.max_bytes <= 0:
+            return 0
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            lockf = open(path + _LOCK_EXT, "a")
+            try:
+                fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lockf.close()
+                continue    # in use
+            try:
+                if os.path.isfile(path):
+                    os.remove(path)
+                    log.info("cache evict " + path)
+                    total -= size
+                    removed += size
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+                lockf.close()
+        return removed
+
+
+class RefYuvCache(FileCache):
+    """
+    reference raw yuv decoded once per (source, cmp_res, cmp_frames, pix_fmt, start_time)
+    """
+    def __init__(self, cache_dir, max_bytes=0):
+        FileCache.__init__(self, cache_dir, max_bytes, ext=".yuv")
+
+    def get_ref_yuv(self, ref_fmt, tsize, cmp_frames=None, pix_fmt="yuv420p", start_time=None):
+        """
+        :param ref_fmt: original video info <trans.Format>
+        :param tsize: decoding size <trans.TSize>
+        :param start_time: decode from this time in seconds
+        :return: path for the raw yuv, call release() when done
+        """
+        tsize.shorter2wxh(ref_fmt.size)
+        key = make_key(file_fingerprint(ref_fmt.path), tsize.wxh(), cmp_frames, pix_fmt, start_time)
+
+        def _decode(tmp_path):
+            iparam = ["-ss", str(start_time)] if (start_time is not None) else []
+            oparam = ["-vframes", str(cmp_frames)] if (cmp_frames is not None) else []
+            oparam += ["-pix_fmt", pix_fmt]
+            save_dir, save_name = os.path.split(tmp_path)
+            return trans.to_yuv_by_size(ref_fmt, tsize, save_name=save_name,
+                                        _iparam=iparam, _oparam=oparam, save_dir=save_dir) is not None
+
+        return self.get(key, _decode)
+
+
+class TransCache(FileCache):
+    """
+    transcoded outputs keyed by input fingerprint, the expanded ffmpeg arguments,
+    the output extension and the ffmpeg version. hits are hardlinked to the output path.
+    trans.trans_by_ioparam() unlinks a hardlinked output before writing it, so an
+    entry is never truncated through its output
+    """
+    def __init__(self, cache_dir, max_bytes=0, tool=None):
+        FileCache.__init__(self, cache_dir, max_bytes)
+        self.tool = tool or cfg.tools.ffmpeg
+
+    def key_of(self, input, iparam, oparam, output):
+        return make_key(file_fingerprint(input), list(iparam), list(oparam),
+                        os.path.splitext(output)[1], tool_version(self.tool))
+
+    def restore(self, key, output):
+        """
+        :return: True if the entry of @key is linked to @output
+        """
+        path = self.lookup(key)
+        if path is None:
+            return False
+        try:
+            link_or_copy(path, output)
+        finally:
+            self.release(path)
+        return True
+
+    def store(self, key, output):
+        def _link(tmp_path):
+            link_or_copy(output, tmp_path)
+            return True
+        path = self.get(key, _link)
+        if path is not None:
+            self.release(path)
+
+    def trans(self, input, iparam, oparam, output, trans_func):
+        """
+        :param trans_func: trans_func(input, iparam, oparam, output) -> returncode, run on a miss.
+                           concurrent misses of the same key run it once
+        :return: returncode, 0 on a hit
+        """
+        key = self.key_of(input, iparam, oparam, output)
+        rets = [None]
+
+        def _create(tmp_path):
+            rets[0] = trans_func(input, iparam, oparam, output)
+            if rets[0] != 0:
+                return False
+            link_or_copy(output, tmp_path)
+            return True
+
+        path = self.get(key, _create)
+        if path is None:
+            return rets[0] or 1
+        try:
+            if rets[0] is None:
+                link_or_copy(path, output)
+        finally:
+            self.release(path)
+        return 0
+
+    def trans_multi(self, input, iparam, outputs, trans_func):
+        """
+        like trans() for trans.trans_multi_by_ioparam(), only the missing outputs are encoded
+        :param trans_func: trans_func(input, iparam, outputs) -> [returncode, ...]
+        """
+        keys = [self.key_of(input, iparam, [vfilter or ""] + list(oparam), output)
+                for vfilter, oparam, output in outputs]
+        rets = [0 if self.restore(key, output) else None for key, (_, _, output) in zip(keys, outputs)]
+        misses = [i for i, ret in enumerate(rets) if ret is None]
+        if misses:
+            for i, ret in zip(misses, trans_func(input, iparam, [outputs[i] for i in misses])):
+                rets[i] = ret
+                if ret == 0:
+                    self.store(keys[i], outputs[i][2])
+        return rets
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _get_cache(cache_cls, cache_dir, max_bytes=0):
+    if cache_dir is None:
+        return None
+    with _caches_lock:
+        cache = _caches.get((cache_cls, cache_dir))
+        if cache is None:
+            cache = cache_cls(cache_dir, utils.parse_bytes(max_bytes))
+            _caches[(cache_cls, cache_dir)] = cache
+        return cache
+
+
+def get_ref_yuv_cache(cache_dir, max_bytes=0):
+    """
+    one RefYuvCache per @cache_dir in this process, so every caller of a task shares it
+    :return: <RefYuvCache>, or None if @cache_dir is None
+    """
+    return _get_cache(RefYuvCache, cache_dir, max_bytes)
+
+
+def make_temp_ref_yuv_cache(parent_dir=None, max_bytes=0):
+    """
+    :param parent_dir: make the temporary dir in this dir, the system one if None
+    :return: <RefYuvCache> in a new temporary dir, the caller removes its cache_dir when done
+    """
+    if parent_dir is not None and not os.path.isdir(parent_dir):
+        os.makedirs(parent_dir)
+    return RefYuvCache(tempfile.mkdtemp(prefix=module_name + ".", dir=parent_dir), utils.parse_bytes(max_bytes))
+
+
+def get_trans_cache(cache_dir, max_bytes=0):
+    """
+    one TransCache per @cache_dir in this process
+    :return: <TransCache>, or None if @cache_dir is None
+    """
+    return _get_cache(TransCache, cache_dir, max_bytes)
@@ -0,0 +1,246 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    chunked encoding of long sources: split at source keyframes, encode the
+    chunks in parallel and join them by the concat demuxer without re-encoding
+"""
+
+import os
+import time
+import shutil
+import logging
+import multiprocessing
+import tempfile
+import proc
+import trans
+import packets
+import utils
+import cfg.tools
+
+FFMPEG = cfg.tools.ffmpeg
+FFPROBE = cfg.tools.ffprobe
+module_name = "v.chunk"
+log = logging.getLogger(module_name)
+
+# options with a value that go to the final mux rather than the chunk encodes
+_audio_options = ("-acodec", "-c:a", "-codec:a", "-b:a", "-ar", "-ac", "-af", "-async", "-movflags")
+# options that limit the output length, they would apply to every chunk
+_length_options = ("-frames", "-vframes", "-frames:v", "-t", "-to", "-fs")
+# input options that seek or limit the input, they would clash with the seek of each chunk
+_input_length_options = ("-ss", "-sseof", "-t", "-to")
+
+
+def get_keyframes(path):
+    """
+    :return: presentation times of the video keyframes of @path in seconds
+    """
+    index = packets.get_index(path)
+    if index is not None:
+        return [float(t) for t in index.keyframes()]
+    times = []
+
+    def _on_line(line):
+        try:
+            times.append(float(line.strip().strip(",")))
+        except ValueError:
+            pass
+
+    command = [FFPROBE, "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+               "-show_entries", "frame=best_effort_timestamp_time", "-of", "csv=p=0", path]
+    returncode, _, error = proc.run(command, on_stdout=_on_line)
+    if returncode:
+        log.error("error[{:d}]: \n{:s}".format(returncode, error))
+    return sorted(times)
+
+
+def get_duration(path):
+    """
+    :return: container duration in seconds, 0 if unknown
+    """
+    command = [FFPROBE, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path]
+    returncode, output, _ = proc.run(command)
+    try:
+        return float(output.strip()) if returncode == 0 else 0.0
+    except ValueError:
+        return 0.0
+
+
+def plan_chunks(keyframes, duration, chunks, min_chunk_time=10.0):
+    """
+    split [0, duration) into about @chunks parts of equal length, every split
+    snapped to the nearest keyframe, which are usually scene cuts
+    :return: [(start, end), ...] in seconds, end is None for the last chunk
+    """
+    chunks = max(1, min(int(chunks), int(duration // min_chunk_time)))
+    splits = []
+    for i in range(1, chunks):
+        target = duration * i / chunks
+        candidates = [t for t in keyframes if (not splits or t > splits[-1]) and 0 < t < duration]
+        if not candidates:
+            break
+        nearest = min(candidates, key=lambda t: abs(t - target))
+        if nearest not in splits:
+            splits.append(nearest)
+    bounds = [0.0] + splits
+    return [(start, end) for start, end in zip(bounds, splits + [None])]
+
+
+def share_cores(chunks, cores=None):
+    """
+    :param chunks: number of chunks, "auto" for one per core
+    :param cores: cores of the whole encode, the cpu count if None
+    :return: (chunks, encoder threads of each chunk), chunks x threads stays within @cores
+    """
+    cores = max(1, int(cores)) if cores else multiprocessing.cpu_count()
+    chunks = cores if chunks == "auto" else max(1, min(int(chunks), cores))
+    return chunks, max(1, cores // chunks)
+
+
+def is_length_limited(iparam, oparam):
+    """
+    :return: True if @iparam or @oparam seek or limit the length, the chunks can't be planned then
+    """
+    return any(opt in oparam for opt in _length_options) or any(opt in iparam for opt in _input_length_options)
+
+
+def split_audio_params(oparam):
+    """
+    :return: (video params, params for the final mux) of @oparam
+    """
+    voparam, aoparam = [], []
+    i = 0
+    while i < len(oparam):
+        if oparam[i] in _audio_options and i + 1 < len(oparam):
+            aoparam += oparam[i:i + 2]
+            i += 2
+        else:
+            if oparam[i] == "-an":
+                aoparam.append("-an")
+            voparam.append(oparam[i])
+            i += 1
+    return voparam, aoparam
+
+
+def _encode_chunk(input, iparam, voparam, start, end, chunk_path):
+    seek = ["-ss", "{:.6f}".format(start)] if start > 0 else []
+    length = ["-t", "{:.6f}".format(end - start)] if end is not None else []
+    start_time = time.time()
+    ret = trans.trans_by_ioparam(input, iparam + seek, ["-an"] + voparam + length, chunk_path)
+    return ret, time.time() - start_time
+
+
+def trans_chunked(input, iparam, oparam, output, chunks="auto", min_chunk_time=10.0, work_dir=None, cores=None,
+                  trans_cache=None):
+    """
+    encode @input to @output in chunks encoded in parallel.
+    every chunk gets the same video params, so crf rate control is consistent between them,
+    audio is taken once from @input when the chunks are joined.
+    the encoder threads in @oparam are per chunk, see share_cores()
+    :param chunks: number of chunks, "auto" for one per core, at most @cores
+    :param min_chunk_time: chunks are at least this long in seconds
+    :param work_dir: dir for the chunk files, a temporary one if None
+    :param cores: cores of the whole encode, the cpu count if None
+    :param trans_cache: <cache.TransCache>, reuse the output of the same input, params and chunk plan
+    :return: <dict> with "returncode", "trans_time", "concat_time", "cached" and "chunks" of
+             {"start", "end", "trans_time", "returncode"} per chunk
+    """
+    report = {"returncode": 0, "chunks": [], "trans_time": 0.0, "concat_time": 0.0, "cached": False}
+    if is_length_limited(iparam, oparam):
+        log.warning("input or output length is limited, encode in one chunk")
+        chunks = 1
+    chunks, _ = share_cores(chunks, cores)
+    duration = get_duration(input) if chunks > 1 else 0.0
+    plan = plan_chunks(get_keyframes(input), duration, chunks, min_chunk_time) if duration > 0 else [(0.0, None)]
+    start_time = time.time()
+    if len(plan) == 1:
+        report["returncode"] = trans.trans_by_ioparam(input, iparam, oparam, output, trans_cache)
+        report["trans_time"] = time.time() - start_time
+        report["chunks"].append({"start": 0.0, "end": None, "trans_time": report["trans_time"],
+                                 "returncode": report["returncode"]})
+        return report
+
+    key = None
+    if trans_cache is not None:
+        # the splits change the output, it is only reused for the same ones
+        splits = ["{:.6f}".format(start) for start, _ in plan[1:]]
+        key = trans_cache.key_of(input, iparam, oparam + ["chunks:"] + splits, output)
+        if trans_cache.restore(key, output):
+            log.info("chunked output restored from the cache " + output)
+            report["cached"] = True
+            return report
+    voparam, aoparam = split_audio_params(oparam)
+    own_dir = work_dir is None
+    work_dir = tempfile.mkdtemp(prefix=module_name + ".") if own_dir else work_dir
+    ext = os.path.splitext(output)[1] or ".mp4"
+    try:
+        chunk_paths = [utils.prepare_save_path("chunk{:04d}{:s}".format(i, ext), work_dir) for i in range(len(plan))]
+        jobs = [proc.submit(_encode_chunk, input, iparam, voparam, start, end, chunk_path)
+                for (start, end), chunk_path in zip(plan, chunk_paths)]
+        for (start, end), (ret, trans_time) in zip(plan, proc.gather(jobs)):
+            report["chunks"].append({"start": start, "end": end, "trans_time": trans_time, "returncode": ret})
+            log.info("chunk [{:.3f}, {:s}) {:.1f}s ret={:d}".format(start, str(end), trans_time, ret))
+        report["trans_time"] = time.time() - start_time
+        failed = [c for c in report["chunks"] if c["returncode"] != 0]
+        if failed:
+            log.error("{:d} chunks failed".format(len(failed)))
+            report["returncode"] = failed[0]["returncode"]
+            return report
+
+        list_path = os.path.join(work_dir, "chunks.txt")
+        with open(list_path, "w") as f:
+            for chunk_path in chunk_paths:
+                f.write("file '{:s}'\n".format(os.path.abspath(chunk_path).replace("'", "'\\''")))
+        concat_time = time.time()
+        trans.unlink_shared(output)
+        command = [FFMPEG, "-hide_banner", "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-i", input]
+        command += ["-map", "0:v"] + ([] if "-an" in aoparam else ["-map", "1:a?"])
+        command += ["-c:v", "copy"] + [a for a in aoparam if a != "-an"] + [output]
+        report["returncode"] = trans.run_command(command)
+        report["concat_time"] = time.time() - concat_time
+        if report["returncode"] == 0 and key is not None:
+            trans_cache.store(key, output)
+        return report
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def to_264_chunked(original, tsize, crf, chunks="auto", save_name=None, save_dir=None, threads=None,
+                   preset="veryslow", cores=None, trans_cache=None):
+    """
+    like trans.to_264_by_size_crf(), encoded by trans_chunked()
+    :param threads: x264 threads of each chunk, @cores / chunks if None
+    :param cores: cores of the whole encode, the cpu count if None
+    :param trans_cache: <cache.TransCache>, see trans_chunked()
+    :return: (path for the transcoded video or None, report of trans_chunked())
+    """
+    tsize.shorter2wxh(original.size)
+    n, chunk_threads = share_cores(chunks, cores)
+    threads = threads or chunk_threads
+    iparam = "-y -threads 0".split(" ")
+    oparam = "-s {w:d}x{h:d}".format(w=tsize.w, h=tsize.h).split(" ") + trans.x264_oparam(crf, threads, preset)
+    if save_name is None:
+        save_name = trans.x264_save_name(original, tsize, crf, preset)
+    save_path = utils.prepare_save_path(save_name, save_dir)
+    report = trans_chunked(original.path, iparam, oparam, save_path, n, cores=cores, trans_cache=trans_cache)
+    if report["returncode"] != 0:
+        log.error("transcoding failed")
+        return None, report
+    return save_path, report
@@ -0,0 +1,211 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    representative clips of a video: scenes are found by a fast x264 pass,
+    grouped by complexity, and one clip per group stands for the group's duration
+"""
+
+import os
+import re
+import json
+import logging
+import tempfile
+import threading
+import cache
+import trans
+import utils
+import cfg.tools
+
+FFMPEG = cfg.tools.ffmpeg
+module_name = "v.clips"
+log = logging.getLogger(module_name)
+
+_vstats_regex = re.compile(r"frame=\s*(?P<frame>\d+).*?f_size=\s*(?P<size>\d+).*?time=\s*(?P<time>[.0-9]+)"
+                           r".*?type=\s*(?P<type>\w)")
+
+
+def _analyse_args(path, vstats_path, height=360):
+    """
+    x264 at a fixed crf on a small picture: frame sizes follow the content complexity,
+    and the scenecut decision puts I frames at scene changes
+    """
+    command = [FFMPEG, "-hide_banner", "-y", "-i", path, "-an", "-vf", "scale=-2:{:d}".format(height)]
+    command += ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"]
+    command += ["-x264opts", "keyint=infinite:min-keyint=12:scenecut=40"]
+    command += ["-vstats_file", vstats_path, "-f", "null", "-"]
+    return command
+
+
+def detect_scenes(path, max_scene_time=20.0):
+    """
+    :param max_scene_time: longer scenes are cut into parts of at most this length
+    :return: [{"start", "duration", "frames", "complexity"}, ...] in time order,
+             complexity is the mean coded frame size in bytes
+    """
+    fd, vstats_path = tempfile.mkstemp(prefix=module_name + ".", suffix=".vstats")
+    os.close(fd)
+    try:
+        if trans.run_command(_analyse_args(path, vstats_path)) != 0:
+            return []
+        frames = []
+        with open(vstats_path, "r") as f:
+            for line in f:
+                match = _vstats_regex.search(line)
+                if match:
+                    frames.append((float(match.group("time")), int(match.group("size")), match.group("type")))
+    finally:
+        os.remove(vstats_path)
+
+    scenes = []
+    for i, (t, size, ftype) in enumerate(frames):
+        if not scenes or ftype == "I" or t - scenes[-1]["start"] >= max_scene_time:
+            scenes.append({"start": t, "frames": 0, "bytes": 0})
+        scenes[-1]["frames"] += 1
+        scenes[-1]["bytes"] += size
+    frame_time = (frames[-1][0] / (len(frames) - 1)) if len(frames) > 1 else 0.04
+    for i, scene in enumerate(scenes):
+        end = scenes[i + 1]["start"] if i + 1 < len(scenes) else scene["start"] + scene["frames"] * frame_time
+        scene["duration"] = end - scene["start"]
+        scene["complexity"] = float(scene.pop("bytes")) / scene["frames"]
+    log.info("{:d} scenes in {:d} frames".format(len(scenes), len(frames)))
+    return scenes
+
+
+def select_clips(scenes, clips=6, clip_time=4.0):
+    """
+    sort scenes by complexity, cut them into @clips groups of equal duration, and
+    take from each group the scene closest to its duration-weighted median complexity
+    :return: [{"start", "duration", "weight", "complexity"}, ...] in time order,
+             weight is the group's share of the total duration
+    """
+    total = sum(s["duration"] for s in scenes)
+    if total <= 0:
+        return []
+    ranked = sorted(scenes, key=lambda s: s["complexity"])
+    groups = [[] for _ in range(clips)]
+    acc = 0.0
+    for scene in ranked:
+        # group by the duration-weighted rank of the scene's middle
+        idx = min(clips - 1, int((acc + scene["duration"] / 2) / total * clips))
+        groups[idx].append(scene)
+        acc += scene["duration"]
+
+    selected = []
+    for group in groups:
+        if not group:
+            continue
+        duration = sum(s["duration"] for s in group)
+        half, acc, median = duration / 2, 0.0, group[-1]["complexity"]
+        for s in group:
+            acc += s["duration"]
+            if acc >= half:
+                median = s["complexity"]
+                break
+        # prefer scenes long enough for a whole clip
+        scene = min(group, key=lambda s: (s["duration"] < clip_time, abs(s["complexity"] - median)))
+        length = min(clip_time, scene["duration"])
+        selected.append({
+            "start": round(scene["start"] + (scene["duration"] - length) / 2, 3),
+            "duration": round(length, 3),
+            "weight": duration / total,
+            "complexity": scene["complexity"]
+        })
+    return sorted(selected, key=lambda c: c["start"])
+
+
+def _extract_clip(path, clip, clip_path):
+    # near lossless intermediate, so the clip encodes see the source quality
+    iparam = ["-y", "-ss", str(clip["start"])]
+    oparam = ["-t", str(clip["duration"]), "-an", "-c:v", "libx264", "-preset", "ultrafast", "-qp", "0"]
+    return trans.trans_by_ioparam(path, iparam, oparam, clip_path)
+
+
+class ClipCache(cache.FileCache):
+    """
+    clip set of a source as json, keyed by the source fingerprint and the selection params,
+    with the extracted clip files next to it
+    """
+    def __init__(self, cache_dir, max_bytes=0):
+        cache.FileCache.__init__(self, cache_dir, max_bytes, ext=".json")
+
+    def get_clips(self, path, clips=6, clip_time=4.0):
+        """
+        :return: [{"start", "duration", "weight", "complexity", "path"}, ...], [] if failed
+        """
+        key = cache.make_key(cache.file_fingerprint(path), clips, clip_time)
+        json_path = self.path_of(key)
+        if os.path.isfile(json_path):
+            with open(json_path, "r") as f:
+                clip_set = json.load(f)
+            if not all(os.path.isfile(c["path"]) for c in clip_set):
+                os.remove(json_path)    # clip files removed, select again
+
+        def _create(tmp_path):
+            selected = select_clips(detect_scenes(path), clips, clip_time)
+            for i, clip in enumerate(selected):
+                clip["path"] = os.path.join(self.cache_dir, "{:s}.clip{:d}.mkv".format(key, i))
+                if _extract_clip(path, clip, clip["path"]) != 0:
+                    return False
+            with open(tmp_path, "w") as f:
+                json.dump(selected, f, indent=4)
+            return bool(selected)
+
+        json_path = self.get(key, _create)
+        if json_path is None:
+            return []
+        try:
+            with open(json_path, "r") as f:
+                return json.load(f)
+        finally:
+            self.release(json_path)
+
+
+def get_clip_set(path, cache_dir=None, clips=6, clip_time=4.0):
+    """
+    :param cache_dir: keep the clip set for the next runs, a temporary dir if None
+    :return: [(clip video <trans.Format>, weight), ...]
+    """
+    cache_dir = cache_dir or utils.prepare_save_path(module_name, tempfile.gettempdir())
+    clip_set = ClipCache(cache_dir).get_clips(path, clips, clip_time)
+    for clip in clip_set:
+        log.info("clip @{:.3f}s {:.3f}s weight={:.3f} complexity={:.0f}".format(
+            clip["start"], clip["duration"], clip["weight"], clip["complexity"]))
+    return [(trans.Format(clip["path"], probe=True), clip["weight"]) for clip in clip_set]
+
+
+def get_prefix(path, duration, cache_dir=None):
+    """
+    first @duration seconds of @path as a near lossless clip
+    :param cache_dir: keep the clip for the next runs, a temporary dir if None
+    :return: <trans.Format> of the clip, None if failed
+    """
+    cache_dir = cache_dir or utils.prepare_save_path(module_name, tempfile.gettempdir())
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    key = cache.make_key(cache.file_fingerprint(path), "prefix", duration)
+    clip_path = os.path.join(cache_dir, "{:s}.prefix.mkv".format(key))
+    if not os.path.isfile(clip_path):
+        # published by rename, the extension stays for the muxer
+        tmp_path = os.path.join(cache_dir, "{:s}.{:d}.{:d}.tmp.mkv".format(
+            key, os.getpid(), threading.current_thread().ident))
+        if _extract_clip(path, {"start": 0.0, "duration": duration}, tmp_path) != 0:
+            return None
+        os.rename(tmp_path, clip_path)
+    return trans.Format(clip_path, probe=True)
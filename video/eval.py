@@ -21,12 +21,20 @@ Brief
     evaluate video quality for videos already transcoded
 """
 
+import os
 import copy
 import json
+import shutil
 import logging
+from multiprocessing.pool import ThreadPool
 import utils
+import proc
+import info
 import trans
 import score
+import cache
+import sample
+import framestore
 
 module_name = "v.rd.collect"
 log = logging.getLogger(module_name)
@@ -39,26 +47,52 @@ def _dict_copy(copydict, preload={}, overwrite={}):
     return ret
 
 
-def collect_trans_quality(task_cfg, seq_cfg, trans_cfg):
+def collect_trans_quality(task_cfg, seq_cfg, trans_cfg, ori_fmt=None, ref_cache=None):
     """
     quality evaluation for transcoded video
+    :param ori_fmt: probed reference <trans.Format>, probed here if None
+    :param ref_cache: <cache.RefYuvCache> for the reference yuv, the one of the task config if None
     """
     trans_data = copy.deepcopy(trans_cfg)
     try:
         ori_path = seq_cfg["reference"]["path"]
         dis_path = trans_cfg["path"]
-        ori_fmt = trans.Format(ori_path, probe=True)
+        if ori_fmt is None:
+            ori_fmt = trans.Format(ori_path, probe=True)
+        if ref_cache is None:
+            ref_cache = cache.get_ref_yuv_cache(task_cfg.get("yuv_cache_dir"), task_cfg.get("yuv_cache_size"))
         dis_fmt = trans.Format(dis_path, probe=True)
         cmp_res = trans_cfg.get("cmp_res", seq_cfg.get("cmp_res"))
         cmp_frm = trans_cfg.get("cmp_frames", seq_cfg.get("cmp_frames"))
-        psnr, ssim, vmaf = score.get_yuv_score(
-            ori_fmt, dis_fmt, cmp_res,
-            cmp_frames=cmp_frm,
-            save_dir=seq_cfg.get("yuv_save_dir"))
+        cmp_smp = trans_cfg.get("cmp_sample", seq_cfg.get("cmp_sample"))
+        save_frm = trans_cfg.get("save_frame_scores", seq_cfg.get("save_frame_scores", False))
+        frame_scores = {} if (save_frm is True and cmp_smp is None) else None
+        score_kw = dict(
+            save_dir=seq_cfg.get("yuv_save_dir"),
+            use_pipe=trans_cfg.get("yuv_pipe", seq_cfg.get("yuv_pipe", False)),
+            backend=trans_cfg.get("score_backend", seq_cfg.get("score_backend", "auto")),
+            ref_cache=ref_cache)
+        if cmp_smp is not None:
+            psnr, ssim, vmaf, bounds = sample.get_sampled_score(
+                ori_fmt, dis_fmt, cmp_res, **_dict_copy(cmp_smp, overwrite=score_kw))
+            trans_data["score_bounds"] = bounds
+        else:
+            psnr, ssim, vmaf = score.get_yuv_score(
+                ori_fmt, dis_fmt, cmp_res,
+                cmp_frames=cmp_frm,
+                frame_scores=frame_scores,
+                vmaf_chunks=trans_cfg.get("vmaf_chunks", seq_cfg.get("vmaf_chunks")),
+                **score_kw)
         trans_data.update({
             "rate": dis_fmt.br,
             "psnr": psnr, "ssim": ssim, "vmaf": vmaf
         })
+        if frame_scores is not None:
+            # outputs of the same name in different dirs get their own file
+            frames_name = "{:s}.{:s}.frames.npz".format(
+                os.path.basename(dis_path), cache.make_key(os.path.abspath(dis_path))[:8])
+            trans_data["frame_scores"] = framestore.save_frame_scores(
+                frame_scores, frames_name, task_cfg.get("data_save_dir"))
     except Exception as e:
         log.error("Exception = `%s`", repr(e))
         raise e
@@ -66,22 +100,50 @@ def collect_trans_quality(task_cfg, seq_cfg, trans_cfg):
     return trans_data
 
 
+def _scores_through_files(seq_cfg, trans_cfg):
+    return score.scores_through_files(trans_cfg.get("yuv_pipe", seq_cfg.get("yuv_pipe", False)),
+                                      seq_cfg.get("yuv_save_dir"))
+
+
 def collect_seq_data(task_cfg, seq_cfg):
+    """
+    the reference is probed once and decoded once per cmp_res (through the task's
+    RefYuvCache, or a temporary one in yuv_save_dir for the entries scored through files,
+    piped entries stream it), the entries of trans_list are scored against it by
+    task_cfg["workers"] at a time. results keep the order of trans_list
+    """
     seq_data = copy.deepcopy(seq_cfg)
-    seq_data.update({
-        "trans_list": []
-    })
     _preload = task_cfg.get("trans_default", {})
     _overwrite = task_cfg.get("trans_overwrite", {})
-    for trans_item in seq_cfg["trans_list"]:
-        trans_cfg = _dict_copy(trans_item, _preload, _overwrite)
-        trans_data = collect_trans_quality(task_cfg, seq_cfg, trans_cfg)
-        seq_data["trans_list"].append(trans_data)
+    trans_cfgs = [_dict_copy(trans_item, _preload, _overwrite) for trans_item in seq_cfg["trans_list"]]
+    ori_fmt = trans.Format(seq_cfg["reference"]["path"], probe=True)
+    ref_cache = cache.get_ref_yuv_cache(task_cfg.get("yuv_cache_dir"), task_cfg.get("yuv_cache_size"))
+    tmp_cache = None
+    if ref_cache is None and any(_scores_through_files(seq_cfg, trans_cfg) for trans_cfg in trans_cfgs):
+        tmp_cache = cache.make_temp_ref_yuv_cache(seq_cfg.get("yuv_save_dir"), task_cfg.get("yuv_cache_size"))
+
+    def _collect(trans_cfg):
+        shared = ref_cache or (tmp_cache if _scores_through_files(seq_cfg, trans_cfg) else None)
+        return collect_trans_quality(task_cfg, seq_cfg, trans_cfg, ori_fmt, shared)
+
+    pool = ThreadPool(min(len(trans_cfgs), task_cfg.get("workers") or proc.get_max_procs()) or 1)
+    try:
+        trans_list = pool.map(_collect, trans_cfgs)
+    finally:
+        pool.terminate()
+        pool.join()
+        if tmp_cache is not None:
+            shutil.rmtree(tmp_cache.cache_dir, ignore_errors=True)
+    seq_data.update({
+        "trans_list": trans_list
+    })
     return seq_data
 
 
 def collect_task_data(task_cfg):
     assert task_cfg["data_format"] == "video.eval.task.config"
+    if task_cfg.get("probe_cache") is not None:
+        info.set_probe_cache(task_cfg["probe_cache"])
     task_data = copy.deepcopy(task_cfg)
     task_data.update({
         "data_format": "video.eval.task.result",
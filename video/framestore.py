@@ -0,0 +1,202 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    per-frame quality scores: streaming parser for vmaf json output,
+    and a compact columnar store (.npz) for them
+"""
+
+import re
+import array
+import logging
+import utils
+try:
+    import numpy as np
+except ImportError:
+    np = None       # only FrameScores needs numpy
+
+module_name = "v.framestore"
+log = logging.getLogger(module_name)
+
+AGGREGATE_PREFIX = "aggregate."
+
+_token_regex = re.compile(
+    r'"(?P<key>(?:\\.|[^"\\])*)"\s*:'
+    r'|"(?:\\.|[^"\\])*"'
+    r'|(?P<num>-?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?|-?Infinity|NaN)'
+    r'|(?P<bracket>[\[\]{}])')
+
+# sections holding per-frame values, run_vmaf and libvmaf log json
+_FRAMES_KEY = "frames"
+# sections holding pooled values, run_vmaf and libvmaf log json
+_AGGREGATE_KEYS = ("aggregate", "pooled_metrics")
+
+
+class VmafJsonParser:
+    """
+    incremental parser for `run_vmaf --out-fmt json` and libvmaf `log_fmt=json` output,
+    see doc/data_format/video.score.vmaf.json.
+    numbers are appended to typed arrays as lines come in, the json tree is never built.
+    - numbers inside "frames": one column per key, missing values are nan
+    - numbers inside "aggregate" or "pooled_metrics": dotted key path, ie. "vmaf.mean"
+    """
+    def __init__(self):
+        self.columns = {}       # key -> array('d')
+        self.aggregate = {}     # key path -> float
+        self.frames = 0
+        self._stack = []        # keys of open containers, None for array items
+        self._key = None
+
+    def _section(self):
+        if _FRAMES_KEY in self._stack:
+            return _FRAMES_KEY
+        for key in _AGGREGATE_KEYS:
+            if key in self._stack:
+                return key
+        return None
+
+    def _on_number(self, value):
+        if self._key is None:
+            return      # array of numbers, not a score
+        section = self._section()
+        if section == _FRAMES_KEY:
+            column = self.columns.get(self._key)
+            if column is None:
+                column = array.array("d", [float("nan")] * (self.frames - 1))
+                self.columns[self._key] = column
+            if len(column) < self.frames:
+                column.append(value)
+        elif section is not None:
+            start = self._stack.index(section) + 1
+            path = [k for k in self._stack[start:] if k is not None] + [self._key]
+            self.aggregate[".".join(path)] = value
+
+    def _on_open(self, bracket):
+        if bracket == "{" and self._stack and self._stack[-1] == _FRAMES_KEY:
+            self.frames += 1
+        self._stack.append(self._key)
+        self._key = None
+
+    def _on_close(self, bracket):
+        if not self._stack:
+            return
+        self._stack.pop()
+        if bracket == "}" and self._stack and self._stack[-1] == _FRAMES_KEY:
+            for column in self.columns.values():
+                while len(column) < self.frames:
+                    column.append(float("nan"))
+        self._key = None
+
+    def feed(self, line):
+        for m in _token_regex.finditer(line):
+            if m.group("key") is not None:
+                self._key = m.group("key")
+            elif m.group("num") is not None:
+                self._on_number(float(m.group("num").replace("Infinity", "inf")))
+            elif m.group("bracket") in ("[", "{"):
+                self._on_open(m.group("bracket"))
+            elif m.group("bracket") is not None:
+                self._on_close(m.group("bracket"))
+        return self
+
+    def vmaf(self):
+        """
+        :return: pooled vmaf score, or mean of per-frame vmaf if no pooled one
+        """
+        for key in ("VMAF_score", "vmaf.mean", "vmaf"):
+            if key in self.aggregate:
+                return self.aggregate[key]
+        column = self.columns.get("VMAF_score", self.columns.get("vmaf"))
+        if column:
+            return sum(column) / len(column)
+        return None
+
+    def frame_scores(self):
+        """
+        :return: <dict> per-frame columns plus "vmaf" alias, and aggregates as AGGREGATE_PREFIX + key
+        """
+        scores = dict(self.columns)
+        vmaf = self.columns.get("VMAF_score", self.columns.get("vmaf"))
+        if vmaf is not None:
+            scores["vmaf"] = vmaf
+        for key, value in self.aggregate.items():
+            scores[AGGREGATE_PREFIX + key] = value
+        return scores
+
+
+def parse_vmaf_json(lines):
+    """
+    :param lines: iterable of text lines, ie. a file or process stdout
+    :return: <VmafJsonParser>
+    """
+    parser = VmafJsonParser()
+    for line in lines:
+        parser.feed(line)
+    return parser
+
+
+class FrameScores:
+    """
+    per-frame scores of one (ref, dis) pair, saved as a compressed .npz with one array per column
+    """
+    def __init__(self, columns=None):
+        if np is None:
+            raise ImportError("FrameScores needs numpy")
+        self.columns = {}
+        for key, value in (columns or {}).items():
+            self.columns[key] = np.asarray(value, dtype=np.float64)
+
+    def __str__(self):
+        return str({k: v.shape for k, v in self.columns.items()})
+
+    def keys(self):
+        return [k for k in self.columns if not k.startswith(AGGREGATE_PREFIX)]
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **self.columns)
+        log.info("frame scores saved to " + path)
+        return path
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as npz:
+            return FrameScores({k: npz[k] for k in npz.files})
+
+    def mean(self, key):
+        return float(np.nanmean(self.columns[key]))
+
+    def harmonic_mean(self, key):
+        values = self.columns[key]
+        values = values[~np.isnan(values)]
+        return float(len(values) / np.sum(1.0 / (values + 1.0)) - 1.0)
+
+    def percentile(self, key, q):
+        return float(np.nanpercentile(self.columns[key], q))
+
+
+def save_frame_scores(frame_scores, save_name, save_dir=None):
+    """
+    :param frame_scores: <dict> filled by score.get_yuv_score()
+    :return: path of the saved .npz, or None if there is nothing to save
+    """
+    if not frame_scores:
+        log.warning("no frame scores to save for " + save_name)
+        return None
+    return FrameScores(frame_scores).save(utils.prepare_save_path(save_name, save_dir))
@@ -0,0 +1,348 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    stream info read from mp4/mov and matroska headers, in the shape of
+    `ffprobe -show_streams -of json`, without spawning ffprobe
+"""
+
+import struct
+import logging
+
+module_name = "v.header"
+log = logging.getLogger(module_name)
+
+_mp4_codecs = {
+    "avc1": "h264", "avc3": "h264", "hvc1": "hevc", "hev1": "hevc", "av01": "av1", "vp09": "vp9",
+    "mp4v": "mpeg4", "mp4a": "aac", "ac-3": "ac3", "ec-3": "eac3", "Opus": "opus", "fLaC": "flac",
+}
+_mkv_codecs = {
+    "V_MPEG4/ISO/AVC": "h264", "V_MPEGH/ISO/HEVC": "hevc", "V_AV1": "av1", "V_VP8": "vp8", "V_VP9": "vp9",
+    "A_AAC": "aac", "A_OPUS": "opus", "A_VORBIS": "vorbis", "A_AC3": "ac3", "A_EAC3": "eac3", "A_FLAC": "flac",
+}
+
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def _rate(num, den):
+    g = _gcd(num, den) or 1
+    return "{:d}/{:d}".format(num // g, den // g)
+
+
+def _iter_boxes(f, start, end):
+    """
+    :return: generator of (type, payload start, box end)
+    """
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError("bad box size")
+        yield box_type.decode("latin-1"), pos + header, pos + size
+        pos += size
+
+
+def _find_box(f, start, end, path):
+    """
+    :param path: box types from the container at [start, end), ie. ["mdia", "minf", "stbl"]
+    :return: (payload start, box end) of the last box of @path, or None
+    """
+    for box_type, payload, box_end in _iter_boxes(f, start, end):
+        if box_type == path[0]:
+            return (payload, box_end) if len(path) == 1 else _find_box(f, payload, box_end, path[1:])
+    return None
+
+
+def _read(f, box):
+    f.seek(box[0])
+    return f.read(box[1] - box[0])
+
+
+def _mp4_track(f, trak):
+    mdhd = _read(f, _find_box(f, trak[0], trak[1], ["mdia", "mdhd"]))
+    if bytearray(mdhd)[0] == 1:
+        timescale, duration = struct.unpack(">IQ", mdhd[20:32])
+    else:
+        timescale, duration = struct.unpack(">II", mdhd[12:20])
+    handler = _read(f, _find_box(f, trak[0], trak[1], ["mdia", "hdlr"]))[8:12].decode("latin-1")
+    stbl = _find_box(f, trak[0], trak[1], ["mdia", "minf", "stbl"])
+    stsd = _read(f, _find_box(f, stbl[0], stbl[1], ["stsd"]))
+    entry = stsd[8:]
+    fourcc = entry[4:8].decode("latin-1")
+
+    stsz = _read(f, _find_box(f, stbl[0], stbl[1], ["stsz"]))
+    sample_size, count = struct.unpack(">II", stsz[4:12])
+    if count == 0 or timescale == 0 or duration == 0:
+        return None     # fragmented or empty, left to ffprobe
+    total = sample_size * count if sample_size else sum(struct.unpack(">{:d}I".format(count), stsz[12:12 + 4 * count]))
+    seconds = float(duration) / timescale
+
+    stream = {
+        "codec_name": _mp4_codecs.get(fourcc, fourcc),
+        "codec_tag_string": fourcc,
+        "duration": "{:.6f}".format(seconds),
+        "nb_frames": str(count),
+        "bit_rate": str(int(total * 8 / seconds)),
+    }
+    if handler == "vide":
+        width, height = struct.unpack(">HH", entry[32:36])
+        stts = _read(f, _find_box(f, stbl[0], stbl[1], ["stts"]))
+        n = struct.unpack(">I", stts[4:8])[0]
+        runs = [struct.unpack(">II", stts[8 + 8 * i:16 + 8 * i]) for i in range(n)]
+        # the sample delta covering most samples gives the frame rate
+        delta = max(runs, key=lambda r: r[0])[1] if runs else 0
+        stream.update({
+            "codec_type": "video",
+            "width": width, "height": height, "coded_width": width, "coded_height": height,
+            "r_frame_rate": _rate(timescale, delta) if delta else "0/0",
+        })
+    elif handler == "soun":
+        channels = struct.unpack(">H", entry[24:26])[0]
+        sample_rate = struct.unpack(">I", entry[32:36])[0] >> 16
+        stream.update({"codec_type": "audio", "channels": channels, "sample_rate": str(sample_rate)})
+    else:
+        return None
+    return stream
+
+
+def _probe_mp4(f, size):
+    moov = _find_box(f, 0, size, ["moov"])
+    if moov is None:
+        return None
+    streams = []
+    for box_type, payload, box_end in _iter_boxes(f, moov[0], moov[1]):
+        if box_type == "mvex":
+            return None     # fragmented, sample tables are in the fragments
+        if box_type == "trak":
+            stream = _mp4_track(f, (payload, box_end))
+            if stream is not None:
+                stream["index"] = len(streams)
+                streams.append(stream)
+    return {"streams": streams}
+
+
+def _mp4_sample_tables(f, trak):
+    mdhd = _read(f, _find_box(f, trak[0], trak[1], ["mdia", "mdhd"]))
+    timescale = struct.unpack(">I", mdhd[20:24] if bytearray(mdhd)[0] == 1 else mdhd[12:16])[0]
+    stbl = _find_box(f, trak[0], trak[1], ["mdia", "minf", "stbl"])
+    stsz = _read(f, _find_box(f, stbl[0], stbl[1], ["stsz"]))
+    sample_size, count = struct.unpack(">II", stsz[4:12])
+    tables = {"timescale": timescale, "count": count, "sample_size": sample_size,
+              "stsz": stsz[12:12 + 4 * count] if not sample_size else None, "media_time": 0}
+    for name in ("stts", "ctts", "stss"):
+        box = _find_box(f, stbl[0], stbl[1], [name])
+        # entries after the fullbox header and the entry count
+        tables[name] = _read(f, box)[8:] if box is not None else None
+    elst = _find_box(f, trak[0], trak[1], ["edts", "elst"])
+    if elst is not None:
+        data = _read(f, elst)
+        v1 = bytearray(data)[0] == 1
+        entry_size = 20 if v1 else 12
+        for i in range(struct.unpack(">I", data[4:8])[0]):
+            entry = data[8 + i * entry_size:8 + (i + 1) * entry_size]
+            media_time = struct.unpack(">q" if v1 else ">i", entry[8:16] if v1 else entry[4:8])[0]
+            if media_time != -1:        # -1 is an empty edit
+                tables["media_time"] = media_time
+                break
+    return tables
+
+
+def sample_tables(path, codec_type="video"):
+    """
+    raw sample tables of the first @codec_type track of a local mp4/mov file
+    :return: {"timescale", "count", "sample_size", "media_time", "stsz", "stts", "ctts", "stss"},
+             the table entries are big endian bytes after the entry count, None if absent.
+             None if @path is not a non-fragmented mp4 or has no such track
+    """
+    handler = {"video": "vide", "audio": "soun"}[codec_type]
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(0)
+            if f.read(12)[4:8] not in (b"ftyp", b"moov", b"mdat", b"free", b"wide"):
+                return None
+            moov = _find_box(f, 0, size, ["moov"])
+            if moov is None or _find_box(f, moov[0], moov[1], ["mvex"]) is not None:
+                return None
+            for box_type, payload, box_end in _iter_boxes(f, moov[0], moov[1]):
+                hdlr = _find_box(f, payload, box_end, ["mdia", "hdlr"]) if box_type == "trak" else None
+                if hdlr is not None and _read(f, hdlr)[8:12].decode("latin-1") == handler:
+                    tables = _mp4_sample_tables(f, (payload, box_end))
+                    return tables if tables["count"] and tables["stts"] else None
+    except (IOError, OSError, ValueError, struct.error, TypeError) as e:
+        log.debug("sample tables failed for " + path + ", " + str(e))
+    return None
+
+
+def _read_vint(f, keep_marker=False):
+    """
+    :return: (value, unknown size), ebml ids keep their length marker
+    """
+    data = bytearray(f.read(1))
+    if not data:
+        raise EOFError()
+    first, mask, length = data[0], 0x80, 1
+    while length <= 8 and not (first & mask):
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError("bad ebml vint")
+    value = first if keep_marker else first & (mask - 1)
+    for c in bytearray(f.read(length - 1)):
+        value = (value << 8) | c
+    return value, (not keep_marker and value == (1 << (7 * length)) - 1)
+
+
+def _iter_elements(f, start, end):
+    """
+    :return: generator of (id, payload start, element end), end is None for an unknown size
+    """
+    pos = start
+    while end is None or pos < end:
+        f.seek(pos)
+        try:
+            element_id, _ = _read_vint(f, keep_marker=True)
+            size, unknown = _read_vint(f)
+        except EOFError:
+            return
+        payload = f.tell()
+        yield element_id, payload, (None if unknown else payload + size)
+        if unknown:
+            return
+        pos = payload + size
+
+
+def _ebml_value(f, payload, end, kind):
+    f.seek(payload)
+    data = f.read(end - payload)
+    if kind == "float":
+        return struct.unpack(">f" if len(data) == 4 else ">d", data)[0]
+    if kind == "str":
+        return data.decode("utf-8", "replace").rstrip("\x00")
+    value = 0
+    for c in bytearray(data):
+        value = (value << 8) | c
+    return value
+
+
+def _mkv_track(f, payload, end):
+    track = {}
+    for element_id, p, e in _iter_elements(f, payload, end):
+        if element_id == 0x83:
+            track["type"] = _ebml_value(f, p, e, "uint")
+        elif element_id == 0x86:
+            track["codec"] = _ebml_value(f, p, e, "str")
+        elif element_id == 0x23E383:
+            track["default_duration"] = _ebml_value(f, p, e, "uint")
+        elif element_id in (0xE0, 0xE1):
+            for sub_id, sp, se in _iter_elements(f, p, e):
+                if sub_id == 0xB0:
+                    track["width"] = _ebml_value(f, sp, se, "uint")
+                elif sub_id == 0xBA:
+                    track["height"] = _ebml_value(f, sp, se, "uint")
+                elif sub_id == 0xB5:
+                    track["sample_rate"] = _ebml_value(f, sp, se, "float")
+                elif sub_id == 0x9F:
+                    track["channels"] = _ebml_value(f, sp, se, "uint")
+    return track
+
+
+def _probe_mkv(f, size):
+    timecode_scale, duration, tracks = 1000000, None, None
+    for element_id, payload, end in _iter_elements(f, 0, size):
+        if element_id != 0x18538067:        # Segment
+            continue
+        for child_id, p, e in _iter_elements(f, payload, end or size):
+            if e is None:
+                break
+            if child_id == 0x1549A966:      # Info
+                for info_id, ip, ie in _iter_elements(f, p, e):
+                    if info_id == 0x2AD7B1:
+                        timecode_scale = _ebml_value(f, ip, ie, "uint")
+                    elif info_id == 0x4489:
+                        duration = _ebml_value(f, ip, ie, "float")
+            elif child_id == 0x1654AE6B:    # Tracks
+                tracks = [_mkv_track(f, tp, te) for track_id, tp, te in _iter_elements(f, p, e)
+                          if track_id == 0xAE and te is not None]
+            elif child_id == 0x1F43B675:    # Cluster, the headers are done
+                break
+            if tracks is not None and duration is not None:
+                break
+        break
+    if not tracks:
+        return None
+
+    streams = []
+    for track in tracks:
+        stream = {"index": len(streams), "codec_name": _mkv_codecs.get(track.get("codec"), track.get("codec"))}
+        if duration is not None:
+            stream["duration"] = "{:.6f}".format(duration * timecode_scale / 1e9)
+        if track.get("type") == 1:
+            stream.update({"codec_type": "video", "width": track.get("width"), "height": track.get("height"),
+                           "coded_width": track.get("width"), "coded_height": track.get("height")})
+            if track.get("default_duration"):
+                stream["r_frame_rate"] = _rate(1000000000, track["default_duration"])
+        elif track.get("type") == 2:
+            stream.update({"codec_type": "audio", "channels": track.get("channels"),
+                           "sample_rate": str(int(track.get("sample_rate", 0)))})
+        else:
+            continue
+        streams.append(stream)
+    if len(streams) == 1 and streams[0]["codec_type"] == "video" and duration:
+        # matroska keeps no bitrate, a video only file (ie. a clip) has the one of the whole file
+        seconds = duration * timecode_scale / 1e9
+        streams[0]["bit_rate"] = str(int(size * 8 / seconds))
+    return {"streams": streams}
+
+
+def probe(path):
+    """
+    read the stream info of a local mp4/mov or matroska/webm file from its headers
+    :return: ffprobe-like object {"streams": [...]}, or None if the file is not handled
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(0)
+            magic = f.read(12)
+            if magic[:4] == b"\x1a\x45\xdf\xa3":
+                vinfo = _probe_mkv(f, size)
+            elif magic[4:8] in (b"ftyp", b"moov", b"mdat", b"free", b"wide"):
+                vinfo = _probe_mp4(f, size)
+            else:
+                return None
+    except (IOError, OSError, ValueError, EOFError, struct.error, TypeError) as e:
+        log.debug("header probe failed for " + path + ", " + str(e))
+        return None
+    if not vinfo or not any(s.get("codec_type") == "video" for s in vinfo["streams"]):
+        return None
+    return vinfo
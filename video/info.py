@@ -25,12 +25,21 @@ import os,time,sys
 import subprocess
 import json
 import logging
+import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
+import proc
+import header
 import cfg.tools
 
 FFPROBE = cfg.tools.ffprobe
 module_name = "v.info"
 log = logging.getLogger(module_name)
 
+# stream fields read by Media
+STREAM_ENTRIES = ("codec_type", "codec_name", "coded_width", "coded_height", "bit_rate", "nb_frames",
+                  "r_frame_rate", "duration", "sample_rate", "channels")
+
 
 def ffprobe_test(ffprobe):
     import subprocess
@@ -45,7 +54,163 @@ def ffprobe_test(ffprobe):
     return True
 
 
-def probe_info(video):
+class ProbeCache:
+    """
+    parsed ffprobe json in a sqlite db, keyed by path and probe args, valid while
+    the file keeps its size, mtime and inode. binary data derived from the file,
+    like the packet index, is kept the same way by get_blob()/put_blob().
+    every thread of every process opens its own connection, the db is in wal mode
+    so readers never wait for a writer
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def __str__(self):
+        return str({"db_path": self.db_path})
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS probe (path TEXT, args TEXT, size INTEGER, mtime REAL, "
+                         "inode INTEGER, data TEXT, PRIMARY KEY (path, args))")
+            conn.execute("CREATE TABLE IF NOT EXISTS blob (path TEXT, args TEXT, size INTEGER, mtime REAL, "
+                         "inode INTEGER, data BLOB, PRIMARY KEY (path, args))")
+            conn.commit()
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def _identity(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None     # net streams are not cached
+        return os.path.realpath(path), st.st_size, st.st_mtime, st.st_ino
+
+    def _get(self, table, path, args):
+        identity = self._identity(path)
+        if identity is None:
+            return None
+        row = self._conn().execute("SELECT size, mtime, inode, data FROM {:s} WHERE path=? AND args=?".format(table),
+                                   (identity[0], args)).fetchone()
+        if row is None or tuple(row[:3]) != identity[1:]:
+            return None
+        return row[3]
+
+    def _put(self, table, path, args, data):
+        identity = self._identity(path)
+        if identity is None:
+            return
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO {:s} VALUES (?, ?, ?, ?, ?, ?)".format(table),
+                         identity[:1] + (args,) + identity[1:] + (data,))
+
+    def get(self, path, args):
+        """
+        :return: probe data, None if missing or the file changed
+        """
+        data = self._get("probe", path, args)
+        return json.loads(data) if data is not None else None
+
+    def put(self, path, args, data):
+        self._put("probe", path, args, json.dumps(data))
+
+    def get_blob(self, path, args):
+        """
+        :return: binary data stored by put_blob(), None if missing or the file changed
+        """
+        data = self._get("blob", path, args)
+        return bytes(data) if data is not None else None
+
+    def put_blob(self, path, args, data):
+        self._put("blob", path, args, sqlite3.Binary(data))
+
+    def invalidate(self, path=None):
+        """
+        drop the entries of @path, or all entries if None
+        """
+        conn = self._conn()
+        with conn:
+            for table in ("probe", "blob"):
+                if path is None:
+                    conn.execute("DELETE FROM " + table)
+                else:
+                    conn.execute("DELETE FROM " + table + " WHERE path=?", (os.path.realpath(path),))
+
+
+_probe_cache = None
+_header_probe = True
+
+
+def set_probe_cache(db_path):
+    """
+    cache probe_info() results in the sqlite db @db_path for this process, None to disable
+    """
+    global _probe_cache
+    _probe_cache = ProbeCache(db_path) if db_path is not None else None
+    log.info("probe cache = " + str(_probe_cache))
+
+
+def get_probe_cache():
+    """
+    :return: <ProbeCache> set by set_probe_cache(), or None
+    """
+    return _probe_cache
+
+
+def invalidate_probe_cache(path=None):
+    """
+    drop cached probe data of @path, or all of it if None
+    """
+    if _probe_cache is not None:
+        _probe_cache.invalidate(path)
+
+
+def set_header_probe(enabled):
+    """
+    read mp4/mov/matroska headers in python before asking ffprobe, on by default
+    """
+    global _header_probe
+    _header_probe = bool(enabled)
+
+
+def _probe_header(video, entries):
+    # the header parser fills STREAM_ENTRIES only, full probes go to ffprobe
+    if not _header_probe or entries is None or not set(entries) <= set(STREAM_ENTRIES):
+        return None
+    if not os.path.isfile(video):
+        return None
+    return header.probe(video)
+
+
+def _run_ffprobe(video, args):
+    if _probe_cache is not None:
+        vinfo = _probe_cache.get(video, " ".join(args))
+        if vinfo is not None:
+            return vinfo
+    command = [FFPROBE] + args + [video]
+    returncode, output, error = proc.run(command)
+    if returncode:
+        log.error("error[{:d}]: \n{:s}".format(returncode, error))
+        return None
+    log.debug("\n" + output + error)
+    vinfo = json.loads(output)
+    if _probe_cache is not None:
+        _probe_cache.put(video, " ".join(args), vinfo)
+    return vinfo
+
+
+def probe_info(video, entries=None):
+    """
+    :param entries: stream fields to ask ffprobe for, ie. STREAM_ENTRIES. all fields if None.
+                    for STREAM_ENTRIES of local mp4/mov/matroska files the headers are read
+                    by the header module, ffprobe runs only if they can't be parsed
+    :return: ffprobe json object with "streams"
+    """
     # incase of netstream
     '''
     if not os.path.exists(video):
@@ -53,16 +218,13 @@ def probe_info(video):
         return None
     '''
     try:
-        command = [FFPROBE] + "-hide_banner -show_streams -of json".split() + [video]
-        log.debug("subprocess = " + str(command))
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-        output, error = process.communicate()
-        if process.returncode:
-            log.error("error[{:d}]: \n{:s}".format(process.returncode, error))
-            return None
-        log.debug("\n" + output + error)
-        vinfo = json.loads(output)
-        return vinfo
+        vinfo = _probe_header(video, entries)
+        if vinfo is not None:
+            return vinfo
+        if entries is None:
+            return _run_ffprobe(video, "-hide_banner -show_streams -of json".split())
+        return _run_ffprobe(video, ["-hide_banner", "-v", "error", "-show_entries",
+                                    "stream=" + ",".join(entries), "-of", "json"])
     except Exception as e:
         log.error("Exception = `%s`", str(e));
         raise e
@@ -70,6 +232,36 @@ def probe_info(video):
     return None
 
 
+def probe_info_async(video, entries=None):
+    """
+    :return: <proc.Job> of probe_info()
+    """
+    return proc.submit(probe_info, video, entries)
+
+
+def probe_batch(paths, entries=STREAM_ENTRIES, jobs=None):
+    """
+    probe @paths concurrently, results are yielded as they complete, not in the order of @paths
+    :param entries: see probe_info()
+    :param jobs: probes in flight, the proc slot count if None
+    :return: generator of (path, <Media>), Media.probe_obj is None if the probe failed
+    """
+    def _probe(path):
+        try:
+            return path, probe_info(path, entries)
+        except Exception as e:
+            log.error("fail to probe " + path + ", " + str(e))
+            return path, None
+
+    pool = ThreadPool(jobs or proc.get_max_procs())
+    try:
+        for path, probe_obj in pool.imap_unordered(_probe, paths):
+            yield path, Media(path).from_probe_obj(probe_obj)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 class Audio:
     def __init__(self):
         self.codec = ""
@@ -97,16 +289,33 @@ class Video:
 
 
 class Media:
-    def __init__(self, path=None, probe=False):
+    def __init__(self, path=None, probe=False, entries=None):
+        """
+        :param probe: True to probe now, "lazy" to probe when video, audio or probe_obj is first read
+        :param entries: see probe_info()
+        """
         self.path = path
         self.t = 0.0                # time in ms
+        self.entries = entries
         self.audio = Audio()
         self.video = Video()
         self.probe_obj = None
 
-        if path is not None and probe is not False:
+        if path is not None and probe == "lazy":
+            del self.audio, self.video, self.probe_obj
+        elif path is not None and probe is not False:
             self.probe_info()
 
+    def __getattr__(self, name):
+        # only called for missing attributes, which are the lazy ones
+        if name not in ("audio", "video", "probe_obj"):
+            raise AttributeError(name)
+        self.audio = Audio()
+        self.video = Video()
+        self.probe_obj = None
+        self.probe_info()
+        return getattr(self, name)
+
     def __str__(self):
         return str({"video": str(self.video), "audio": str(self.audio)})
 
@@ -139,19 +348,29 @@ class Media:
                 self._set_ffprobe_audio(strm)
 
     def probe_info(self):
-        self.probe_obj = probe_info(self.path)
+        self.probe_obj = probe_info(self.path, self.entries)
         if self.probe_obj is not None:
             self._set_ffprobe_info(self.probe_obj)
         else:
             log.error("fail to probe " + self.path)
         return self.probe_obj
 
+    def from_probe_obj(self, probe_obj):
+        """
+        set media info from an object returned by probe_info()
+        """
+        self.probe_obj = probe_obj
+        if probe_obj is not None:
+            self._set_ffprobe_info(probe_obj)
+        return self
+
 
 def _main_parser():
     from optparse import OptionParser
     parser = OptionParser()
     parser.add_option("-v", "--video", dest="video", help=r"video path")
     parser.add_option("-i", "--input", dest="video", help=r"video path")
+    parser.add_option("-b", "--batch", dest="batch", help=r"probe every file in this dir")
     return parser
 
 
@@ -168,6 +387,11 @@ if __name__ == "__main__":
     _create_module_log()
     parser = _main_parser()
     (opt, args) = parser.parse_args()
+    if opt.batch is not None:
+        files = [os.path.join(opt.batch, name) for name in sorted(os.listdir(opt.batch))]
+        for path, mi in probe_batch([f for f in files if os.path.isfile(f)]):
+            print ("FAIL" if mi.probe_obj is None else "OK"), path, str(mi.video)
+        sys.exit(0)
     mi = Media(opt.video)
     probe_obj = mi.probe_info()
     print json.dumps(probe_obj, indent=4)
@@ -0,0 +1,167 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    psnr/ssim of raw yuv420p frames computed in-process by numpy,
+    numbers follow ffmpeg's psnr and ssim filters
+"""
+
+import collections
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import trans
+
+module_name = "v.metric"
+log = logging.getLogger(module_name)
+
+PLANES = ("y", "u", "v")
+_MAX = 255
+
+
+def _split_planes(frames, w, h):
+    """
+    :param frames: <np.ndarray> (n, frame_bytes) uint8
+    :return: [y, u, v] views of shape (n, ph, pw)
+    """
+    n = frames.shape[0]
+    cw, ch = trans.yuv420p_chroma_size(w, h)
+    y = frames[:, :w * h].reshape(n, h, w)
+    u = frames[:, w * h:w * h + cw * ch].reshape(n, ch, cw)
+    v = frames[:, w * h + cw * ch:].reshape(n, ch, cw)
+    return [y, u, v]
+
+
+def _plane_mse(ref, dis):
+    diff = ref.astype(np.int32) - dis.astype(np.int32)
+    return (diff * diff).reshape(ref.shape[0], -1).mean(axis=1)
+
+
+def _block4x4_sum(plane, hb, wb):
+    n = plane.shape[0]
+    return plane[:, :hb * 4, :wb * 4].reshape(n, hb, 4, wb, 4).sum(axis=(2, 4), dtype=np.int64)
+
+
+def _plane_ssim(ref, dis):
+    """
+    ssim over 8x8 windows at a stride of 4, like ffmpeg's ssim filter
+    :return: per-frame ssim <np.ndarray> (n,)
+    """
+    n, h, w = ref.shape
+    hb, wb = h // 4, w // 4
+    if hb < 2 or wb < 2:
+        return np.ones(n)
+    a = ref.astype(np.uint16)
+    b = dis.astype(np.uint16)
+    # products of 8bit samples fit in uint16, their sums don't
+    sums = [_block4x4_sum(x, hb, wb) for x in (a, b, a * a, b * b, a * b)]
+    # 2x2 neighbouring 4x4 blocks make one 8x8 window
+    s1, s2, saa, sbb, s12 = [(x[:, :-1, :-1] + x[:, 1:, :-1] + x[:, :-1, 1:] + x[:, 1:, 1:]).astype(np.float64)
+                             for x in sums]
+    ss = saa + sbb
+    c1 = int(.01 * .01 * _MAX * _MAX * 64 + .5)
+    c2 = int(.03 * .03 * _MAX * _MAX * 64 * 63 + .5)
+    var = ss * 64 - s1 * s1 - s2 * s2
+    covar = s12 * 64 - s1 * s2
+    ssim = (2 * s1 * s2 + c1) * (2 * covar + c2) / ((s1 * s1 + s2 * s2 + c1) * (var + c2))
+    return ssim.reshape(n, -1).mean(axis=1)
+
+
+def _score_batch(args):
+    ref, dis, w, h = args
+    ref_planes = _split_planes(ref, w, h)
+    dis_planes = _split_planes(dis, w, h)
+    mse = np.stack([_plane_mse(r, d) for r, d in zip(ref_planes, dis_planes)], axis=1)
+    ssim = np.stack([_plane_ssim(r, d) for r, d in zip(ref_planes, dis_planes)], axis=1)
+    return mse, ssim
+
+
+def _mse_to_psnr(mse):
+    with np.errstate(divide="ignore"):
+        return 10 * np.log10(float(_MAX * _MAX) / mse)
+
+
+def _read_batches(ref_file, dis_file, w, h, batch, max_frames=None):
+    size = trans.yuv420p_frame_bytes(w, h)
+    count = 0
+    while max_frames is None or count < max_frames:
+        n = batch if max_frames is None else min(batch, max_frames - count)
+        ref = ref_file.read(size * n)
+        dis = dis_file.read(size * n)
+        n = min(len(ref), len(dis)) // size
+        if n == 0:
+            break
+        count += n
+        yield (np.frombuffer(ref[:n * size], np.uint8).reshape(n, size),
+               np.frombuffer(dis[:n * size], np.uint8).reshape(n, size))
+
+
+def yuv_score(ref_yuv, dis_yuv, w, h, max_frames=None, batch=8, jobs=None):
+    """
+    per-frame and aggregate psnr/ssim of two yuv420p files.
+    both files are read sequentially, so named pipes work as well.
+    :param batch: frames per task of the thread pool
+    :param jobs: threads, cpu count if None
+    :return: <dict> per-frame arrays "psnr_y/u/v", "psnr", "ssim_y/u/v", "ssim" and
+             aggregates "psnr_avg", "ssim_avg", "frames". psnr_avg is taken from the mean mse
+             like ffmpeg, and "psnr"/"ssim" weight planes by pixel count.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = ThreadPool(jobs)
+    pending = collections.deque()
+    mse_list, ssim_list = [], []
+    try:
+        with open(ref_yuv, "rb") as ref_file, open(dis_yuv, "rb") as dis_file:
+            for ref, dis in _read_batches(ref_file, dis_file, w, h, batch, max_frames):
+                pending.append(pool.apply_async(_score_batch, ((ref, dis, w, h),)))
+                # bound the frames in memory
+                while len(pending) >= 2 * jobs:
+                    mse, ssim = pending.popleft().get()
+                    mse_list.append(mse)
+                    ssim_list.append(ssim)
+            while pending:
+                mse, ssim = pending.popleft().get()
+                mse_list.append(mse)
+                ssim_list.append(ssim)
+    finally:
+        pool.close()
+        pool.join()
+
+    if not mse_list:
+        log.error("no frame to compare in " + ref_yuv + " and " + dis_yuv)
+        return None
+    mse = np.concatenate(mse_list)
+    ssim = np.concatenate(ssim_list)
+    cw, ch = trans.yuv420p_chroma_size(w, h)
+    weight = np.array([w * h, cw * ch, cw * ch], np.float64)
+    weight /= weight.sum()
+    mse_all = mse.dot(weight)
+    ssim_all = ssim.dot(weight)
+
+    result = {"frames": mse.shape[0]}
+    for i, plane in enumerate(PLANES):
+        result["psnr_" + plane] = _mse_to_psnr(mse[:, i])
+        result["ssim_" + plane] = ssim[:, i]
+    result["psnr"] = _mse_to_psnr(mse_all)
+    result["ssim"] = ssim_all
+    result["psnr_avg"] = float(_mse_to_psnr(mse_all.mean()))
+    result["ssim_avg"] = float(ssim_all.mean())
+    log.info("psnr={:f}, ssim={:f}, frames={:d}".format(result["psnr_avg"], result["ssim_avg"], result["frames"]))
+    return result
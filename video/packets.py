@@ -0,0 +1,262 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    per-stream packet index (pts, dts, size, keyframe) as numpy arrays, read
+    from mp4 sample tables or streamed from `ffprobe -show_packets`, kept in
+    the probe cache. bitrate, bitrate over time and keyframes come from it.
+"""
+
+import os
+import sys
+import array
+import logging
+import proc
+import info
+import header
+import cfg.tools
+try:
+    import numpy as np
+except ImportError:
+    np = None       # no packet index without numpy, callers fall back to ffprobe fields
+
+FFPROBE = cfg.tools.ffprobe
+module_name = "v.packets"
+log = logging.getLogger(module_name)
+
+# one record per packet in decoding order, times in seconds, nan if unknown
+_dtype = [("pts", "<f8"), ("dts", "<f8"), ("size", "<i4"), ("key", "?")]
+_codec_types = {"v": "video", "a": "audio"}
+
+
+class PacketIndex:
+    """
+    packets of one stream, in decoding order
+    """
+    def __init__(self, packets):
+        """
+        :param packets: numpy record array of _dtype
+        """
+        self.packets = packets
+
+    def __len__(self):
+        return len(self.packets)
+
+    def __str__(self):
+        return str({"packets": len(self), "duration": self.duration(), "bit_rate": self.bit_rate()})
+
+    @property
+    def pts(self):
+        return self.packets["pts"]
+
+    @property
+    def dts(self):
+        return self.packets["dts"]
+
+    @property
+    def size(self):
+        return self.packets["size"]
+
+    @property
+    def key(self):
+        return self.packets["key"]
+
+    def _times(self):
+        # pts, or dts for packets without one
+        return np.where(np.isnan(self.pts), self.dts, self.pts)
+
+    def duration(self):
+        """
+        :return: presentation time from the first packet to the end of the last one, in seconds
+        """
+        times = np.sort(self._times()[~np.isnan(self._times())])
+        if len(times) < 2:
+            return 0.0
+        return float(times[-1] - times[0] + np.median(np.diff(times)))
+
+    def bit_rate(self):
+        """
+        :return: average bitrate in bits/s, 0 if unknown
+        """
+        duration = self.duration()
+        return int(self.size.sum(dtype=np.int64) * 8 / duration) if duration > 0 else 0
+
+    def bitrate_windows(self, window=1.0):
+        """
+        :param window: window length in seconds
+        :return: (window start times, bitrate of each window in bits/s)
+        """
+        times = self._times()
+        valid = ~np.isnan(times)
+        if not valid.any():
+            return np.zeros(0), np.zeros(0)
+        idx = ((times[valid] - times[valid].min()) // window).astype(np.int64)
+        bits = np.bincount(idx, weights=self.size[valid] * 8.0)
+        return np.arange(len(bits)) * window, bits / window
+
+    def keyframes(self):
+        """
+        :return: sorted presentation times of the keyframes in seconds
+        """
+        times = self._times()[self.key]
+        return np.sort(times[~np.isnan(times)])
+
+    def to_bytes(self):
+        return self.packets.tobytes()
+
+    @staticmethod
+    def from_bytes(data):
+        return PacketIndex(np.frombuffer(data, dtype=_dtype))
+
+    @staticmethod
+    def from_columns(pts, dts, size, key):
+        packets = np.empty(len(size), dtype=_dtype)
+        packets["pts"], packets["dts"], packets["size"], packets["key"] = pts, dts, size, key
+        return PacketIndex(packets)
+
+
+def _runs(table, count):
+    """
+    expand (count, value) runs of a stts/ctts table to @count values
+    """
+    runs = np.frombuffer(table, dtype=">u4").reshape(-1, 2)
+    values = np.frombuffer(table, dtype=">i4").reshape(-1, 2)[:, 1]    # ctts v1 offsets are signed
+    return np.repeat(values.astype(np.int64), runs[:, 0])[:count]
+
+
+def _from_sample_tables(tables):
+    count = tables["count"]
+    deltas = _runs(tables["stts"], count)
+    if len(deltas) != count:
+        return None
+    dts = np.concatenate(([0], np.cumsum(deltas)[:-1])) - tables["media_time"]
+    pts = dts.copy()
+    if tables["ctts"]:
+        offsets = _runs(tables["ctts"], count)
+        if len(offsets) != count:
+            return None
+        pts += offsets
+    if tables["sample_size"]:
+        size = np.full(count, tables["sample_size"], dtype=np.int64)
+    else:
+        size = np.frombuffer(tables["stsz"], dtype=">u4")
+    if tables["stss"] is None:
+        key = np.ones(count, dtype=bool)    # no sync sample table, every sample is a sync sample
+    else:
+        key = np.zeros(count, dtype=bool)
+        key[np.frombuffer(tables["stss"], dtype=">u4").astype(np.int64) - 1] = True
+    timescale = float(tables["timescale"])
+    return PacketIndex.from_columns(pts / timescale, dts / timescale, size, key)
+
+
+def _from_ffprobe(path, stream):
+    # typed arrays keep a few bytes per packet, so hours of packets fit in memory
+    pts, dts, size, key = array.array("d"), array.array("d"), array.array("i"), array.array("b")
+
+    def _time(value):
+        try:
+            return float(value)
+        except ValueError:
+            return float("nan")     # N/A
+
+    def _on_line(line):
+        fields = line.strip().split(",")
+        if len(fields) < 4 or not fields[2].isdigit():
+            return
+        pts.append(_time(fields[0]))
+        dts.append(_time(fields[1]))
+        size.append(int(fields[2]))
+        key.append("K" in fields[3])
+
+    command = [FFPROBE, "-v", "error", "-select_streams", stream + ":0",
+               "-show_entries", "packet=pts_time,dts_time,size,flags", "-of", "csv=p=0", path]
+    returncode, _, error = proc.run(command, on_stdout=_on_line)
+    if returncode:
+        log.error("error[{:d}]: \n{:s}".format(returncode, error))
+        return None
+    return PacketIndex.from_columns(np.asarray(pts, dtype=np.float64), np.asarray(dts, dtype=np.float64),
+                                    np.asarray(size, dtype=np.int32), np.asarray(key, dtype=bool))
+
+
+def get_index(path, stream="v", scan=True):
+    """
+    :param stream: "v" for the first video stream, "a" for the first audio stream
+    :param scan: False not to fall back to `ffprobe -show_packets`, which reads the whole file
+    :return: <PacketIndex>, None if numpy is missing or the packets can't be read
+    """
+    if np is None:
+        log.warning("numpy is not installed, no packet index")
+        return None
+    probe_cache = info.get_probe_cache()
+    args = "packets " + stream
+    if probe_cache is not None:
+        data = probe_cache.get_blob(path, args)
+        if data is not None:
+            return PacketIndex.from_bytes(data)
+
+    index = None
+    tables = header.sample_tables(path, _codec_types[stream]) if os.path.isfile(path) else None
+    if tables is not None:
+        try:
+            index = _from_sample_tables(tables)
+        except (ValueError, IndexError) as e:
+            log.warning("bad sample tables in " + path + ", " + str(e))
+    if index is None and scan:
+        index = _from_ffprobe(path, stream)
+    if index is not None and probe_cache is not None:
+        probe_cache.put_blob(path, args, index.to_bytes())
+    return index
+
+
+def get_bit_rate(path, stream="v", scan=True):
+    """
+    :param scan: see get_index()
+    :return: average bitrate of @stream in bits/s, None if unknown
+    """
+    index = get_index(path, stream, scan)
+    return index.bit_rate() if index is not None and len(index) else None
+
+
+def _main_parser():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("-i", "--input", dest="video", help=r"video path")
+    parser.add_option("-s", "--stream", dest="stream", default="v", help=r"v or a")
+    parser.add_option("-w", "--window", dest="window", type="float", default=1.0,
+                      help=r"bitrate window in seconds")
+    return parser
+
+
+def _create_module_log():
+    import logger
+    logger.log2file(module_name + ".log", logging.INFO)
+    logger.log2stdout(module_name)
+
+if __name__ == "__main__":
+    _create_module_log()
+    parser = _main_parser()
+    (opt, args) = parser.parse_args()
+    index = get_index(opt.video, opt.stream)
+    if index is None:
+        sys.exit(1)
+    print str(index)
+    print "keyframes", list(index.keyframes())
+    for start, bps in zip(*index.bitrate_windows(opt.window)):
+        print "{:10.3f} {:10.0f}".format(start, bps)
+    log.info("done")
@@ -0,0 +1,194 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    shared runner for external tools (ffmpeg, ffprobe, run_vmaf).
+    every process runs in one of a bounded number of slots, callers overlap
+    their tool calls by submit() and collect them by Job.result()
+"""
+
+import logging
+import multiprocessing
+import subprocess
+import threading
+import traceback
+
+module_name = "v.proc"
+log = logging.getLogger(module_name)
+
+_slots = threading.BoundedSemaphore(multiprocessing.cpu_count())
+_max_procs = multiprocessing.cpu_count()
+
+
+def set_max_procs(n):
+    """
+    :param n: processes allowed to run at the same time, cpu count if None or 0.
+              processes already running keep their slots
+    """
+    global _slots, _max_procs
+    _max_procs = int(n or multiprocessing.cpu_count())
+    _slots = threading.BoundedSemaphore(_max_procs)
+    log.info("max_procs = {:d}".format(_max_procs))
+
+
+def get_max_procs():
+    return _max_procs
+
+
+class _Slot:
+    def __enter__(self):
+        self.slots = _slots
+        self.slots.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.slots.release()
+        return False
+
+
+def _kill(process):
+    if process.poll() is None:
+        try:
+            process.kill()
+        except OSError:
+            pass    # exited meanwhile
+
+
+def _drain(stream, on_line, lines, process, errors):
+    for line in iter(stream.readline, ""):
+        if on_line is None:
+            lines.append(line)
+            continue
+        try:
+            stop = on_line(line) is True
+        except Exception as e:
+            log.error("line callback failed, kill the process\n{:s}".format(traceback.format_exc()))
+            errors.append(e)
+            # the pipe is still drained, a full one would block the process before it dies
+            on_line, stop = (lambda line: None), True
+        if stop:
+            _kill(process)
+    stream.close()
+
+
+def run(cmdargs, on_stdout=None, on_stderr=None):
+    """
+    run @cmdargs in a slot and wait for it
+    :param on_stdout: on_stdout(line) called for each stdout line as it comes, the process
+                      is killed if it returns True. the output is collected and returned if None
+    :param on_stderr: like @on_stdout for stderr
+    :return: (returncode, stdout, stderr), "" for the streams given to a callback.
+             an exception of a callback kills the process and is raised once it is waited for
+    """
+    errors = []
+    with _Slot():
+        log.info("subprocess = " + ' '.join(cmdargs))
+        process = subprocess.Popen(cmdargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   universal_newlines=True, shell=False)
+        out_lines, err_lines = [], []
+        # both pipes have to be drained at the same time, or a full one blocks the process
+        err_thread = threading.Thread(target=_drain, args=(process.stderr, on_stderr, err_lines, process, errors))
+        err_thread.daemon = True
+        err_thread.start()
+        try:
+            _drain(process.stdout, on_stdout, out_lines, process, errors)
+        except BaseException:
+            _kill(process)
+            raise
+        finally:
+            err_thread.join()
+            process.wait()
+    if errors:
+        raise errors[0]
+    return process.returncode, "".join(out_lines), "".join(err_lines)
+
+
+class Job:
+    """
+    a call running in its own thread, like a future
+    """
+    def __init__(self, func, args=(), kwargs=None, name=None):
+        self.name = name or getattr(func, "__name__", "job")
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs or {}
+        self._result = None
+        self._error = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+
+    def __str__(self):
+        return str({"name": self.name, "done": self.done()})
+
+    def _run(self):
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except Exception as e:
+            log.error("job {:s} failed\n{:s}".format(self.name, traceback.format_exc()))
+            self._error = e
+        finally:
+            self._done.set()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        :return: True if the job is done
+        """
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """
+        :return: return value of the call, the exception of the call is raised again
+        """
+        if not self.wait(timeout):
+            raise RuntimeError("job {:s} not done in {:s}s".format(self.name, str(timeout)))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def submit(func, *args, **kwargs):
+    """
+    call @func in a new thread. submitting itself takes no slot, the processes
+    started by @func do, so a job may submit and wait for other jobs
+    :return: <Job>
+    """
+    return Job(func, args, kwargs).start()
+
+
+def run_async(cmdargs, on_stdout=None, on_stderr=None):
+    """
+    :return: <Job> of run()
+    """
+    return submit(run, cmdargs, on_stdout, on_stderr)
+
+
+def gather(jobs):
+    """
+    :return: results of @jobs in the same order
+    """
+    return [job.result() for job in jobs]
@@ -25,12 +25,19 @@ import os
 import json
 import time
 import copy
+import shutil
 import logging
+import functools
 import subprocess
 import video.info as info
 import video.trans as trans
 import video.score as score
 import video.utils as utils
+import video.cache as cache
+import video.framestore as framestore
+import video.sample as sample
+import video.chunk as chunk
+import video.rd.sched as sched
 import cfg.tools
 
 
@@ -44,12 +51,16 @@ def _append_param_to_name(name, param, value, sep="-"):
     return cat
 
 
-def collect_point_data(task_cfg, graph_cfg, line_cfg, point_cfg):
-    raw_point_data = {"label": point_cfg["label"]}
+def _get_trans_cache(task_cfg):
+    return cache.get_trans_cache(task_cfg.get("trans_cache_dir"), task_cfg.get("trans_cache_size"))
+
+
+def _point_trans_args(task_cfg, graph_cfg, line_cfg, point_cfg, threads=None):
+    """
+    :return: (iparam, oparam, output) of the point, params substituted
+    """
     input = graph_cfg["input"]
     output = os.path.basename(input)
-    #
-    # video transcoding
     iparam = line_cfg["input_param"]
     oparam = line_cfg["output_param"]
     output = _append_param_to_name(output, "label", line_cfg["label"])
@@ -57,20 +68,25 @@ def collect_point_data(task_cfg, graph_cfg, line_cfg, point_cfg):
         iparam = iparam.replace("%" + param + "%", str(value))
         oparam = oparam.replace("%" + param + "%", str(value))
         output = _append_param_to_name(output, param, str(value))
+    if threads is not None:
+        oparam = sched.set_threads(oparam, threads)
     output += ".mp4"
     output = utils.prepare_save_path(output, task_cfg.get("video_save_dir"))
-    start_time = time.time()
-    ret = trans.trans_by_ioparam(input, iparam.split(), oparam.split(), output)
-    trans_time = time.time() - start_time
-    #
-    raw_point_data.update({
-        "iparam": iparam,
-        "oparam": oparam,
-        "output": output,
-        "trans_time": trans_time,
-        "rate": 0,
-        "psnr": 0.0, "ssim": 0.0, "vmaf": 0.0
-    })
+    return iparam, oparam, output
+
+
+def _get_ref_cache(task_cfg):
+    return cache.get_ref_yuv_cache(task_cfg.get("yuv_cache_dir"), task_cfg.get("yuv_cache_size"))
+
+
+def _scores_through_files(task_cfg, line_cfg):
+    return score.scores_through_files(line_cfg.get("yuv_pipe", task_cfg.get("yuv_pipe", False)),
+                                      task_cfg.get("yuv_save_dir"))
+
+
+def _collect_point_score(task_cfg, graph_cfg, line_cfg, raw_point_data, ret, ref_cache=None):
+    input = graph_cfg["input"]
+    output = raw_point_data["output"]
     # video quality evaluation
     if ret == 0:
         print output
@@ -79,14 +95,33 @@ def collect_point_data(task_cfg, graph_cfg, line_cfg, point_cfg):
         print output
         cmp_res = line_cfg.get("cmp_res")
         cmp_frm = line_cfg.get("cmp_frames")
-        psnr, ssim, vmaf = score.get_yuv_score(
-            ori_fmt, dis_fmt, cmp_res,
-            cmp_frames=cmp_frm,
-            save_dir=task_cfg.get("yuv_save_dir"))
+        cmp_smp = line_cfg.get("cmp_sample")
+        save_frm = line_cfg.get("save_frame_scores", task_cfg.get("save_frame_scores", False))
+        frame_scores = {} if (save_frm is True and cmp_smp is None) else None
+        score_kw = dict(
+            save_dir=task_cfg.get("yuv_save_dir"),
+            use_pipe=line_cfg.get("yuv_pipe", task_cfg.get("yuv_pipe", False)),
+            backend=line_cfg.get("score_backend", task_cfg.get("score_backend", "auto")),
+            ref_cache=ref_cache or _get_ref_cache(task_cfg))
+        if cmp_smp is not None:
+            smp_kw = copy.deepcopy(cmp_smp)
+            smp_kw.update(score_kw)
+            psnr, ssim, vmaf, bounds = sample.get_sampled_score(ori_fmt, dis_fmt, cmp_res, **smp_kw)
+            raw_point_data["score_bounds"] = bounds
+        else:
+            psnr, ssim, vmaf = score.get_yuv_score(
+                ori_fmt, dis_fmt, cmp_res,
+                cmp_frames=cmp_frm,
+                frame_scores=frame_scores,
+                vmaf_chunks=line_cfg.get("vmaf_chunks", task_cfg.get("vmaf_chunks")),
+                **score_kw)
         raw_point_data.update({
             "rate": dis_fmt.br,
             "psnr": psnr, "ssim": ssim, "vmaf": vmaf
         })
+        if frame_scores is not None:
+            raw_point_data["frame_scores"] = framestore.save_frame_scores(
+                frame_scores, os.path.basename(output) + ".frames.npz", task_cfg.get("data_save_dir"))
         print output
     else:
         log.error("trans failed (" + str(ret) + ")")
@@ -94,27 +129,156 @@ def collect_point_data(task_cfg, graph_cfg, line_cfg, point_cfg):
     return raw_point_data
 
 
-def collect_line_data(task_cfg, graph_cfg, line_cfg, point_cfgs):
+def _new_point_data(point_cfg, iparam, oparam, output, trans_time):
+    return {
+        "label": point_cfg["label"],
+        "iparam": iparam,
+        "oparam": oparam,
+        "output": output,
+        "trans_time": trans_time,
+        "rate": 0,
+        "psnr": 0.0, "ssim": 0.0, "vmaf": 0.0
+    }
+
+
+def collect_point_data(task_cfg, graph_cfg, line_cfg, point_cfg, threads=None, ref_cache=None):
+    """
+    :param threads: encoder threads set into the output params, keep them as configured if None
+    :param ref_cache: <cache.RefYuvCache>, the one of the task config if None
+    """
+    # video transcoding
+    chunks = line_cfg.get("chunks", task_cfg.get("chunks"))
+    point_threads = threads
+    if chunks is not None and threads is not None:
+        # the chunks share the cores given to the point
+        chunks, point_threads = chunk.share_cores(chunks, threads)
+    iparam, oparam, output = _point_trans_args(task_cfg, graph_cfg, line_cfg, point_cfg, point_threads)
+    start_time = time.time()
+    report = None
+    if chunks is not None:
+        # long inputs: encode keyframe aligned chunks in parallel
+        report = chunk.trans_chunked(graph_cfg["input"], iparam.split(), oparam.split(), output, chunks,
+                                     cores=threads)
+        ret = report["returncode"]
+    else:
+        ret = trans.trans_by_ioparam(graph_cfg["input"], iparam.split(), oparam.split(), output,
+                                     _get_trans_cache(task_cfg))
+    trans_time = time.time() - start_time
+    #
+    raw_point_data = _new_point_data(point_cfg, iparam, oparam, output, trans_time)
+    if report is not None:
+        raw_point_data["chunk_report"] = report
+    return _collect_point_score(task_cfg, graph_cfg, line_cfg, raw_point_data, ret, ref_cache)
+
+
+def collect_batch_data(task_cfg, graph_cfg, line_cfg, point_cfgs, threads=None, ref_cache=None):
+    """
+    encode all the points of a line in one ffmpeg process decoding the input once,
+    see trans.trans_multi_by_ioparam(). points with different input params fall back
+    to one process each.
+    :param threads: encoder threads of the whole batch, split evenly between the points
+    :param ref_cache: see collect_point_data()
+    :return: raw point data of @point_cfgs
+    """
+    point_threads = max(1, threads // len(point_cfgs)) if threads is not None else None
+    args = [_point_trans_args(task_cfg, graph_cfg, line_cfg, point_cfg, point_threads) for point_cfg in point_cfgs]
+    if len(set(iparam for iparam, _, _ in args)) != 1:
+        log.warning("input params differ between points, encode them one by one")
+        return [collect_point_data(task_cfg, graph_cfg, line_cfg, point_cfg, threads, ref_cache)
+                for point_cfg in point_cfgs]
+    #
+    start_time = time.time()
+    rets = trans.trans_multi_by_ioparam(graph_cfg["input"], args[0][0].split(),
+                                        [(None, oparam.split(), output) for _, oparam, output in args],
+                                        _get_trans_cache(task_cfg))
+    trans_time = time.time() - start_time
+    #
+    raw_points = []
+    for point_cfg, (iparam, oparam, output), ret in zip(point_cfgs, args, rets):
+        raw_point_data = _new_point_data(point_cfg, iparam, oparam, output, trans_time)
+        raw_point_data["batch_size"] = len(point_cfgs)
+        raw_points.append(_collect_point_score(task_cfg, graph_cfg, line_cfg, raw_point_data, ret, ref_cache))
+    return raw_points
+
+
+def collect_line_data(task_cfg, graph_cfg, line_cfg, point_cfgs, raw_points=None):
+    """
+    :param raw_points: point data already collected for @point_cfgs, collect them one by one if None
+    """
     raw_line = copy.deepcopy(line_cfg)
     raw_line.update({
         "point_array": []
     })
     #
-    for point_cfg in point_cfgs:
-        raw_point_data = collect_point_data(task_cfg, graph_cfg, line_cfg, point_cfg)
+    if raw_points is None and line_cfg.get("batch_points") is True:
+        raw_points = collect_batch_data(task_cfg, graph_cfg, line_cfg, point_cfgs)
+    for i, point_cfg in enumerate(point_cfgs):
+        if raw_points is not None:
+            raw_point_data = raw_points[i]
+        else:
+            raw_point_data = collect_point_data(task_cfg, graph_cfg, line_cfg, point_cfg)
         raw_line["point_array"].append(raw_point_data)
     return raw_line
 
 
-def collect_figure_data(task_cfg, graph_cfg, line_cfgs, point_cfgs):
+def collect_task_points(task_cfg, graph_cfgs, line_cfgs, point_cfgs, cores):
+    """
+    collect all points of the task in parallel under a budget of @cores.
+    points of a graph score against one decoding of its input, kept in the task's
+    RefYuvCache or a temporary one in yuv_save_dir, never in a yuv file shared by
+    concurrent points. lines scored through pipes stream it instead
+    :return: raw point data indexed by [graph][line][point]
+    """
+    cores = sched.get_cores(cores)
+    ref_cache = _get_ref_cache(task_cfg)
+    tmp_cache = None
+    if ref_cache is None and any(_scores_through_files(task_cfg, line_cfg) for line_cfg in line_cfgs):
+        tmp_cache = cache.make_temp_ref_yuv_cache(task_cfg.get("yuv_save_dir"), task_cfg.get("yuv_cache_size"))
+    jobs = []
+    for graph_cfg in graph_cfgs:
+        ori_fmt = trans.Format(graph_cfg["input"], probe=True)
+        for line_cfg in line_cfgs:
+            line_cache = ref_cache or (tmp_cache if _scores_through_files(task_cfg, line_cfg) else None)
+            point_func = functools.partial(collect_point_data, ref_cache=line_cache)
+            batch_func = functools.partial(collect_batch_data, ref_cache=line_cache)
+            height = sched.output_height(line_cfg["output_param"], ori_fmt.size.h)
+            threads = sched.useful_threads(height, cores)
+            if line_cfg.get("batch_points") is True:
+                jobs.append((min(cores, threads * len(point_cfgs)), batch_func,
+                             (task_cfg, graph_cfg, line_cfg, point_cfgs)))
+                continue
+            for point_cfg in point_cfgs:
+                jobs.append((threads, point_func, (task_cfg, graph_cfg, line_cfg, point_cfg)))
+    try:
+        results = iter(sched.run_jobs(jobs, cores))
+    finally:
+        if tmp_cache is not None:
+            shutil.rmtree(tmp_cache.cache_dir, ignore_errors=True)
+    raw_points = []
+    for _ in graph_cfgs:
+        raw_graph_points = []
+        for line_cfg in line_cfgs:
+            if line_cfg.get("batch_points") is True:
+                raw_graph_points.append(next(results))
+            else:
+                raw_graph_points.append([next(results) for _ in point_cfgs])
+        raw_points.append(raw_graph_points)
+    return raw_points
+
+
+def collect_figure_data(task_cfg, graph_cfg, line_cfgs, point_cfgs, raw_points=None):
+    """
+    :param raw_points: point data already collected, indexed by [line][point]
+    """
     raw_graph = copy.deepcopy(graph_cfg)
     raw_graph.update({
         "data_format": "raw_data",
         "line_array": []
     })
     #
-    for line_cfg in line_cfgs:
-        raw_line = collect_line_data(task_cfg, graph_cfg, line_cfg, point_cfgs)
+    for i, line_cfg in enumerate(line_cfgs):
+        raw_line = collect_line_data(task_cfg, graph_cfg, line_cfg, point_cfgs,
+                                     raw_points[i] if raw_points is not None else None)
         raw_graph["line_array"].append(raw_line)
     #
     if graph_cfg.get("save_raw_json") is not None:
@@ -131,6 +295,8 @@ def collect_figure_data(task_cfg, graph_cfg, line_cfgs, point_cfgs):
 def collect_task_data(task_cfg):
     try:
         assert task_cfg["data_format"] == "cfg_data"
+        if task_cfg.get("probe_cache") is not None:
+            info.set_probe_cache(task_cfg["probe_cache"])
         raw_task = copy.deepcopy(task_cfg)
         raw_task.update({
             "data_format": "raw_data",
@@ -141,8 +307,13 @@ def collect_task_data(task_cfg):
         line_cfgs = task_cfg["line_cfg_list"]
         point_cfgs = task_cfg["point_cfg_list"]
         #
-        for graph_cfg in graph_cfgs:
-            raw_graph = collect_figure_data(task_cfg, graph_cfg, line_cfgs, point_cfgs)
+        # "cores" runs points in parallel, each encode gets threads that pay off at its size
+        raw_points = None
+        if task_cfg.get("cores") is not None:
+            raw_points = collect_task_points(task_cfg, graph_cfgs, line_cfgs, point_cfgs, task_cfg["cores"])
+        for i, graph_cfg in enumerate(graph_cfgs):
+            raw_graph = collect_figure_data(task_cfg, graph_cfg, line_cfgs, point_cfgs,
+                                            raw_points[i] if raw_points is not None else None)
             raw_task["graph_array"].append(raw_graph)
         #
         if task_cfg.get("save_raw_json") is not None:
@@ -0,0 +1,154 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    run rd points in parallel under a global core budget, each encode
+    gets the threads that still pay off at its resolution
+"""
+
+import re
+import logging
+import multiprocessing
+import threading
+import video.proc as proc
+
+module_name = "v.rd.sched"
+log = logging.getLogger(module_name)
+
+# x264 frame threads stop scaling once each thread has too few mb rows,
+# (max height, threads) measured as the point where more threads gain < 10%
+_useful_threads_table = [(288, 2), (360, 4), (540, 6), (720, 8), (1080, 12), (1440, 16), (2160, 24)]
+_max_useful_threads = 32
+
+_x264_threads_regex = re.compile(r"(^|:)threads=\d+")
+_x264_lookahead_regex = re.compile(r"(^|:)lookahead-threads=\d+")
+_x265_pools_regex = re.compile(r"(^|:)pools=[^:]+")
+_size_regex = re.compile(r"-s\s+(\d+)x(\d+)")
+
+
+def get_cores(cores):
+    """
+    :param cores: <int>, or "auto" for the cpu count
+    """
+    return multiprocessing.cpu_count() if cores == "auto" else max(1, int(cores))
+
+
+def useful_threads(height, cores=None):
+    """
+    :param height: encoded picture height
+    :return: encoder threads worth spending on one encode of @height
+    """
+    threads = _max_useful_threads
+    for max_height, n in _useful_threads_table:
+        if height <= max_height:
+            threads = n
+            break
+    return min(threads, cores) if cores else threads
+
+
+def lookahead_threads(threads):
+    # same ratio as the old threads=36:lookahead-threads=4
+    return max(1, threads // 9)
+
+
+def output_height(oparam, input_height):
+    """
+    :return: height set by "-s wxh" in @oparam, or @input_height
+    """
+    match = _size_regex.search(oparam)
+    return int(match.group(2)) if match else input_height
+
+
+def set_threads(oparam, threads):
+    """
+    rewrite the encoder thread settings in @oparam to @threads,
+    "%THREADS%" in @oparam is replaced as well
+    :return: new oparam <string>
+    """
+    oparam = oparam.replace("%THREADS%", str(threads))
+    args = oparam.split()
+    found = False
+    for i in range(1, len(args)):
+        if args[i - 1] in ("-x264opts", "-x264-params"):
+            opts = args[i]
+            if _x264_threads_regex.search(opts):
+                opts = _x264_threads_regex.sub(r"\g<1>threads={:d}".format(threads), opts)
+                opts = _x264_lookahead_regex.sub(
+                    r"\g<1>lookahead-threads={:d}".format(lookahead_threads(threads)), opts)
+                found = True
+            args[i] = opts
+        elif args[i - 1] == "-x265-params":
+            opts = _x265_pools_regex.sub("", args[i]).lstrip(":")
+            args[i] = (opts + ":" if opts else "") + "pools={:d}".format(threads)
+            found = True
+        elif args[i - 1] == "-threads":
+            args[i] = str(threads)
+            found = True
+    if not found:
+        args = args + ["-threads", str(threads)]
+    return " ".join(args)
+
+
+class CoreBudget:
+    """
+    cores shared by running jobs, a job asking for more than the budget gets all of it
+    """
+    def __init__(self, cores):
+        self.cores = cores
+        self.free = cores
+        self._cond = threading.Condition()
+
+    def acquire(self, n):
+        """
+        :return: cores taken, pass it to release()
+        """
+        n = min(n, self.cores)
+        with self._cond:
+            while self.free < n:
+                self._cond.wait()
+            self.free -= n
+        return n
+
+    def release(self, n):
+        with self._cond:
+            self.free += n
+            self._cond.notify_all()
+
+
+def run_jobs(jobs, cores):
+    """
+    run @jobs in config order as long as cores are free
+    :param jobs: [(threads, func, args), ...], func(*args, threads=threads) is called
+    :param cores: core budget <int>
+    :return: results of @jobs in the same order
+    """
+    budget = CoreBudget(cores)
+
+    def _run(func, args, threads, taken):
+        try:
+            return func(*args, threads=threads)
+        finally:
+            budget.release(taken)
+
+    started = []
+    for threads, func, args in jobs:
+        taken = budget.acquire(threads)
+        started.append(proc.submit(_run, func, args, threads, taken))
+    log.info("{:d} jobs started on {:d} cores".format(len(started), cores))
+    return proc.gather(started)
@@ -0,0 +1,175 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright
+    2017 Jeff <163jogh@163.com>
+
+License
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    S the License for the specific language governing permissions and
+    limitations under the License.
+
+Brief
+    sampled quality scoring: score short windows spread over the whole video
+    until the pooled estimate is within a requested confidence interval
+"""
+
+import math
+import logging
+import score
+
+module_name = "v.sample"
+log = logging.getLogger(module_name)
+
+METRICS = ("psnr", "ssim", "vmaf")
+
+# two-sided standard normal quantiles
+_z_table = {0.8: 1.2816, 0.9: 1.6449, 0.95: 1.9600, 0.98: 2.3263, 0.99: 2.5758, 0.999: 3.2905}
+
+
+def t_quantile(confidence, df):
+    """
+    two-sided student-t quantile, Cornish-Fisher expansion around the normal one
+    :param confidence: one of the keys of _z_table
+    """
+    if confidence not in _z_table:
+        raise ValueError("confidence should be one of " + str(sorted(_z_table)))
+    z = _z_table[confidence]
+    if df <= 0:
+        return float("inf")
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    return z + g1 / df + g2 / df ** 2 + g3 / df ** 3
+
+
+def stratum_order(n):
+    """
+    van der Corput order of @n strata, so every prefix of the order is spread
+    over the whole range: 8 -> [0, 4, 2, 6, 1, 5, 3, 7]
+    """
+    bits = max(1, int(math.ceil(math.log(n, 2)))) if n > 1 else 1
+    order = []
+    for i in range(1 << bits):
+        rev = int(format(i, "0{:d}b".format(bits))[::-1], 2)
+        if rev < n:
+            order.append(rev)
+    return order
+
+
+def _fps(video):
+    try:
+        num, den = str(video.fps).split("/") if "/" in str(video.fps) else (video.fps, 1)
+        return float(num) / float(den)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def get_duration(fmt):
+    """
+    :param fmt: <trans.Format>, probed if not yet
+    :return: duration in seconds, 0 if unknown
+    """
+    if fmt.info is None:
+        fmt.probe_info()
+    video = fmt.info.video
+    try:
+        return float(video.ts)
+    except (TypeError, ValueError):
+        pass
+    fps = _fps(video)
+    try:
+        return float(video.frames) / fps if fps > 0 else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class Estimate:
+    """
+    mean and confidence bound of window scores, windows are equally sized and taken
+    from equally sized strata, so the plain mean of window means estimates the whole video
+    """
+    def __init__(self, confidence=0.95, population=None):
+        self.confidence = confidence
+        self.population = population    # number of strata, for finite population correction
+        self.samples = {m: [] for m in METRICS}
+
+    def add(self, psnr, ssim, vmaf):
+        for m, v in zip(METRICS, (psnr, ssim, vmaf)):
+            self.samples[m].append(float(v))
+
+    def n(self):
+        return len(self.samples["vmaf"])
+
+    def mean(self, metric):
+        values = self.samples[metric]
+        return sum(values) / len(values) if values else 0.0
+
+    def half_width(self, metric):
+        values = self.samples[metric]
+        n = len(values)
+        if n < 2:
+            return float("inf")
+        mean = sum(values) / n
+        var = sum((v - mean) ** 2 for v in values) / (n - 1)
+        fpc = 1.0
+        if self.population:
+            fpc = math.sqrt(max(0.0, 1.0 - float(n) / self.population))
+        return t_quantile(self.confidence, n - 1) * math.sqrt(var / n) * fpc
+
+    def reached(self, ci):
+        """
+        :param ci: <dict> metric -> wanted half width of the confidence interval
+        """
+        return all(self.half_width(m) <= w for m, w in ci.items())
+
+    def bounds(self):
+        ret = {"windows": self.n(), "confidence": self.confidence}
+        for m in METRICS:
+            ret[m + "_ci"] = self.half_width(m) if self.n() > 1 else None
+        return ret
+
+
+def get_sampled_score(ref_fmt, dis_fmt, cmp_res=None, window=30, ci=None, confidence=0.95,
+                      min_windows=4, max_windows=32, **score_kw):
+    """
+    score windows of @window frames from @max_windows strata of the video, in an order that keeps
+    them spread over the whole duration, and stop once the estimate is within @ci
+    :param ci: <dict> metric -> half width of the confidence interval, ie. {"vmaf": 0.5}.
+               None to score all @max_windows windows
+    :param score_kw: passed to score.get_yuv_score(), ie. use_pipe, ref_cache, backend
+    :return: (psnr, ssim, vmaf, bounds), bounds is <dict> of "<metric>_ci", "windows", "confidence"
+    """
+    ci = ci or {}
+    for m in ci:
+        if m not in METRICS:
+            raise ValueError("unknown metric " + m)
+    duration = get_duration(ref_fmt)
+    fps = _fps(ref_fmt.info.video) or 25.0
+    window_time = window / fps
+    max_windows = max(1, min(max_windows, int(duration / window_time))) if duration > 0 else 1
+    stratum = duration / max_windows if duration > 0 else 0.0
+
+    estimate = Estimate(confidence, population=max_windows)
+    for idx in stratum_order(max_windows):
+        start_time = idx * stratum + max(0.0, stratum - window_time) / 2
+        psnr, ssim, vmaf = score.get_yuv_score(ref_fmt, dis_fmt, cmp_res, cmp_frames=window,
+                                               start_time=round(start_time, 3), **score_kw)
+        if psnr == 0 and ssim == 0 and vmaf == 0:
+            log.error("failed to score window @{:.3f}s".format(start_time))
+            continue
+        estimate.add(psnr, ssim, vmaf)
+        if ci and estimate.n() >= min_windows and estimate.reached(ci):
+            break
+    bounds = estimate.bounds()
+    log.info("sampled score windows={:d}/{:d}, ".format(estimate.n(), max_windows)
+             + ", ".join("{:s}={:f}+-{:s}".format(m, estimate.mean(m), str(bounds[m + "_ci"])) for m in METRICS))
+    return estimate.mean("psnr"), estimate.mean("ssim"), estimate.mean("vmaf"), bounds
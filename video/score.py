@@ -22,12 +22,18 @@ Brief
 """
 
 import os
-import json
+import functools
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import re
-import subprocess
-import info
+import shutil
+import tempfile
+import time
+import proc
 import trans
+import framestore
+import chunk
 import cfg.tools
 
 FFMPEG = cfg.tools.ffmpeg
@@ -36,82 +42,146 @@ RUN_VMAF_PY = cfg.tools.run_vmaf_py
 module_name = "v.score"
 log = logging.getLogger(module_name)
 
+_RAW_FPS = 25
+_MIN_CHUNK_FRAMES = 25
 
-def _get_psnr_ssim_from_command(cmd_args):
+
+_f_regex = r"([.0-9]+|inf)"
+_psnr_regex = re.compile(
+    r"\[Parsed_psnr_\d+ @ 0x[0-9a-f]+\] PSNR "
+    + r"y:" + _f_regex + " u:" + _f_regex + " v:" + _f_regex + " "
+    + "average:(?P<psnr>[.0-9]+) .*")
+_ssim_regex = re.compile(
+    r"\[Parsed_ssim_\d+ @ 0x[0-9a-f]+\] SSIM "
+    + r"Y:[.0-9]+ \(" + _f_regex + "\) "
+    + r"U:[.0-9]+ \(" + _f_regex + "\) "
+    + r"V:[.0-9]+ \(" + _f_regex + "\) "
+    + r"All:(?P<ssim>[.0-9]+) \((?P<ssim2>[.0-9]+)\)")
+_vmaf_regex = re.compile(
+    r"\[Parsed_libvmaf_\d+ @ 0x[0-9a-f]+\] VMAF score ?[:=] ?(?P<vmaf>[.0-9]+)")
+
+
+def _get_lavfi_score_from_command(cmd_args):
     """
-    run @cmd_args which produce psnr and ssim, then filter the result
-    :param cmd_args: "ffmpeg -i input1 -i input2 -lavfi psnr;[0:v][1:v]ssim -f null -"
-    :return: psnr, ssim, ssim2
-    """
-    psnr, ssim, ssim2 = 0, 0, 0
-
-    f_regex = r"([.0-9]+|inf)"
-    psnr_regex = re.compile(
-        r"\[Parsed_psnr_\d+ @ 0x[0-9a-f]+\] PSNR "
-        + r"y:" + f_regex + " u:" + f_regex + " v:" + f_regex + " "
-        + "average:(?P<psnr>[.0-9]+) .*")
-    ssim_regex = re.compile(
-        r"\[Parsed_ssim_\d+ @ 0x[0-9a-f]+\] SSIM "
-        + r"Y:[.0-9]+ \(" + f_regex + "\) "
-        + r"U:[.0-9]+ \(" + f_regex + "\) "
-        + r"V:[.0-9]+ \(" + f_regex + "\) "
-        + r"All:(?P<ssim>[.0-9]+) \((?P<ssim2>[.0-9]+)\)")
+    run @cmd_args which produce psnr, ssim and/or vmaf in one ffmpeg filtergraph,
+    then filter the result
+    :param cmd_args: "ffmpeg -i input1 -i input2 -lavfi psnr;[0:v][1:v]ssim;[1:v][0:v]libvmaf -f null -"
+    :return: psnr, ssim, vmaf
+    """
+    scores = {"psnr": 0, "ssim": 0, "vmaf": 0}
+
+    # ffmepg默认输出到stderr
+    def _on_line(line):
+        for key, regex in (("psnr", _psnr_regex), ("ssim", _ssim_regex), ("vmaf", _vmaf_regex)):
+            match = regex.search(line)
+            if match:
+                scores[key] = float(match.group(key))
 
     try:
-        process = subprocess.Popen(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                   universal_newlines=True, shell=False)
-        log.info("subprocess = " + ' '.join(cmd_args))
-        while True:
-            # ffmepg默认输出到stderr，这是个阻塞调用
-            line = process.stderr.readline()
-            if process.poll() is not None:
-                log.info("...Process Ending...")
-                break
-            psnr_match = psnr_regex.search(line)
-            ssim_match = ssim_regex.search(line)
-            if psnr_match:
-                psnr_dict = psnr_match.groupdict()
-                psnr = float(psnr_dict["psnr"])
-            if ssim_match:
-                ssim_dict = ssim_match.groupdict()
-                ssim = float(ssim_dict["ssim"])
-                ssim2 = float(ssim_dict["ssim2"])
-        if process.returncode:
-            log.error("ffmpeg exit with error code " + str(process.returncode))
+        returncode, _, _ = proc.run(cmd_args, on_stderr=_on_line)
+        log.info("...Process Ending...")
+        if returncode:
+            log.error("ffmpeg exit with error code " + str(returncode))
     except Exception as e:
         log.error("Exception = " + str(e))
+    return scores["psnr"], scores["ssim"], scores["vmaf"]
+
 
+def _get_vmaf_from_lavfi_command(cmd_args):
+    """
+    :param cmd_args: "ffmpeg -i input1 -i input2 -lavfi [1:v][0:v]libvmaf -f null -"
+    :return: vmaf
+    """
+    return _get_lavfi_score_from_command(cmd_args)[2]
+
+
+def _get_psnr_ssim_from_command(cmd_args):
+    """
+    run @cmd_args which produce psnr and ssim, then filter the result
+    :param cmd_args: "ffmpeg -i input1 -i input2 -lavfi psnr;[0:v][1:v]ssim -f null -"
+    :return: psnr, ssim
+    """
+    psnr, ssim, _ = _get_lavfi_score_from_command(cmd_args)
     if psnr * ssim == 0:
         log.error("psnr/ssim == 0, please check psnr/ssim regex pattern ")
-        log.error("psnr_regex=" + psnr_regex)
-        log.error("ssim_regex=" + ssim_regex)
+        log.error("psnr_regex=" + _psnr_regex.pattern)
+        log.error("ssim_regex=" + _ssim_regex.pattern)
 
     log.info("psnr="+str(psnr)+", ssim="+str(ssim))
     return psnr, ssim
 
 
-def _get_vmaf_from_command(cmd_args):
+def _get_psnr_ssim_from_command_async(cmd_args):
+    """
+    :return: <proc.Job> of _get_psnr_ssim_from_command()
+    """
+    return proc.submit(_get_psnr_ssim_from_command, cmd_args)
+
+
+_has_libvmaf = None
+
+
+def has_libvmaf():
     """
-    run @command_args which produce psnr and ssim, then filter the result
+    :return: True if ffmpeg is built with the libvmaf filter
+    """
+    global _has_libvmaf
+    if _has_libvmaf is None:
+        try:
+            returncode, output, _ = proc.run([FFMPEG, "-hide_banner", "-filters"])
+            _has_libvmaf = returncode == 0 and re.search(r"\slibvmaf\s", output) is not None
+        except Exception as e:
+            log.error("Exception = " + str(e))
+            _has_libvmaf = False
+        log.info("ffmpeg libvmaf filter " + ("found" if _has_libvmaf else "not found"))
+    return _has_libvmaf
+
+
+def _get_vmaf_from_command(cmd_args, frame_scores=None):
+    """
+    run @command_args which produce psnr and ssim, then filter the result.
+    the json output is parsed line by line as it comes, never buffered as a whole
     :param command_arg: "run_vmaf yuv420p w h input1 input2 ..."
+    :param frame_scores: <dict> filled with per-frame vmaf and feature arrays
     :return: vmaf
     """
     try:
-        log.info("subprocess = " + ' '.join(cmd_args))
-        process = subprocess.Popen(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-        output, error = process.communicate()
-        log.debug("\n" + output + error)
-        if process.returncode:
-            log.error("error[{:d}]: \n{:s}".format(process.returncode, error))
+        parser = framestore.VmafJsonParser()
+        returncode, _, error = proc.run(cmd_args, on_stdout=parser.feed)
+        if returncode:
+            log.error("error[{:d}]: \n{:s}".format(returncode, error))
             return 0
-        vmaf_obj = json.loads(output)
-        vmaf = vmaf_obj["aggregate"]["VMAF_score"]
+        vmaf = parser.vmaf()
+        if vmaf is None:
+            log.error("no vmaf score in output")
+            return 0
+        log.debug("vmaf={:f}, frames={:d}".format(vmaf, parser.frames))
+        if frame_scores is not None:
+            frame_scores.update(parser.frame_scores())
         return float(vmaf)
     except Exception as e:
         log.error("Exception = " + str(e))
     return 0
 
 
+def _get_vmaf_from_command_async(cmd_args, frame_scores=None):
+    """
+    :return: <proc.Job> of _get_vmaf_from_command()
+    """
+    return proc.submit(_get_vmaf_from_command, cmd_args, frame_scores)
+
+
+def _get_vmaf_from_log(log_path, frame_scores):
+    """
+    read per-frame scores from a libvmaf json log into @frame_scores
+    """
+    try:
+        with open(log_path, "r") as f:
+            frame_scores.update(framestore.parse_vmaf_json(f).frame_scores())
+    except Exception as e:
+        log.error("Exception = " + str(e))
+
+
 # def get_vmaf_score(original, out, cmp_res=None):
 #     """
 #     :param original: original video info <trans.Format>
@@ -135,62 +205,398 @@ def _get_vmaf_from_command(cmd_args):
 #     return _get_psnr_ssim_from_command(cmd_args)
 
 
-def get_yuv_score(ref_fmt, dis_fmt, cmp_res=None, cmp_frames=None, has_psnr=True, has_vmaf=True, save_dir=None):
+def _psnr_ssim_args(ref_yuv, dis_yuv, cmp_res):
+    cmd_args = [FFMPEG]
+    cmd_args += "-f rawvideo -pix_fmt yuv420p -s".split(" ") + [cmp_res.wxh(), "-i", ref_yuv]
+    cmd_args += "-f rawvideo -pix_fmt yuv420p -s".split(" ") + [cmp_res.wxh(), "-i", dis_yuv]
+    cmd_args += ["-lavfi", "psnr;[0:v][1:v]ssim", "-f", "null", "-"]
+    return cmd_args
+
+
+def _vmaf_args(ref_yuv, dis_yuv, cmp_res):
+    vmaf_args = ["python", RUN_VMAF, "yuv420p", str(cmp_res.w), str(cmp_res.h)]
+    vmaf_args += [ref_yuv, dis_yuv, "--out-fmt", "json"]
+    return vmaf_args
+
+
+def _lavfi_score_args(ref_yuv, dis_yuv, cmp_res, has_psnr=True, vmaf_log=None):
+    """
+    psnr, ssim and vmaf from one filtergraph, so both inputs are read only once
+    :param vmaf_log: let libvmaf write per-frame scores to this json file
+    """
+    cmd_args = [FFMPEG]
+    cmd_args += "-f rawvideo -pix_fmt yuv420p -s".split(" ") + [cmp_res.wxh(), "-i", ref_yuv]
+    cmd_args += "-f rawvideo -pix_fmt yuv420p -s".split(" ") + [cmp_res.wxh(), "-i", dis_yuv]
+    libvmaf = "libvmaf" if vmaf_log is None else "libvmaf=log_fmt=json:log_path=" + vmaf_log
+    if has_psnr is True:
+        graph = "[0:v]split=3[r0][r1][r2];[1:v]split=3[d0][d1][d2];"
+        graph += "[r0][d0]psnr;[r1][d1]ssim;[d2][r2]" + libvmaf
+    else:
+        graph = "[1:v][0:v]" + libvmaf     # libvmaf takes the distorted one as main input
+    cmd_args += ["-lavfi", graph, "-f", "null", "-"]
+    return cmd_args
+
+
+def _command_pass(cmd_args_func, get_score_func):
+    """
+    :return: score_func(ref_yuv, dis_yuv, cmp_res) running the command of @cmd_args_func
+    """
+    def _score_func(ref_yuv, dis_yuv, cmp_res):
+        return get_score_func(cmd_args_func(ref_yuv, dis_yuv, cmp_res))
+    return _score_func
+
+
+def _lavfi_pass(has_psnr, get_score_func, frame_scores=None):
+    """
+    :return: score_func(ref_yuv, dis_yuv, cmp_res) running psnr/ssim/libvmaf filters in one ffmpeg
+    """
+    def _score_func(ref_yuv, dis_yuv, cmp_res):
+        if frame_scores is None:
+            return get_score_func(_lavfi_score_args(ref_yuv, dis_yuv, cmp_res, has_psnr))
+        log_fd, vmaf_log = tempfile.mkstemp(prefix=module_name + ".", suffix=".json")
+        os.close(log_fd)
+        try:
+            ret = get_score_func(_lavfi_score_args(ref_yuv, dis_yuv, cmp_res, has_psnr, vmaf_log))
+            _get_vmaf_from_log(vmaf_log, frame_scores)
+            return ret
+        finally:
+            os.remove(vmaf_log)
+    return _score_func
+
+
+def _numpy_psnr_ssim_pass(frame_scores=None):
+    """
+    :return: score_func(ref_yuv, dis_yuv, cmp_res) computing psnr/ssim in-process by metric.yuv_score()
+    """
+    def _score_func(ref_yuv, dis_yuv, cmp_res):
+        import metric
+        result = metric.yuv_score(ref_yuv, dis_yuv, cmp_res.w, cmp_res.h)
+        if result is None:
+            return 0, 0
+        if frame_scores is not None:
+            frame_scores.update(result)
+        return result["psnr_avg"], result["ssim_avg"]
+    return _score_func
+
+
+def _chunk_vmaf_args(ref_yuv, dis_yuv, cmp_res, start, frames, vmaf_log):
+    """
+    vmaf of @frames frames from frame @start of raw yuv inputs, rawvideo is seekable by time
+    """
+    start_time = "{:.6f}".format(start / float(_RAW_FPS))
+    raw_args = ["-f", "rawvideo", "-pix_fmt", "yuv420p", "-s", cmp_res.wxh(), "-framerate", str(_RAW_FPS)]
+    cmd_args = [FFMPEG, "-hide_banner"]
+    cmd_args += raw_args + ["-ss", start_time, "-i", ref_yuv]
+    cmd_args += raw_args + ["-ss", start_time, "-i", dis_yuv]
+    cmd_args += ["-lavfi", "[1:v][0:v]libvmaf=log_fmt=json:log_path=" + vmaf_log]
+    cmd_args += ["-frames:v", str(frames), "-f", "null", "-"]
+    return cmd_args
+
+
+def _chunked_vmaf_pass(chunks, frame_scores=None):
+    """
+    :return: score_func(ref_yuv, dis_yuv, cmp_res) scoring vmaf of temporal chunks in parallel ffmpeg
+             processes. each chunk also decodes one frame on both sides, the motion feature of a
+             frame needs its neighbours, so per-frame scores equal those of a single pass
+    """
+    def _score_func(ref_yuv, dis_yuv, cmp_res):
+        frame_size = trans.yuv420p_frame_bytes(cmp_res.w, cmp_res.h)
+        total = min(os.path.getsize(ref_yuv), os.path.getsize(dis_yuv)) // frame_size
+        n = chunks if chunks != "auto" else multiprocessing.cpu_count()
+        n = max(1, min(int(n), total // _MIN_CHUNK_FRAMES))
+        edges = [total * i // n for i in range(n + 1)]
+        log_dir = tempfile.mkdtemp(prefix=module_name + ".")
+
+        def _run_chunk(i):
+            a, b = edges[i], edges[i + 1]
+            head, tail = max(0, a - 1), min(total, b + 1)
+            vmaf_log = os.path.join(log_dir, "chunk{:d}.json".format(i))
+            _get_vmaf_from_lavfi_command(_chunk_vmaf_args(ref_yuv, dis_yuv, cmp_res, head, tail - head, vmaf_log))
+            columns = {}
+            _get_vmaf_from_log(vmaf_log, columns)
+            # drop the neighbour frames
+            return dict((k, list(v)[a - head:len(v) - (tail - b)]) for k, v in columns.items()
+                        if not k.startswith(framestore.AGGREGATE_PREFIX))
+
+        log.info("vmaf of {:d} frames in {:d} chunks".format(total, n))
+        pool = ThreadPool(n)
+        try:
+            results = pool.map(_run_chunk, range(n))
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(log_dir, ignore_errors=True)
+
+        if any(len(r.get("vmaf", [])) != edges[i + 1] - edges[i] for i, r in enumerate(results)):
+            log.error("vmaf chunk missing frames")
+            return None
+        pooled = {}
+        for key in results[0]:
+            pooled[key] = [v for r in results for v in r.get(key, [])]
+        pooled["frameNum"] = range(total)
+        vmaf = sum(pooled["vmaf"]) / total
+        pooled[framestore.AGGREGATE_PREFIX + "vmaf.mean"] = vmaf
+        if frame_scores is not None:
+            frame_scores.update(pooled)
+        log.info("vmaf=" + str(vmaf))
+        return vmaf
+    return _score_func
+
+
+BACKENDS = ("auto", "lavfi", "run_vmaf", "numpy")
+
+
+def _use_libvmaf(backend):
+    """
+    auto/lavfi/numpy: libvmaf filter if ffmpeg has one, run_vmaf: always run_vmaf
+    """
+    if backend not in BACKENDS:
+        raise ValueError("unknown score backend " + str(backend))
+    if backend == "run_vmaf":
+        return False
+    if has_libvmaf():
+        return True
+    if backend == "lavfi":
+        log.warning("ffmpeg has no libvmaf filter, fall back to run_vmaf")
+    return False
+
+
+def _run_score_passes(run_pass, has_psnr, has_vmaf, backend, frame_scores=None, vmaf_chunks=None):
+    """
+    :param run_pass: run_pass(score_func) -> result of score_func(ref_yuv, dis_yuv, cmp_res), or None on failure
+    :param vmaf_chunks: score vmaf in temporal chunks, only for seekable yuv files
+    :return: (psnr,ssim,vmaf) <double, double, double>
+    """
+    psnr, ssim, vmaf = 0, 0, 0
+    if vmaf_chunks is not None and has_vmaf is True and not _use_libvmaf(backend):
+        log.warning("chunked vmaf needs ffmpeg libvmaf filter, score in one chunk")
+        vmaf_chunks = None
+
+    # get psnr, ssim and vmaf in a single pass
+    if has_vmaf is True and backend != "numpy" and vmaf_chunks is None and _use_libvmaf(backend):
+        ret = run_pass(_lavfi_pass(has_psnr, _get_lavfi_score_from_command, frame_scores))
+        return (0, 0, 0) if ret is None else ret
+
+    # get psnr and ssim
+    if has_psnr is True:
+        if backend == "numpy":
+            ret = run_pass(_numpy_psnr_ssim_pass(frame_scores))
+        else:
+            ret = run_pass(_command_pass(_psnr_ssim_args, _get_psnr_ssim_from_command))
+        if ret is None:
+            return 0, 0, 0
+        psnr, ssim = ret
+
+    # get vmaf
+    if has_vmaf is True:
+        if vmaf_chunks is not None:
+            ret = run_pass(_chunked_vmaf_pass(vmaf_chunks, frame_scores))
+        elif backend == "numpy" and _use_libvmaf(backend):
+            ret = run_pass(_lavfi_pass(False, _get_vmaf_from_lavfi_command, frame_scores))
+        else:
+            ret = run_pass(_command_pass(_vmaf_args,
+                                         functools.partial(_get_vmaf_from_command, frame_scores=frame_scores)))
+        if ret is None:
+            return 0, 0, 0
+        vmaf = ret
+    return psnr, ssim, vmaf
+
+
+def _wait_decoders(decoders, timeout=1.0):
+    """
+    reap the decoders feeding a pipe reader that has already exited.
+    a decoder still alive after @timeout is blocked on a pipe nobody reads.
+    :return: True if all decoders succeeded
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline and any(p.poll() is None for p in decoders):
+        time.sleep(0.05)
+    ok = True
+    for p in decoders:
+        if p.poll() is None:
+            p.kill()
+            ok = False
+        if p.wait():
+            ok = False
+    return ok
+
+
+def _get_score_by_pipe(score_func, ref_fmt, dis_fmt, cmp_res, iparam, oparam, ref_yuv=None):
+    """
+    decode ref/dis into a pair of named pipes and run @score_func over them.
+    nothing is written to disk, so every pass over the yuv needs its own decoders.
+    :param ref_yuv: read the reference from this yuv file instead of decoding it
+    :return: result of @score_func, or None if any decoder failed
+    """
+    pipe_dir = tempfile.mkdtemp(prefix=module_name + ".")
+    ref_pipe = os.path.join(pipe_dir, "ref.yuv") if ref_yuv is None else ref_yuv
+    dis_pipe = os.path.join(pipe_dir, "dis.yuv")
+    decoders = []
+    try:
+        if ref_yuv is None:
+            os.mkfifo(ref_pipe)
+            decoders.append(trans.open_yuv_pipe(ref_fmt, cmp_res, ref_pipe, _iparam=iparam, _oparam=oparam))
+        os.mkfifo(dis_pipe)
+        decoders.append(trans.open_yuv_pipe(dis_fmt, cmp_res, dis_pipe, _iparam=iparam, _oparam=oparam))
+        result = score_func(ref_pipe, dis_pipe, cmp_res)
+    finally:
+        decoded = _wait_decoders(decoders)
+        shutil.rmtree(pipe_dir, ignore_errors=True)
+    if not decoded:
+        log.error("decoding to pipe failed")
+        return None
+    return result
+
+
+def get_pipe_score(ref_fmt, dis_fmt, cmp_res=None, cmp_frames=None, has_psnr=True, has_vmaf=True, ref_yuv=None,
+                   backend="auto", frame_scores=None, start_time=None):
+    """
+    same as get_yuv_score(), but ref/dis are streamed to the scorers through named pipes,
+    so no yuv file is written.
+    :param ref_yuv: reference already decoded to yuv, e.g. by cache.RefYuvCache
+    :return: (psnr,ssim,vmaf) <double, double, double>
+    """
+    cmp_res = ref_fmt.size if (cmp_res is None or cmp_res.s() == 0) else cmp_res
+    iparam = ["-ss", str(start_time)] if (start_time is not None) else []
+    oparam = ["-vframes", str(cmp_frames)] if (cmp_frames is not None) else []
+
+    def _run_pass(score_func):
+        return _get_score_by_pipe(score_func, ref_fmt, dis_fmt, cmp_res, iparam, oparam, ref_yuv)
+
+    return _run_score_passes(_run_pass, has_psnr, has_vmaf, backend, frame_scores)
+
+
+def scores_through_files(use_pipe, save_dir):
+    """
+    :return: True if get_yuv_score() decodes to yuv files with @use_pipe and @save_dir,
+             else the yuv is streamed through pipes and never written
+    """
+    return use_pipe is not True or save_dir is not None
+
+
+def get_yuv_score(ref_fmt, dis_fmt, cmp_res=None, cmp_frames=None, has_psnr=True, has_vmaf=True, save_dir=None,
+                  use_pipe=False, ref_cache=None, backend="auto", frame_scores=None, start_time=None,
+                  vmaf_chunks=None):
     """
     decoding to yuv and then calculate quality score like psnr,ssim,vmaf
     :param ref_fmt: original video info <trans.Format>
     :param dis_fmt: transcoded video info <trans.Format>
     :param cmp_res: compare resolution <trans.CTransSize>. If None, use original resolution.
     :param save_dir: save yuv file in @save_dir, or delete yuv filte if None
-    :return: (psnr,ssim) <double, double>
+    :param use_pipe: stream yuv through named pipes instead of files, only if @save_dir is None
+    :param ref_cache: get reference yuv from <cache.RefYuvCache> instead of decoding it every time,
+                      with pipes too, so leave it None for pipes to keep the reference off the disk
+    :param backend: one of BACKENDS. "auto" gets psnr/ssim/vmaf in a single ffmpeg pass if ffmpeg
+                    has libvmaf, else runs ffmpeg for psnr/ssim and run_vmaf for vmaf.
+                    "numpy" gets psnr/ssim in-process by metric.yuv_score()
+    :param frame_scores: <dict> filled with per-frame arrays if the backend produces them
+    :param start_time: compare from this time (in seconds) of both videos
+    :param vmaf_chunks: split the compared frames into this many temporal chunks scored in parallel,
+                        "auto" for one chunk per cpu. pooled results equal a single pass.
+                        needs yuv files and ffmpeg libvmaf, ignored otherwise
+    :return: (psnr,ssim,vmaf) <double, double, double>
     """
     cmp_res = ref_fmt.size if (cmp_res is None or cmp_res.s() == 0) else cmp_res
+    ref_yuv = None
+    if ref_cache is not None:
+        ref_yuv = ref_cache.get_ref_yuv(ref_fmt, cmp_res, cmp_frames, start_time=start_time)
+        if ref_yuv is None:
+            log.error("failed to get ref_yuv")
+            return 0, 0, 0
+    try:
+        if use_pipe is True:
+            if save_dir is None:
+                if vmaf_chunks is not None:
+                    log.warning("chunked vmaf needs yuv files, ignore vmaf_chunks")
+                return get_pipe_score(ref_fmt, dis_fmt, cmp_res, cmp_frames, has_psnr, has_vmaf, ref_yuv,
+                                      backend, frame_scores, start_time)
+            log.warning("yuv_save_dir is set, ignore use_pipe")
+        return _get_file_score(ref_fmt, dis_fmt, cmp_res, cmp_frames, has_psnr, has_vmaf, save_dir, ref_yuv,
+                               backend, frame_scores, start_time, vmaf_chunks)
+    finally:
+        if ref_yuv is not None:
+            ref_cache.release(ref_yuv)
+
+
+def get_yuv_score_async(ref_fmt, dis_fmt, cmp_res=None, **kwargs):
+    """
+    :return: <proc.Job> of get_yuv_score(), result() gives (psnr,ssim,vmaf)
+    """
+    return proc.submit(get_yuv_score, ref_fmt, dis_fmt, cmp_res, **kwargs)
+
+
+def _get_file_score(ref_fmt, dis_fmt, cmp_res, cmp_frames, has_psnr, has_vmaf, save_dir, ref_yuv=None,
+                    backend="auto", frame_scores=None, start_time=None, vmaf_chunks=None):
+    iparam = ["-ss", str(start_time)] if (start_time is not None) else []
     oparam = ["-vframes", str(cmp_frames)] if (cmp_frames is not None) else []
-    ref_yuv = trans.to_yuv_by_size(ref_fmt, cmp_res, _oparam=oparam, save_dir=save_dir)
-    dis_yuv = trans.to_yuv_by_size(dis_fmt, cmp_res, _oparam=oparam, save_dir=save_dir)
+    own_ref = ref_yuv is None
+    if own_ref:
+        ref_yuv = trans.to_yuv_by_size(ref_fmt, cmp_res, _iparam=iparam, _oparam=oparam, save_dir=save_dir)
+    dis_yuv = trans.to_yuv_by_size(dis_fmt, cmp_res, _iparam=iparam, _oparam=oparam, save_dir=save_dir)
     if ref_yuv is None or dis_yuv is None:
         log.error("failed to get"
                   + (" ref_yuv" if ref_yuv is None else "")
                   + (" dis_yuv" if dis_yuv is None else ""))
         return 0, 0, 0
 
-    psnr, ssim, vmaf = 0, 0, 0
-
-    # get psnr and ssim
-    if has_psnr is True:
-        cmd_args = [FFMPEG]
-        cmd_args += "-f rawvideo -pix_fmt yuv420p -s".split(" ") + [cmp_res.wxh(), "-i", ref_yuv]
-        cmd_args += "-f rawvideo -pix_fmt yuv420p -s".split(" ") + [cmp_res.wxh(), "-i", dis_yuv]
-        cmd_args += ["-lavfi", "psnr;[0:v][1:v]ssim", "-f", "null", "-"]
-        psnr, ssim = _get_psnr_ssim_from_command(cmd_args)
+    def _run_pass(score_func):
+        return score_func(ref_yuv, dis_yuv, cmp_res)
 
-    # get vmaf
-    if has_vmaf is True:
-        vmaf_args = ["python", RUN_VMAF, "yuv420p", str(cmp_res.w), str(cmp_res.h)]
-        vmaf_args += [ref_yuv, dis_yuv, "--out-fmt", "json"]
-        vmaf = _get_vmaf_from_command(vmaf_args)
+    psnr, ssim, vmaf = _run_score_passes(_run_pass, has_psnr, has_vmaf, backend, frame_scores, vmaf_chunks)
     #
     if save_dir is None:
-        os.remove(ref_yuv)
+        if own_ref:
+            os.remove(ref_yuv)
         os.remove(dis_yuv)
     return psnr, ssim, vmaf
 
 
-def trans_and_get_score(ori_fmt, dis_fmt):
+def trans_and_get_score(ori_fmt, dis_fmt, ref_cache=None, trans_cache=None, chunks=None, preset="veryslow",
+                        threads=36, frame_scores=None, on_progress=None):
     """
     make video transcoding according to @trans, and then update video quality scores
     :param original: original video info <trans.Format>
     :param trans: transcoded video info <trans.Format>
+    :param ref_cache: <cache.RefYuvCache>, see get_yuv_score()
+    :param trans_cache: <cache.TransCache>, see trans.trans_by_ioparam()
+    :param chunks: encode in this many parallel chunks, see chunk.trans_chunked()
+    :param preset: x264 preset
+    :param threads: x264 threads, chunked encodes share them out between the chunks
+    :param frame_scores: <dict> filled with per-frame scores, see get_yuv_score()
+    :param on_progress: see trans.run_command(), not for chunked encodes. an aborted encode is not scored
     :return: @trans <trans.Format>
     """
-    dis_fmt.path = trans.to_264_by_size_crf(ori_fmt, dis_fmt.size, dis_fmt.crf)
+    if chunks is not None:
+        dis_fmt.path, _ = chunk.to_264_chunked(ori_fmt, dis_fmt.size, dis_fmt.crf, chunks, preset=preset,
+                                               cores=threads, trans_cache=trans_cache)
+    else:
+        dis_fmt.path = trans.to_264_by_size_crf(ori_fmt, dis_fmt.size, dis_fmt.crf, threads=threads,
+                                                trans_cache=trans_cache, preset=preset, on_progress=on_progress)
     if dis_fmt.path is not None:
         dis_fmt.probe_info()
-        dis_fmt.psnr, dis_fmt.ssim, dis_fmt.vmaf = get_yuv_score(ori_fmt, dis_fmt)
+        dis_fmt.psnr, dis_fmt.ssim, dis_fmt.vmaf = get_yuv_score(ori_fmt, dis_fmt, ref_cache=ref_cache,
+                                                                 frame_scores=frame_scores)
         log.info("transcoded = " + str(dis_fmt))
     return dis_fmt
 
 
+def trans_multi_and_get_score(ori_fmt, dis_fmts, ref_cache=None, trans_cache=None, preset="veryslow", threads=36):
+    """
+    like trans_and_get_score() for several points, @ori_fmt is decoded once for all the encodes
+    :param dis_fmts: transcoded video infos with size and crf set [...<trans.Format>...]
+    :return: @dis_fmts
+    """
+    paths = trans.to_264_multi(ori_fmt, [(dis_fmt.size, dis_fmt.crf) for dis_fmt in dis_fmts],
+                               threads=threads, trans_cache=trans_cache, preset=preset)
+    for dis_fmt, path in zip(dis_fmts, paths):
+        dis_fmt.path = path
+        if dis_fmt.path is not None:
+            dis_fmt.probe_info()
+            dis_fmt.psnr, dis_fmt.ssim, dis_fmt.vmaf = get_yuv_score(ori_fmt, dis_fmt, ref_cache=ref_cache)
+            log.info("transcoded = " + str(dis_fmt))
+    return dis_fmts
+
+
 def _main_test(path, size, crf):
     ori_fmt = trans.Format(path, probe=True)
     tsize = trans.TSize().from_string(size)
@@ -25,10 +25,13 @@ import logging
 import os
 import subprocess
 import info
+import packets
+import proc
 import utils
 import cfg.tools
 
 FFMPEG = cfg.tools.ffmpeg
+ABORTED = -1        # run_command() returncode when the progress callback stopped the process
 module_name = "v.trans"
 log = logging.getLogger(module_name)
 
@@ -91,6 +94,9 @@ class TSize:
 
 class Format:
     def __init__(self, path=None, size=TSize(), crf=0, br=0, psnr=0, ssim=0, vmaf=0, probe=False):
+        """
+        :param probe: True to probe now, "lazy" to probe when size or br is first read
+        """
         self.path = path
         self.size = size
         self.crf = float(crf)
@@ -101,6 +107,16 @@ class Format:
         self.info = None
         if probe is True:
             self.probe_info()
+        elif probe == "lazy":
+            self.info = info.Media(path=self.path, probe="lazy", entries=info.STREAM_ENTRIES)
+            del self.size, self.br
+
+    def __getattr__(self, name):
+        # only called for missing attributes, which are the lazy ones
+        if name not in ("size", "br") or self.__dict__.get("info") is None:
+            raise AttributeError(name)
+        self.from_mediainfo(self.info)
+        return getattr(self, name)
 
     def __str__(self):
         return str({k: str(v) for k, v in self.__dict__.items()})
@@ -109,11 +125,16 @@ class Format:
         self.path = mi.path
         self.size = TSize(mi.video.w, mi.video.h)
         self.br = mi.video.br
+        if self.br is None and mi.path is not None:
+            # mp4 streams may come without bit_rate, count the packets of the sample tables then.
+            # a packet scan of other files would cost more than the probe
+            br = packets.get_bit_rate(mi.path, scan=False)
+            self.br = str(br) if br is not None else None
         self.info = mi
         return self
 
     def probe_info(self):
-        self.from_mediainfo(info.Media(path=self.path, probe=True))
+        self.from_mediainfo(info.Media(path=self.path, probe=True, entries=info.STREAM_ENTRIES))
 
     def get_save_name(self, basename, ext="mp4"):
         suffix = "{wxh:s}_crf_{crf:f}".format(wxh=self.size.wxh(), crf=self.crf)
@@ -121,66 +142,214 @@ class Format:
         return self.path
 
 
-def run_command(cmdargs):
+def _progress_reader(on_progress, aborted):
+    """
+    :return: on_line(line) for the `-progress pipe:1` key=value lines of ffmpeg,
+             @on_progress is called with each report once its "progress" key is read
+    """
+    report = {}
+
+    def _on_line(line):
+        key, _, value = line.strip().partition("=")
+        report[key] = value
+        if key == "progress" and not aborted and on_progress(dict(report)) is True:
+            aborted.append(True)
+            return True
+    return _on_line
+
+
+def run_command(cmdargs, on_progress=None):
     """
     video transcoding
-    :return: process returncode
+    :param on_progress: on_progress(report) for each ffmpeg progress report <dict> (out_time_us,
+                        total_size, ... as strings), the process is stopped if it returns True
+    :return: process returncode, ABORTED if stopped by @on_progress
     """
     try:
-        log.info("subprocess = " + ' '.join(cmdargs))
-        process = subprocess.Popen(cmdargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-        output, error = process.communicate()
+        aborted = []
+        on_stdout = None
+        if on_progress is not None:
+            cmdargs = cmdargs[:1] + ["-progress", "pipe:1"] + cmdargs[1:]
+            on_stdout = _progress_reader(on_progress, aborted)
+        returncode, output, error = proc.run(cmdargs, on_stdout)
         log.debug("\n" + output + error)
-        if process.returncode:
-            log.error("error[{:d}]: \n{:s}".format(process.returncode, error))
-        return process.returncode
+        if aborted:
+            log.info("aborted " + cmdargs[-1])
+            return ABORTED
+        if returncode:
+            log.error("error[{:d}]: \n{:s}".format(returncode, error))
+        return returncode
     except Exception as e:
         log.error("Exception = `%s`", repr(e))
         raise e
     return 0
 
-def trans_by_ioparam(input, iparam, oparam, output):
+
+def run_command_async(cmdargs):
+    """
+    :return: <proc.Job> of run_command()
+    """
+    return proc.submit(run_command, cmdargs)
+
+def unlink_shared(output):
+    # ffmpeg truncates an existing output, which would also truncate a cache entry linked to it
+    if os.path.isfile(output) and os.stat(output).st_nlink > 1:
+        os.remove(output)
+
+
+def _trans_by_ioparam(input, iparam, oparam, output, on_progress=None):
+    unlink_shared(output)
+    command = [FFMPEG, "-hide_banner"] + iparam + ["-i", input] + oparam + [output]
+    return run_command(command, on_progress)
+
+
+def trans_by_ioparam(input, iparam, oparam, output, trans_cache=None, on_progress=None):
     """
     video transcoding
     :param original: original video info <Format>
     :param iparam: parameters passed to ffmpeg for input [...<string>...]
     :param oparam: parameters passed to ffmpeg for output [...<string>...]
     :param save_path: path for out video <string>
+    :param trans_cache: <cache.TransCache>, reuse the output of the same input and params
+    :param on_progress: see run_command(), an aborted output is not kept in @trans_cache
     :return: process returncode
     """
-    command = [FFMPEG, "-hide_banner"] + iparam + ["-i", input] + oparam + [output]
-    return run_command(command)
+    if trans_cache is not None:
+        return trans_cache.trans(input, iparam, oparam, output,
+                                 lambda i, ip, op, o: _trans_by_ioparam(i, ip, op, o, on_progress))
+    return _trans_by_ioparam(input, iparam, oparam, output, on_progress)
 
 
-def to_264_by_size_crf(original, tsize, crf, save_name=None, _iparam=[], save_dir=None):
+def trans_by_ioparam_async(input, iparam, oparam, output, trans_cache=None):
     """
-    :return: path for the transcoded video
+    :return: <proc.Job> of trans_by_ioparam()
     """
-    tsize.shorter2wxh(original.size)
-    iparam = "-y -threads 0".split(" ") + _iparam
-    oparam = "-s {w:d}x{h:d} -crf {crf:f}".format(w=tsize.w, h=tsize.h, crf=crf).split(" ")
-    oparam += "-c:v libx264 -preset veryslow -vcodec libx264".split(" ")
-    oparam += ["-x264opts", "psy=0:ref=5:keyint=90:min-keyint=9:chroma_qp_offset=0:aq_mode=2:threads=36:lookahead-threads=4"]
+    return proc.submit(trans_by_ioparam, input, iparam, oparam, output, trans_cache)
+
+
+def _trans_multi_by_ioparam(input, iparam, outputs):
+    n = len(outputs)
+    graph = "[0:v]split={:d}".format(n) + "".join("[s{:d}]".format(i) for i in range(n))
+    for i, (vfilter, _, _) in enumerate(outputs):
+        graph += ";[s{:d}]{:s}[o{:d}]".format(i, vfilter or "null", i)
+    command = [FFMPEG, "-hide_banner"] + iparam + ["-i", input, "-filter_complex", graph]
+    for i, (_, oparam, output) in enumerate(outputs):
+        unlink_shared(output)
+        command += ["-map", "[o{:d}]".format(i), "-map", "0:a?"]
+        command += oparam + [output]
+    ret = run_command(command)
+    return [ret if ret else (0 if os.path.isfile(output) and os.path.getsize(output) > 0 else 1)
+            for _, _, output in outputs]
+
+
+def trans_multi_by_ioparam(input, iparam, outputs, trans_cache=None):
+    """
+    decode @input once and encode it to several outputs in one ffmpeg process,
+    the decoded frames are split to a filter chain per output
+    :param iparam: parameters passed to ffmpeg for input [...<string>...]
+    :param outputs: [(vfilter, oparam, output), ...], vfilter like "scale=852:480" is applied
+                    to the split frames of this output, None for none
+    :param trans_cache: <cache.TransCache>, only the outputs missing in it are encoded
+    :return: returncode per output [...<int>...], non-zero if the process failed or
+             the output is missing
+    """
+    if trans_cache is not None:
+        return trans_cache.trans_multi(input, iparam, outputs, _trans_multi_by_ioparam)
+    return _trans_multi_by_ioparam(input, iparam, outputs)
+
+
+def x264_oparam(crf, threads=36, preset="veryslow"):
+    oparam = "-crf {crf:f}".format(crf=crf).split(" ")
+    oparam += "-c:v libx264 -preset {:s} -vcodec libx264".format(preset).split(" ")
+    oparam += ["-x264opts", "psy=0:ref=5:keyint=90:min-keyint=9:chroma_qp_offset=0:aq_mode=2"
+               + ":threads={:d}:lookahead-threads={:d}".format(threads, max(1, threads // 9))]
     oparam += "-maxrate 2500k -bufsize 5M".split(" ")
     oparam += "-async 1 -b:a 48k -ar 44100 -ac 2 -acodec libfdk_aac".split(" ")
     oparam += "-movflags faststart".split(" ")
+    return oparam
+
+
+def x264_save_name(original, tsize, crf, preset="veryslow"):
+    name = os.path.basename(original.path) + ".[" + tsize.wxh() + "].[" + str(crf) + "]"
+    if preset != "veryslow":
+        name += ".[" + preset + "]"
+    return name + ".mp4"
+
+
+def to_264_by_size_crf(original, tsize, crf, save_name=None, _iparam=[], save_dir=None, threads=36,
+                       trans_cache=None, preset="veryslow", on_progress=None):
+    """
+    :param threads: x264 threads, lookahead threads follow at 1/9 of it
+    :param trans_cache: <cache.TransCache>, see trans_by_ioparam()
+    :param preset: x264 preset
+    :param on_progress: see run_command()
+    :return: path for the transcoded video, None if failed or aborted
+    """
+    tsize.shorter2wxh(original.size)
+    iparam = "-y -threads 0".split(" ") + _iparam
+    oparam = "-s {w:d}x{h:d}".format(w=tsize.w, h=tsize.h).split(" ") + x264_oparam(crf, threads, preset)
     if save_name is None:
-        save_name = os.path.basename(original.path) + ".[" + tsize.wxh() + "].[" + str(crf) + "].mp4"
+        save_name = x264_save_name(original, tsize, crf, preset)
     save_path = utils.prepare_save_path(save_name, save_dir)
-    ret = trans_by_ioparam(original.path, iparam, oparam, save_path)
+    ret = trans_by_ioparam(original.path, iparam, oparam, save_path, trans_cache, on_progress)
+    if ret == ABORTED:
+        return None
     if ret is not 0:
         log.error("transcoding failed")
         return None
     return save_path
 
 
-def to_yuv_by_size(original, tsize, save_name=None, _iparam=[], _oparam=[], save_dir=None):
+def to_264_multi(original, specs, _iparam=[], save_dir=None, threads=36, trans_cache=None, preset="veryslow"):
     """
-    :return: path for the raw yuv
+    encode several (size, crf) points of @original with one decoding, see trans_multi_by_ioparam()
+    :param specs: [(tsize <TSize>, crf), ...]
+    :param threads: x264 threads of each encoder
+    :return: path for each transcoded video, None for the failed ones [...<string>...]
+    """
+    iparam = "-y -threads 0".split(" ") + _iparam
+    outputs = []
+    for tsize, crf in specs:
+        tsize.shorter2wxh(original.size)
+        save_path = utils.prepare_save_path(x264_save_name(original, tsize, crf, preset), save_dir)
+        outputs.append(("scale={w:d}:{h:d}".format(w=tsize.w, h=tsize.h), x264_oparam(crf, threads, preset),
+                        save_path))
+    rets = trans_multi_by_ioparam(original.path, iparam, outputs, trans_cache)
+    paths = []
+    for ret, (_, _, save_path) in zip(rets, outputs):
+        if ret is not 0:
+            log.error("transcoding failed " + save_path)
+        paths.append(save_path if ret is 0 else None)
+    return paths
+
+
+def yuv420p_chroma_size(w, h):
+    """
+    :return: (w, h) of the chroma planes of a @w x @h yuv420p frame, rounded up for odd sizes like ffmpeg
     """
+    return (w + 1) // 2, (h + 1) // 2
+
+
+def yuv420p_frame_bytes(w, h):
+    """
+    :return: bytes of one raw @w x @h yuv420p frame
+    """
+    cw, ch = yuv420p_chroma_size(w, h)
+    return w * h + 2 * cw * ch
+
+
+def _yuv_ioparam(original, tsize, _iparam=[], _oparam=[]):
     tsize.shorter2wxh(original.size)
     iparam = "-y -threads 0".split(" ") + _iparam
     oparam = ["-an", "-s", tsize.wxh()] + _oparam + ["-f", "rawvideo"]
+    return iparam, oparam
+
+
+def to_yuv_by_size(original, tsize, save_name=None, _iparam=[], _oparam=[], save_dir=None):
+    """
+    :return: path for the raw yuv
+    """
+    iparam, oparam = _yuv_ioparam(original, tsize, _iparam, _oparam)
     if save_name is None:
         save_name = os.path.basename(original.path) + ".[" + tsize.wxh() + "].yuv"
     save_path = utils.prepare_save_path(save_name, save_dir)
@@ -191,6 +360,24 @@ def to_yuv_by_size(original, tsize, save_name=None, _iparam=[], _oparam=[], save
     return save_path
 
 
+def open_yuv_pipe(original, tsize, pipe_path, _iparam=[], _oparam=[]):
+    """
+    start decoding to raw yuv into @pipe_path (a named pipe) without waiting.
+    the reader side must open @pipe_path, or the decoder blocks forever.
+    decoders take no proc slot, the reader holding one waits for them
+    :return: decoder process <subprocess.Popen>
+    """
+    iparam, oparam = _yuv_ioparam(original, tsize, _iparam, _oparam)
+    command = [FFMPEG, "-hide_banner", "-nostdin", "-loglevel", "error"] + iparam
+    command += ["-i", original.path] + oparam + [pipe_path]
+    log.info("subprocess = " + ' '.join(command))
+    devnull = open(os.devnull, "w")
+    try:
+        return subprocess.Popen(command, stdout=devnull, stderr=devnull, shell=False)
+    finally:
+        devnull.close()
+
+
 def _main_test(path, size, crf):
     ori_fmt = Format(path, probe=True)
     tsize = TSize().from_string(size)
@@ -38,3 +38,19 @@ def prepare_save_path(save_name, save_dir=None):
     if not os.path.isdir(os.path.dirname(save_path)):
         os.makedirs(os.path.dirname(save_path))
     return save_path
+
+
+def parse_bytes(size):
+    """
+    :param size: bytes <int>, or string with K/M/G/T suffix like "20G"
+    :return: bytes <int>
+    """
+    if size is None:
+        return 0
+    if isinstance(size, (int, long, float)):
+        return int(size)
+    size = size.strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)